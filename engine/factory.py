@@ -64,7 +64,13 @@ class EngineFactory(IBus.Factory):
             if engine_name in self.dbdict:
                 self.db = self.dbdict[engine_name]
             else:
-                self.db = tabsqlitedb.TabSqliteDb()
+                # All engines share one database object (and its
+                # writer thread, n-gram trie and caches), only the
+                # first engine created opens it. A system n-gram
+                # database is only attached when one is configured,
+                # see TypingBoosterEngine.set_system_ngram_db():
+                self.db = tabsqlitedb.get_shared_database(
+                    ngram_trie=True, writer_thread=True)
                 self.dbdict[engine_name] = self.db
             if engine_name in self.enginedict:
                 engine = self.enginedict[engine_name]
@@ -85,5 +91,6 @@ class EngineFactory(IBus.Factory):
         if DEBUG_LEVEL > 1:
             sys.stderr.write("EngineFactory.do_destroy()\n")
         for _db in self.dbdict:
-            self.dbdict[_db].sync_usrdb()
+            tabsqlitedb.release_shared_database(self.dbdict[_db])
+        self.dbdict = {}
         super(EngineFactory, self).destroy()
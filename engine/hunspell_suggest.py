@@ -27,6 +27,20 @@ hunspell dictonaries.
 import os
 import sys
 import unicodedata
+import bisect
+import array
+import json
+import mmap
+import struct
+import time
+import threading
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import pickle
+import traceback
+import weakref
+import zlib
 import itb_util
 
 DEBUG_LEVEL = int(0)
@@ -51,58 +65,1127 @@ except (ImportError,):
 # letter of a word until the candidate lookup table pops up.
 MAX_WORDS = 100
 
+# Maximum number of input phrases whose suggestions are cached.
+# Each cached entry holds up to MAX_WORDS suggestions. The statistics
+# of the cache are shown in the debug output of the engine and
+# can be used to tune this number.
+SUGGEST_CACHE_SIZE = 1000
+
+# Maximum number of word forms generated from each word of a .dic file
+# by the prefix and suffix rules of the .aff file. The generated forms
+# are added to the word index, so that inflected forms can be completed
+# as fast as the words listed in the .dic file. 0 disables the
+# expansion. The expansion makes compiling a word index slower, but
+# that is done only once in the background and the index is cached.
+# Changing this rebuilds the cached word indexes:
+MAX_AFFIX_FORMS_PER_STEM = 20
+
+# Version of the format of the files where the precompiled
+# dictionaries are cached. Increase this whenever the format or the
+# way the keys are computed changes, cache files with a different
+# version are ignored and rewritten then:
+DICTIONARY_CACHE_VERSION = 3
+
+_WORD_INDEX_MAGIC = b'ITBWIDX\0'
+_WORD_INDEX_HEADER = struct.Struct('=8sIIII')
+# Key id of a word whose key is the word itself:
+_KEY_SAME_AS_WORD = 0xFFFFFFFF
+
+# Word indexes and deletion indexes currently in use in this process,
+# indexed by the path and signature of the index file. Dictionaries
+# which are loaded more than once, for example by several engines,
+# share the same index:
+_WORD_INDEXES = weakref.WeakValueDictionary()
+
+_DELETION_INDEX_MAGIC = b'ITBDIDX\0'
+_DELETION_INDEX_HEADER = struct.Struct('=8sIIII')
+
+# Maximum edit distance of the corrections found by a DeletionIndex:
+DELETION_INDEX_MAX_DISTANCE = 2
+# Only the deletions of this many characters at the beginning of the
+# words are indexed, longer words are verified by computing the edit
+# distance. This keeps the index small:
+DELETION_INDEX_PREFIX_LENGTH = 7
+
+# List of languages where accent insensitive matching makes sense:
+ACCENT_LANGUAGES = (
+    'af', 'ast', 'az', 'be', 'bg', 'br', 'bs', 'ca', 'cs', 'csb',
+    'cv', 'cy', 'da', 'de', 'dsb', 'el', 'en', 'es', 'eu', 'fo',
+    'fr', 'fur', 'fy', 'ga', 'gd', 'gl', 'grc', 'gv', 'haw', 'hr',
+    'hsb', 'ht', 'hu', 'ia', 'is', 'it', 'kk', 'ku', 'ky', 'lb',
+    'ln', 'lv', 'mg', 'mi', 'mk', 'mn', 'mos', 'mt', 'nb', 'nds',
+    'nl', 'nn', 'nr', 'nso', 'ny', 'oc', 'pl', 'plt', 'pt', 'qu',
+    'quh', 'ru', 'sc', 'se', 'sh', 'shs', 'sk', 'sl', 'smj', 'sq',
+    'sr', 'ss', 'st', 'sv', 'tet', 'tk', 'tn', 'ts', 'uk', 'uz',
+    've', 'vi', 'wa', 'xh',
+)
+
+def dictionary_cache_path(name, suffix='.index'):
+    '''Returns the full path of the file where the precompiled
+    dictionary “name” is cached.
+
+    The cache files are in “~/.local/share/ibus-typing-booster/dictionaries”
+    by default.
+
+    :param name: Name of the dictionary, for example “en_US”
+    :type name: String
+    :param suffix: “.index” for the word index, “.deletions” for
+                   the deletion index
+    :type suffix: String
+    :rtype: String
+    '''
+    return os.path.join(
+        itb_util.xdg_save_data_path('ibus-typing-booster/dictionaries'),
+        name + suffix)
+
+def _file_signature(file_path):
+    '''Returns a list [path, size, mtime] identifying the
+    current contents of a file.
+
+    If the file does not exist, size and mtime are 0.
+    '''
+    try:
+        stat_result = os.stat(file_path)
+    except (OSError,):
+        return [file_path, 0, 0]
+    return [file_path, stat_result.st_size, stat_result.st_mtime_ns]
+
+class _StringSequence:
+    '''A read-only sequence of the strings stored in a section of
+    a WordIndex.
+
+    Each string is encoded in UTF-8 and followed by a “\\n”, the
+    offsets point to the beginning of each string relative to the
+    start of the section and have one extra element pointing to the
+    end of the section.
+    '''
+    def __init__(self, buffer, start, offsets):
+        self._buffer = buffer
+        self._start = start
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            (first, last, step) = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(first, last, step)]
+            if first >= last:
+                return []
+            # The strings in a range are stored contiguously, decode
+            # them all at once:
+            return self._buffer[
+                self._start + self._offsets[first]:
+                self._start + self._offsets[last] - 1
+            ].decode('UTF-8').split('\n')
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('index out of range')
+        return self._buffer[
+            self._start + self._offsets[index]:
+            self._start + self._offsets[index + 1] - 1
+        ].decode('UTF-8')
+
+    def __iter__(self):
+        return iter(self[:])
+
+class _KeySequence:
+    '''A read-only sequence of the keys of a WordIndex
+
+    Only the keys which differ from their words are stored, key_ids[i]
+    is either _KEY_SAME_AS_WORD or the position of the key of word i
+    in differing_keys.
+    '''
+    def __init__(self, words, key_ids, differing_keys):
+        self._words = words
+        self._key_ids = key_ids
+        self._differing_keys = differing_keys
+
+    def __len__(self):
+        return len(self._key_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        key_id = self._key_ids[index]
+        if key_id == _KEY_SAME_AS_WORD:
+            return self._words[index]
+        return self._differing_keys[key_id]
+
+    def __iter__(self):
+        return iter(self[:])
+
+class _PooledSequence:
+    '''A read-only sequence of the words (or keys) of one dictionary
+    stored in a word pool, see load_word_pool()
+
+    Element i is strings[positions[i]]. The positions are ascending,
+    so the words of a range are in one contiguous range of the pool.
+    '''
+    def __init__(self, strings, positions):
+        self._strings = strings
+        self._positions = positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            (first, last, step) = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(first, last, step)]
+            if first >= last:
+                return []
+            # Decode the contiguous range of the pool at once and
+            # pick the words of this dictionary from it:
+            start = self._positions[first]
+            strings = self._strings[start:self._positions[last - 1] + 1]
+            return [strings[self._positions[i] - start]
+                    for i in range(first, last)]
+        return self._strings[self._positions[index]]
+
+    def __iter__(self):
+        return iter(self[:])
+
+class WordIndex:
+    '''A read-only, sorted index of the words of a dictionary and of
+    the keys used to match them.
+
+    The index is usually stored in a file which is memory mapped.
+    The engine, the setup tool and any other process using the same
+    dictionary then share the pages of that file in the page cache
+    instead of each holding large lists of Python strings.
+
+    File format (integers are unsigned 32 bit in native byte order):
+
+        header:       magic “ITBWIDX\\0”, format version, number of
+                      words n, maximum word length, length m of the
+                      metadata
+        metadata:     m bytes of JSON, padded with NUL bytes to a
+                      multiple of 4 bytes
+        word offsets: n + 1 integers
+        key ids:      n integers, the position of the key of each word
+                      in the differing keys or 0xFFFFFFFF if the key
+                      is the word itself
+        key offsets:  m + 1 integers for the m differing keys
+        words:        the words in UTF-8, each followed by “\\n”
+        keys:         the m keys which differ from their words in
+                      UTF-8, each followed by “\\n”
+        members:      only in a word pool, see load_word_pool(),
+                      after padding to a multiple of 4 bytes: for each
+                      dictionary listed in the metadata, the positions
+                      of its words in this index as integers
+
+    The key ids, key offsets and keys are only present if at least
+    one key differs from its word. The words are sorted by their keys.
+
+    The index needs a few bytes per word on top of the UTF-8 text of
+    the words, the keys cost nothing for words without accents.
+    For dictionaries where accent insensitive matching does not make
+    sense, there are no keys at all.
+
+    Examples:
+
+    >>> index = WordIndex(WordIndex.build(
+    ...     ['Alpenglühen', 'Glühwürmchen', 'Glut'],
+    ...     ['Alpengluhen', 'Gluhwurmchen', 'Glut']))
+    >>> index.completions('Glu')
+    ['Glühwürmchen', 'Glut']
+
+    >>> index.completions('Glut')
+    ['Glut']
+
+    >>> index.words[0]
+    'Alpenglühen'
+
+    >>> index.max_word_len
+    12
+
+    >>> index.keys[0]
+    'Alpengluhen'
+
+    >>> index.keys[2] is index.words[2]
+    False
+
+    >>> index.keys[2] == index.words[2]
+    True
+    '''
+    def __init__(self, buffer):
+        self._buffer = buffer
+        (magic,
+         version,
+         number_of_words,
+         self.max_word_len,
+         metadata_length) = _WORD_INDEX_HEADER.unpack_from(buffer, 0)
+        if magic != _WORD_INDEX_MAGIC or version != DICTIONARY_CACHE_VERSION:
+            raise ValueError('Not a word index of the current version')
+        position = _WORD_INDEX_HEADER.size
+        self.metadata = json.loads(
+            bytes(buffer[position:position + metadata_length])
+            .decode('UTF-8'))
+        position += _padded_length(metadata_length)
+        offsets_size = (number_of_words + 1) * 4
+        view = memoryview(buffer)
+        word_offsets = view[position:position + offsets_size].cast('I')
+        position += offsets_size
+        number_of_keys = self.metadata.get('differing_keys', 0)
+        key_ids = None
+        if number_of_keys:
+            key_ids = view[
+                position:position + number_of_words * 4].cast('I')
+            position += number_of_words * 4
+            key_offsets = view[
+                position:position + (number_of_keys + 1) * 4].cast('I')
+            position += (number_of_keys + 1) * 4
+        self.words = _StringSequence(buffer, position, word_offsets)
+        self.keys = self.words
+        position += word_offsets[-1]
+        if key_ids is not None:
+            self.keys = _KeySequence(
+                self.words,
+                key_ids,
+                _StringSequence(buffer, position, key_offsets))
+            position += key_offsets[-1]
+        # In a word pool, the positions of the words of each member
+        # dictionary:
+        self.members = {}
+        position = _padded_length(position)
+        for (name, count) in self.metadata.get('members', []):
+            self.members[name] = view[
+                position:position + count * 4].cast('I')
+            position += count * 4
+
+    def __len__(self):
+        return len(self.words)
+
+    @classmethod
+    def open(cls, file_path, signature=None):
+        '''Open a memory mapped word index file
+
+        Returns None if the file does not exist, is not a valid index
+        of the current format version or if its signature differs
+        from the signature given.
+
+        If the same index file with the same signature is already open
+        in this process, the same WordIndex object is returned again.
+
+        :param file_path: Full path of the index file
+        :type file_path: String
+        :param signature: If not None, the signature of the files the
+                          index should have been compiled from.
+        :type signature: List
+        :rtype: WordIndex object or None
+        '''
+        return _open_index_file(cls, file_path, signature)
+
+    @staticmethod
+    def build(words, keys=None, metadata=None, members=()):
+        '''Build the contents of a word index
+
+        :param words: The words, sorted by their keys
+        :type words: List of strings
+        :param keys: The keys of the words, sorted. If None, the
+                     words are used as keys.
+        :type keys: List of strings
+        :param metadata: Additional information to store in the index
+        :type metadata: Dictionary which can be serialized as JSON
+        :param members: Only for a word pool, the names of the member
+                        dictionaries and the positions of their words
+                        in words
+        :type members: List of tuples (string, sequence of integers)
+        :rtype: Bytes
+        '''
+        key_ids = array.array('I')
+        differing_keys = []
+        if keys is not None:
+            for (word, key) in zip(words, keys):
+                if key == word:
+                    key_ids.append(_KEY_SAME_AS_WORD)
+                else:
+                    key_ids.append(len(differing_keys))
+                    differing_keys.append(key)
+        if not differing_keys:
+            key_ids = array.array('I')
+        metadata = dict(metadata or {})
+        metadata['differing_keys'] = len(differing_keys)
+        if members:
+            metadata['members'] = [
+                [name, len(positions)] for (name, positions) in members]
+        metadata_bytes = json.dumps(metadata).encode('UTF-8')
+        sections = [
+            _WORD_INDEX_HEADER.pack(
+                _WORD_INDEX_MAGIC,
+                DICTIONARY_CACHE_VERSION,
+                len(words),
+                max([len(x) for x in words] + [0]),
+                len(metadata_bytes)),
+            metadata_bytes.ljust(_padded_length(len(metadata_bytes)), b'\0')]
+        data = []
+        for strings in (words, differing_keys):
+            if strings is differing_keys and not strings:
+                break
+            offsets = array.array('I', [0])
+            encoded = [x.encode('UTF-8') + b'\n' for x in strings]
+            for item in encoded:
+                offsets.append(offsets[-1] + len(item))
+            if strings is differing_keys:
+                sections.append(key_ids.tobytes())
+            sections.append(offsets.tobytes())
+            data.append(b''.join(encoded))
+        if members:
+            length = sum([len(x) for x in sections + data])
+            data.append(b'\0' * (_padded_length(length) - length))
+            for (dummy_name, positions) in members:
+                data.append(array.array('I', positions).tobytes())
+        return b''.join(sections + data)
+
+    @staticmethod
+    def write(file_path, words, keys=None, metadata=None, members=()):
+        '''Write a word index file
+
+        The file is written to a temporary file first and then
+        renamed, so that other processes never see a partially
+        written index. Processes which have the old file mapped
+        continue to use the old contents.
+
+        See WordIndex.build() for the parameters.
+        '''
+        _write_index_file(
+            file_path, WordIndex.build(words, keys, metadata, members))
+
+    def completions(self, prefix):
+        '''Returns the words whose keys start with prefix
+
+        The lookup is a binary search in the sorted keys, i.e. it is
+        O(log n + k) where n is the number of words in the index and k
+        is the number of matches.
+
+        :param prefix: The beginning of the keys to find
+        :type prefix: String
+        :rtype: List of strings
+        '''
+        (first, last) = _completion_range(self.keys, prefix)
+        return self.words[first:last]
+
+class DeletionIndex:
+    '''An index to find the words of a dictionary within a small
+    edit distance of a possibly misspelled input.
+
+    This uses the symmetric deletion idea of the SymSpell algorithm:
+    two words are within edit distance d of each other only if
+    deleting at most d characters from both of them gives a common
+    string. The deletions of all words are computed once and stored
+    in the index, the lookup then only needs to compute the
+    deletions of the input and verify the few words found. This takes
+    well below a millisecond and works for short inputs as well,
+    unlike enchant and pyhunspell.
+
+    To keep the index small, only the deletions of the first
+    DELETION_INDEX_PREFIX_LENGTH characters are stored, for the
+    distinct prefixes of the keys of a WordIndex. The keys sharing a
+    prefix are consecutive in the WordIndex and form a group.
+
+    File format (integers are unsigned 32 bit in native byte order):
+
+        header:        magic “ITBDIDX\\0”, format version, number of
+                       groups g, number of deletions n, length m of
+                       the metadata
+        metadata:      m bytes of JSON, padded with NUL bytes to a
+                       multiple of 4 bytes
+        group starts:  g + 1 integers, the position of the first key
+                       of each group in the WordIndex
+        bucket starts: b + 1 integers, the deletions are in a hash
+                       table with b buckets (b is in the metadata)
+        hashes:        n integers, the CRC32 of each deletion
+        groups:        n integers, the group of each deletion
+
+    Examples:
+
+    >>> keys = ['Hause', 'Haus', 'Maus', 'the', 'then']
+    >>> keys.sort()
+    >>> index = DeletionIndex(DeletionIndex.build(keys))
+    >>> [(distance, keys[x])
+    ...  for (distance, x) in index.corrections(keys, 'Huas')]
+    [(1, 'Haus'), (2, 'Hause'), (2, 'Maus')]
+
+    >>> index.corrections(keys, 'teh', max_distance=1)
+    [(1, 3)]
+    '''
+    def __init__(self, buffer):
+        self._buffer = buffer
+        (magic,
+         version,
+         number_of_groups,
+         number_of_deletions,
+         metadata_length) = _DELETION_INDEX_HEADER.unpack_from(buffer, 0)
+        if (magic != _DELETION_INDEX_MAGIC
+                or version != DICTIONARY_CACHE_VERSION):
+            raise ValueError('Not a deletion index of the current version')
+        position = _DELETION_INDEX_HEADER.size
+        self.metadata = json.loads(
+            bytes(buffer[position:position + metadata_length])
+            .decode('UTF-8'))
+        if (self.metadata.get('prefix_length')
+                != DELETION_INDEX_PREFIX_LENGTH
+                or self.metadata.get('max_distance')
+                != DELETION_INDEX_MAX_DISTANCE):
+            raise ValueError('Deletion index with different parameters')
+        position += _padded_length(metadata_length)
+        view = memoryview(buffer)
+        number_of_buckets = self.metadata['buckets']
+        sections = []
+        for length in (number_of_groups + 1,
+                       number_of_buckets + 1,
+                       number_of_deletions,
+                       number_of_deletions):
+            sections.append(view[position:position + length * 4].cast('I'))
+            position += length * 4
+        (self._group_starts,
+         self._bucket_starts,
+         self._hashes,
+         self._groups) = sections
+
+    @classmethod
+    def open(cls, file_path, signature=None):
+        '''Open a memory mapped deletion index file
+
+        Returns None if the file does not exist, is not a valid index
+        of the current format version or if its signature differs
+        from the signature given.
+
+        :param file_path: Full path of the index file
+        :type file_path: String
+        :param signature: If not None, the signature of the files the
+                          index should have been compiled from.
+        :type signature: List
+        :rtype: DeletionIndex object or None
+        '''
+        return _open_index_file(cls, file_path, signature)
+
+    @staticmethod
+    def build(keys, metadata=None):
+        '''Build the contents of a deletion index
+
+        :param keys: The sorted keys of a WordIndex
+        :type keys: Sequence of strings
+        :param metadata: Additional information to store in the index
+        :type metadata: Dictionary which can be serialized as JSON
+        :rtype: Bytes
+        '''
+        group_starts = array.array('I')
+        hashes = array.array('I')
+        groups = array.array('I')
+        previous_prefix = None
+        for (position, key) in enumerate(keys):
+            prefix = key[:DELETION_INDEX_PREFIX_LENGTH]
+            if prefix == previous_prefix:
+                continue
+            previous_prefix = prefix
+            group = len(group_starts)
+            group_starts.append(position)
+            for deletion in _deletions(prefix, DELETION_INDEX_MAX_DISTANCE):
+                hashes.append(zlib.crc32(deletion.encode('UTF-8')))
+                groups.append(group)
+        group_starts.append(len(keys))
+        # Sort the deletions into the buckets of a hash table:
+        number_of_buckets = len(hashes) // 2 + 1
+        bucket_starts = array.array('I', bytes(4 * (number_of_buckets + 1)))
+        for value in hashes:
+            bucket_starts[value % number_of_buckets + 1] += 1
+        for bucket in range(number_of_buckets):
+            bucket_starts[bucket + 1] += bucket_starts[bucket]
+        fill = array.array('I', bucket_starts)
+        sorted_hashes = array.array('I', bytes(4 * len(hashes)))
+        sorted_groups = array.array('I', bytes(4 * len(hashes)))
+        for (value, group) in zip(hashes, groups):
+            bucket = value % number_of_buckets
+            sorted_hashes[fill[bucket]] = value
+            sorted_groups[fill[bucket]] = group
+            fill[bucket] += 1
+        del hashes, groups, fill
+        metadata = dict(metadata or {})
+        metadata['prefix_length'] = DELETION_INDEX_PREFIX_LENGTH
+        metadata['max_distance'] = DELETION_INDEX_MAX_DISTANCE
+        metadata['buckets'] = number_of_buckets
+        metadata_bytes = json.dumps(metadata).encode('UTF-8')
+        return b''.join([
+            _DELETION_INDEX_HEADER.pack(
+                _DELETION_INDEX_MAGIC,
+                DICTIONARY_CACHE_VERSION,
+                len(group_starts) - 1,
+                len(sorted_hashes),
+                len(metadata_bytes)),
+            metadata_bytes.ljust(_padded_length(len(metadata_bytes)), b'\0'),
+            group_starts.tobytes(),
+            bucket_starts.tobytes(),
+            sorted_hashes.tobytes(),
+            sorted_groups.tobytes()])
+
+    @staticmethod
+    def write(file_path, keys, metadata=None):
+        '''Write a deletion index file
+
+        See DeletionIndex.build() for the parameters and
+        WordIndex.write() about how the file is replaced.
+        '''
+        _write_index_file(file_path, DeletionIndex.build(keys, metadata))
+
+    def corrections(self, keys, term, max_distance=None):
+        '''Returns the keys within a small edit distance of term
+
+        The distance is the optimal string alignment distance, i.e.
+        insertions, deletions, substitutions and transpositions of
+        adjacent characters count as one edit each. term itself is
+        not returned.
+
+        :param keys: The sorted keys of the WordIndex this index
+                     has been built from
+        :type keys: Sequence of strings
+        :param term: The possibly misspelled input
+        :type term: String
+        :param max_distance: The maximum edit distance, None means
+                             DELETION_INDEX_MAX_DISTANCE
+        :type max_distance: Integer
+        :rtype: List of tuples (distance, position) sorted by distance,
+                position is the position of the key in keys.
+        '''
+        if max_distance is None:
+            max_distance = DELETION_INDEX_MAX_DISTANCE
+        max_distance = min(max_distance, DELETION_INDEX_MAX_DISTANCE)
+        number_of_buckets = len(self._bucket_starts) - 1
+        candidate_groups = set()
+        for deletion in _deletions(
+                term[:DELETION_INDEX_PREFIX_LENGTH], max_distance):
+            value = zlib.crc32(deletion.encode('UTF-8'))
+            bucket = value % number_of_buckets
+            for position in range(self._bucket_starts[bucket],
+                                  self._bucket_starts[bucket + 1]):
+                if self._hashes[position] == value:
+                    candidate_groups.add(self._groups[position])
+        corrections = []
+        for group in candidate_groups:
+            start = self._group_starts[group]
+            end = self._group_starts[group + 1]
+            for (offset, key) in enumerate(keys[start:end]):
+                if key == term:
+                    continue
+                distance = _edit_distance(term, key, max_distance)
+                if distance <= max_distance:
+                    corrections.append((distance, start + offset))
+        return sorted(corrections)
+
+def _deletions(term, max_distance):
+    '''Returns the set of strings which can be made from term by
+    deleting up to max_distance characters
+
+    Strings are not shortened to less than one character.
+
+    Examples:
+
+    >>> sorted(_deletions('abc', 1))
+    ['ab', 'abc', 'ac', 'bc']
+
+    >>> sorted(_deletions('abc', 2))
+    ['a', 'ab', 'abc', 'ac', 'b', 'bc', 'c']
+    '''
+    deletions = {term}
+    last = {term}
+    for dummy_distance in range(max_distance):
+        new = set()
+        for string in last:
+            if len(string) > 1:
+                for i in range(len(string)):
+                    new.add(string[:i] + string[i + 1:])
+        new -= deletions
+        deletions |= new
+        last = new
+    return deletions
+
+def _edit_distance(source, target, max_distance):
+    '''Returns the optimal string alignment distance between two
+    strings, or max_distance + 1 if it is larger than max_distance
+
+    Examples:
+
+    >>> _edit_distance('teh', 'the', 2)
+    1
+
+    >>> _edit_distance('Hasu', 'Hause', 2)
+    2
+
+    >>> _edit_distance('kitten', 'sitting', 2)
+    3
+    '''
+    if abs(len(source) - len(target)) > max_distance:
+        return max_distance + 1
+    before_previous = None
+    previous = list(range(len(target) + 1))
+    for i in range(1, len(source) + 1):
+        current = [i] + [0] * len(target)
+        for j in range(1, len(target) + 1):
+            cost = 0 if source[i - 1] == target[j - 1] else 1
+            value = min(previous[j] + 1,
+                        current[j - 1] + 1,
+                        previous[j - 1] + cost)
+            if (i > 1 and j > 1
+                    and source[i - 1] == target[j - 2]
+                    and source[i - 2] == target[j - 1]):
+                value = min(value, before_previous[j - 2] + 1)
+            current[j] = value
+        if min(current) > max_distance:
+            return max_distance + 1
+        before_previous = previous
+        previous = current
+    return min(previous[-1], max_distance + 1)
+
+def _open_index_file(cls, file_path, signature):
+    '''Memory map a WordIndex or DeletionIndex file
+
+    See WordIndex.open().
+    '''
+    shared_key = (file_path, json.dumps(signature))
+    index = _WORD_INDEXES.get(shared_key)
+    if index is not None:
+        return index
+    try:
+        with open(file_path, 'rb') as index_file:
+            buffer = mmap.mmap(
+                index_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError,):
+        return None
+    try:
+        index = cls(buffer)
+    except (ValueError, TypeError, KeyError, struct.error,):
+        return None
+    if signature is not None and index.metadata.get(
+            'signature') != signature:
+        return None
+    _WORD_INDEXES[shared_key] = index
+    return index
+
+def _write_index_file(file_path, data):
+    '''Write the contents of an index file
+
+    The data is written to a temporary file first and then renamed,
+    so that other processes never see a partially written index.
+    Processes which have the old file mapped continue to use the old
+    contents.
+    '''
+    tmp_path = file_path + '.%s.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as index_file:
+        index_file.write(data)
+    os.replace(tmp_path, file_path)
+
+def _padded_length(length):
+    '''Returns length rounded up to a multiple of 4'''
+    return (length + 3) // 4 * 4
+
+def _completion_range(keys, prefix, low=0, high=None):
+    '''Returns the range of the sorted keys which start with prefix
+
+    :param keys: The sorted keys
+    :type keys: Sequence of strings
+    :param prefix: The beginning of the keys to find
+    :type prefix: String
+    :param low: Start of the range of keys to search in
+    :type low: Integer
+    :param high: End of the range of keys to search in, None means
+                 the end of the keys.
+    :type high: Integer
+    :rtype: Tuple of two integers (first, last) such that
+            keys[first:last] are the keys starting with prefix
+
+    Examples:
+
+    >>> _completion_range(['a', 'ab', 'abc', 'b'], 'ab')
+    (1, 3)
+
+    >>> _completion_range(['a', 'ab', 'abc', 'b'], 'abc', 1, 3)
+    (2, 3)
+
+    >>> _completion_range(['a', 'ab', 'abc', 'b'], 'c')
+    (4, 4)
+    '''
+    if high is None:
+        high = len(keys)
+    if not prefix:
+        return (low, high)
+    first = bisect.bisect_left(keys, prefix, low, high)
+    # All keys starting with prefix are smaller than prefix with
+    # its last character incremented:
+    if ord(prefix[-1]) < sys.maxunicode:
+        last = bisect.bisect_left(
+            keys,
+            prefix[:-1] + chr(ord(prefix[-1]) + 1),
+            first,
+            high)
+    else:
+        last = high
+        for index in range(first, high):
+            if not keys[index].startswith(prefix):
+                last = index
+                break
+    return (first, last)
+
+def dictionary_signature(name):
+    '''Returns the signature of the .dic and .aff files of a hunspell
+    dictionary a word index is tagged with, or None if the dictionary
+    is not installed
+
+    The maximum number of affixed forms per word is part of the
+    signature as well, it changes the contents of the index.
+
+    :param name: Name of the dictionary, e.g. 'en_US'
+    :type name: String
+    :rtype: List or None
+    '''
+    (dic_path, aff_path) = itb_util.find_hunspell_dictionary(name)
+    if not dic_path:
+        return None
+    return [_file_signature(dic_path),
+            _file_signature(aff_path),
+            MAX_AFFIX_FORMS_PER_STEM]
+
+def word_index_is_current(name):
+    '''Checks whether an up to date word index file of a hunspell
+    dictionary is in the cache
+
+    Returns True as well if the dictionary is not installed, there
+    is nothing to compile then.
+
+    :param name: Name of the dictionary, e.g. 'en_US'
+    :type name: String
+    :rtype: Boolean
+    '''
+    signature = dictionary_signature(name)
+    if signature is None:
+        return True
+    try:
+        return WordIndex.open(
+            dictionary_cache_path(name), signature) is not None
+    except (OSError,):
+        return False
+
+def compile_word_index(name, signature):
+    '''Parse the .dic file of a hunspell dictionary, add the word
+    forms generated by the affix rules of the .aff file (up to
+    MAX_AFFIX_FORMS_PER_STEM per word), build the sorted lists of
+    words and keys and write them to a word index file in the cache.
+
+    Returns the new memory mapped word index. If the word index
+    file could not be written, a word index in memory is returned
+    instead. If the dictionary could not be read, None is returned.
+
+    :param name: Name of the dictionary, e.g. 'en_US'
+    :type name: String
+    :param signature: Signature of the .dic and .aff files, the
+                      word index is tagged with it.
+    :type signature: List
+    :rtype: WordIndex object or None
+    '''
+    (_dic_path,
+     encoding,
+     words) = itb_util.get_hunspell_dictionary_wordlist(
+         name, max_affix_forms=MAX_AFFIX_FORMS_PER_STEM)
+    if not words:
+        return None
+    # Affixed forms are often listed in the .dic file as well:
+    words = set(words)
+    keys = None
+    if name.split('_')[0] in ACCENT_LANGUAGES:
+        word_pairs = sorted([
+            (itb_util.remove_accents(x), x)
+            for x in words
+        ])
+        keys = [x[0] for x in word_pairs]
+        words = [x[1] for x in word_pairs]
+        del word_pairs
+    else:
+        words = sorted(words)
+    metadata = {'name': name,
+                'encoding': encoding,
+                'signature': signature}
+    try:
+        index_path = dictionary_cache_path(name)
+        WordIndex.write(index_path, words, keys, metadata)
+        index = WordIndex.open(index_path, signature)
+        if index is not None:
+            return index
+    except (OSError,) as error:
+        sys.stderr.write(
+            'Could not write the word index for %s: %s\n'
+            % (name, error))
+    index = WordIndex(WordIndex.build(words, keys, metadata))
+    _WORD_INDEXES[(name, json.dumps(signature))] = index
+    return index
+
+def load_deletion_index(name, signature, keys):
+    '''Returns the deletion index of a hunspell dictionary
+
+    The deletion index is memory mapped from the cache if it is up to
+    date, otherwise it is built from the keys of the word index of
+    the dictionary and written to the cache next to the word index.
+    If the file cannot be written, the index is kept in memory.
+
+    :param name: Name of the dictionary, e.g. 'en_US'
+    :type name: String
+    :param signature: Signature of the .dic and .aff files the
+                      word index has been compiled from
+    :type signature: List
+    :param keys: The sorted keys of the word index
+    :type keys: Sequence of strings
+    :rtype: DeletionIndex object or None
+    '''
+    if not keys:
+        return None
+    try:
+        index_path = dictionary_cache_path(name, suffix='.deletions')
+        index = DeletionIndex.open(index_path, signature)
+        if index is not None:
+            return index
+    except (OSError,):
+        index_path = None
+    metadata = {'name': name, 'signature': signature}
+    if index_path:
+        try:
+            DeletionIndex.write(index_path, keys, metadata)
+            index = DeletionIndex.open(index_path, signature)
+            if index is not None:
+                return index
+        except (OSError,) as error:
+            sys.stderr.write(
+                'Could not write the deletion index for %s: %s\n'
+                % (name, error))
+    shared_key = (name + '.deletions', json.dumps(signature))
+    index = _WORD_INDEXES.get(shared_key)
+    if index is None:
+        index = DeletionIndex(DeletionIndex.build(keys, metadata))
+        _WORD_INDEXES[shared_key] = index
+    return index
+
+def deletion_index_is_current(name):
+    '''Checks whether an up to date deletion index file of a
+    hunspell dictionary is in the cache
+
+    Returns True as well if the dictionary is not installed.
+
+    :param name: Name of the dictionary, e.g. 'en_US'
+    :type name: String
+    :rtype: Boolean
+    '''
+    signature = dictionary_signature(name)
+    if signature is None:
+        return True
+    try:
+        return DeletionIndex.open(
+            dictionary_cache_path(name, suffix='.deletions'),
+            signature) is not None
+    except (OSError,):
+        return False
+
+def _compile_word_index_file(name, deletion_index=False):
+    '''Compile the word index file and, if requested, the deletion
+    index file of a hunspell dictionary in a worker process
+
+    Nothing is returned, Dictionary.load_dictionary() in the parent
+    process memory maps the new files.
+
+    :param name: Name of the dictionary, e.g. 'en_US'
+    :type name: String
+    :param deletion_index: Whether to compile the deletion index
+    :type deletion_index: Boolean
+    '''
+    signature = dictionary_signature(name)
+    if signature is None:
+        return
+    index = None
+    try:
+        index = WordIndex.open(dictionary_cache_path(name), signature)
+    except (OSError,):
+        pass
+    if index is None:
+        index = compile_word_index(name, signature)
+    if deletion_index and index is not None:
+        load_deletion_index(name, signature, index.keys)
+
+def load_word_pool(dictionaries):
+    '''Returns a word pool with the words of several dictionaries
+
+    A word pool is a WordIndex of the union of the words of
+    dictionaries which have many words in common, for example en_US,
+    en_GB and en_AU. For each member dictionary, it stores the
+    positions of its words in the pool. The words the dictionaries
+    have in common are stored only once then, each dictionary needs
+    4 bytes per word for the positions.
+
+    The pool is memory mapped from the cache if it is up to date,
+    otherwise it is built from the words of the dictionaries and
+    written to the cache. If the file cannot be written, the pool is
+    kept in memory.
+
+    :param dictionaries: The dictionaries, all of them must match
+                         accent insensitively or none of them
+    :type dictionaries: List of Dictionary objects
+    :rtype: WordIndex object
+    '''
+    dictionaries = sorted(dictionaries, key=lambda x: x.name)
+    names = [dictionary.name for dictionary in dictionaries]
+    signature = [dictionary.signature for dictionary in dictionaries]
+    pool_name = '+'.join(names)
+    try:
+        pool_path = dictionary_cache_path(pool_name, suffix='.pool')
+        pool = WordIndex.open(pool_path, signature)
+        if pool is not None:
+            return pool
+    except (OSError,):
+        pool_path = None
+    shared_key = (pool_name + '.pool', json.dumps(signature))
+    pool = _WORD_INDEXES.get(shared_key)
+    if pool is not None:
+        return pool
+    pairs = set()
+    for dictionary in dictionaries:
+        pairs.update(zip(dictionary.word_keys[:], dictionary.words[:]))
+    pairs = sorted(pairs)
+    positions = {pair: position for (position, pair) in enumerate(pairs)}
+    members = [
+        (dictionary.name,
+         array.array('I', [positions[pair] for pair in zip(
+             dictionary.word_keys[:], dictionary.words[:])]))
+        for dictionary in dictionaries]
+    del positions
+    keys = [x[0] for x in pairs]
+    words = [x[1] for x in pairs]
+    del pairs
+    metadata = {'name': pool_name, 'signature': signature}
+    if pool_path:
+        try:
+            WordIndex.write(pool_path, words, keys, metadata, members)
+            pool = WordIndex.open(pool_path, signature)
+            if pool is not None:
+                return pool
+        except (OSError,) as error:
+            sys.stderr.write(
+                'Could not write the word pool for %s: %s\n'
+                % (pool_name, error))
+    pool = WordIndex(WordIndex.build(words, keys, metadata, members))
+    _WORD_INDEXES[shared_key] = pool
+    return pool
+
+def share_dictionary_words(dictionaries):
+    '''Store the words which several of the dictionaries have in
+    common only once
+
+    The dictionaries of the same language, for example en_US and
+    en_GB, are switched to a common word pool, see load_word_pool().
+    A dictionary is switched again when it is used in another
+    combination of dictionaries later, the words it contains stay
+    the same.
+
+    :param dictionaries: The dictionaries used together
+    :type dictionaries: List of Dictionary objects
+    '''
+    languages = {}
+    for dictionary in dictionaries:
+        if dictionary.words:
+            languages.setdefault(
+                dictionary.name.split('_')[0], []).append(dictionary)
+    for members in languages.values():
+        if len(members) < 2:
+            continue
+        pool = load_word_pool(members)
+        for dictionary in members:
+            dictionary.use_word_pool(pool)
+
 class Dictionary:
     '''A class to hold a hunspell dictionary
     '''
-    def __init__(self, name='en_US'):
+    def __init__(self, name='en_US', deletion_index=False):
         if DEBUG_LEVEL > 1:
             sys.stderr.write(
-                "Dictionary.__init__(name=%s)\n" %name)
+                "Dictionary.__init__(name=%s, deletion_index=%s)\n"
+                %(name, deletion_index))
         self.name = name
         self.dic_path = ''
         self.encoding = 'UTF-8'
+        # Whether the words of this dictionary are matched accent
+        # insensitively:
+        self.accent_insensitive = (
+            self.name.split('_')[0] in ACCENT_LANGUAGES)
+        # self.words is sorted by self.word_keys, self.word_keys[i] is
+        # the (possibly accent insensitive) key used to match the
+        # beginning of self.words[i]. If no key differs from its word,
+        # self.word_keys is the same object as self.words. Both are
+        # read-only sequences backed by a WordIndex, or by a word pool
+        # shared with other dictionaries, see use_word_pool():
+        self._word_index = None
+        # The signature of the .dic and .aff files the words have
+        # been read from:
+        self.signature = None
         self.words = []
-        self.word_pairs = []
+        self.word_keys = []
         self.max_word_len = 0 # maximum length of words in this dictionary
+        # Optional DeletionIndex for fast corrections of typos:
+        self.deletion_index = None
+        self._use_deletion_index = deletion_index
         self.enchant_dict = None
         self.pyhunspell_object = None
+        # The key in the registry of shared dictionaries, see
+        # get_shared_dictionary():
+        self.shared_key = None
         self.load_dictionary()
 
     def load_dictionary(self):
         '''Load a hunspell dictionary and instantiate a
         enchant.Dict() or a hunspell.Hunspell() object.
 
+        If a precompiled word index of the dictionary which is still
+        up to date is found in the cache, it is memory mapped and
+        used. Otherwise the .dic file is parsed and a new word index
+        is written to the cache.
         '''
         if DEBUG_LEVEL > 0:
             sys.stderr.write("load_dictionary() ...\n")
-        (self.dic_path,
-         self.encoding,
-         self.words) = itb_util.get_hunspell_dictionary_wordlist(self.name)
+        (dic_path, aff_path) = itb_util.find_hunspell_dictionary(self.name)
+        if dic_path:
+            signature = [_file_signature(dic_path),
+                         _file_signature(aff_path),
+                         MAX_AFFIX_FORMS_PER_STEM]
+            index = None
+            try:
+                index = WordIndex.open(
+                    dictionary_cache_path(self.name), signature)
+            except (OSError,):
+                # The cache directory cannot be created, _compile()
+                # reports the problem and falls back to memory:
+                pass
+            if index is None:
+                # Maybe the index file could not be written before
+                # and the dictionary is already in memory:
+                index = _WORD_INDEXES.get(
+                    (self.name, json.dumps(signature)))
+            if index is None:
+                index = self._compile(signature)
+            if index is not None and len(index):
+                self._word_index = index
+                self.signature = signature
+                self.dic_path = dic_path
+                self.encoding = index.metadata['encoding']
+                self.words = index.words
+                self.word_keys = index.keys
+                self.max_word_len = index.max_word_len
+                if DEBUG_LEVEL > 1:
+                    sys.stderr.write(
+                        'load_dictionary() using word index for %s, '
+                        % self.name
+                        + 'max_word_len = %s\n' % self.max_word_len)
+                if self._use_deletion_index:
+                    self.deletion_index = load_deletion_index(
+                        self.name, signature, self.word_keys)
         if self.words:
-            # List of languages where accent insensitive matching makes sense:
-            accent_languages = (
-                'af', 'ast', 'az', 'be', 'bg', 'br', 'bs', 'ca', 'cs', 'csb',
-                'cv', 'cy', 'da', 'de', 'dsb', 'el', 'en', 'es', 'eu', 'fo',
-                'fr', 'fur', 'fy', 'ga', 'gd', 'gl', 'grc', 'gv', 'haw', 'hr',
-                'hsb', 'ht', 'hu', 'ia', 'is', 'it', 'kk', 'ku', 'ky', 'lb',
-                'ln', 'lv', 'mg', 'mi', 'mk', 'mn', 'mos', 'mt', 'nb', 'nds',
-                'nl', 'nn', 'nr', 'nso', 'ny', 'oc', 'pl', 'plt', 'pt', 'qu',
-                'quh', 'ru', 'sc', 'se', 'sh', 'shs', 'sk', 'sl', 'smj', 'sq',
-                'sr', 'ss', 'st', 'sv', 'tet', 'tk', 'tn', 'ts', 'uk', 'uz',
-                've', 'vi', 'wa', 'xh',
-            )
-            if self.name.split('_')[0] in accent_languages:
-                self.word_pairs = [
-                    (x, itb_util.remove_accents(x))
-                    for x in self.words
-                ]
-            for word in self.words:
-                if len(word) > self.max_word_len:
-                    self.max_word_len = len(word)
-            if DEBUG_LEVEL > 1:
-                sys.stderr.write(
-                    'load_dictionary() max_word_len = %s\n'
-                    % self.max_word_len)
             if IMPORT_ENCHANT_SUCCESSFUL:
                 self.enchant_dict = enchant.Dict(self.name)
             elif IMPORT_HUNSPELL_SUCCESSFUL and self.dic_path:
@@ -110,11 +1193,185 @@ class Dictionary:
                 self.pyhunspell_object = hunspell.HunSpell(
                     self.dic_path, aff_path)
 
+    def _compile(self, signature):
+        '''Compile the word index of the dictionary, see
+        compile_word_index()
+
+        :param signature: Signature of the .dic and .aff files, the
+                          word index is tagged with it.
+        :type signature: List
+        :rtype: WordIndex object or None
+        '''
+        return compile_word_index(self.name, signature)
+
+    def use_word_pool(self, pool):
+        '''Use the words of this dictionary stored in a word pool
+        instead of its own word index, see load_word_pool()
+
+        The words and their order stay the same, so the ranges of
+        words found before and the deletion index remain valid.
+
+        Returns True if the pool contains the words of this dictionary.
+
+        :param pool: The word pool
+        :type pool: WordIndex object
+        :rtype: Boolean
+        '''
+        positions = pool.members.get(self.name)
+        if (positions is None
+                or pool.metadata['signature'][
+                    list(pool.members).index(self.name)]
+                != self.signature
+                or len(positions) != len(self.words)):
+            return False
+        words = _PooledSequence(pool.words, positions)
+        word_keys = words
+        if pool.keys is not pool.words:
+            word_keys = _PooledSequence(pool.keys, positions)
+        self._word_index = pool
+        self.words = words
+        self.word_keys = word_keys
+        return True
+
+    def completion_range(self, prefix, low=0, high=None):
+        '''Returns the range of the words in this dictionary which
+        start with prefix
+
+        The lookup is a binary search in the sorted keys, i.e.
+        it is O(log n) where n is the number of words searched.
+
+        If the range of the words starting with a shorter prefix of
+        prefix is already known, pass it as low and high, then only
+        that range is searched.
+
+        :param prefix: The beginning of the words to find. For
+                       accent insensitive dictionaries, the accents
+                       should already be removed from prefix.
+        :type prefix: String
+        :param low: The first index to search
+        :type low: Integer
+        :param high: The index after the last index to search, None
+                     for the end of the dictionary
+        :type high: Integer or None
+        :return: The range [first, last[ of self.words
+        :rtype: Tuple of integers
+        '''
+        return _completion_range(self.word_keys, prefix, low, high)
+
+    def completions(self, prefix, low=0, high=None):
+        '''Returns the words in this dictionary which start with prefix
+
+        See completion_range() for the parameters.
+
+        :rtype: List of strings
+        '''
+        (first, last) = self.completion_range(prefix, low, high)
+        return self.words[first:last]
+
+    def corrections(self, term):
+        '''Returns the words in this dictionary within a small edit
+        distance of term, using the deletion index
+
+        Returns an empty list if there is no deletion index. Inputs
+        of up to 2 characters are not corrected, inputs of 3 or 4
+        characters are corrected only up to edit distance 1, there
+        would be too many meaningless corrections otherwise.
+
+        :param term: The possibly misspelled input. For accent
+                     insensitive dictionaries, the accents should
+                     already be removed from term.
+        :type term: String
+        :rtype: List of strings, the closest words first
+        '''
+        if not self.deletion_index:
+            return []
+        max_distance = (len(term) - 1) // 2
+        if max_distance < 1:
+            return []
+        return [self.words[position]
+                for (dummy_distance, position)
+                in self.deletion_index.corrections(
+                    self.word_keys, term, max_distance)]
+
+# Dictionary objects in use in this process, indexed by
+# (name, deletion_index, signature). The values are lists
+# [dictionary, reference count]. Several Hunspell objects using the
+# same dictionary, for example those of several engines, share one
+# Dictionary and its enchant or pyhunspell object:
+_SHARED_DICTIONARIES = {}
+_SHARED_DICTIONARIES_LOCK = threading.Lock()
+
+# Serializes the calls of enchant and pyhunspell, the dictionaries
+# may be shared between several Hunspell objects:
+_SPELLCHECK_LOCK = threading.Lock()
+
+def get_shared_dictionary(name, deletion_index=False):
+    '''Returns a Dictionary shared with the other users of the same
+    dictionary in this process
+
+    The dictionary is only loaded if it is not in use already or if
+    its files have changed since it was loaded. Every call must be
+    balanced by a call of release_shared_dictionary() when the
+    dictionary is not used anymore.
+
+    :param name: Name of the dictionary, e.g. 'en_US'
+    :type name: String
+    :param deletion_index: Whether to use a deletion index to
+                           correct typos
+    :type deletion_index: Boolean
+    :rtype: Dictionary
+    '''
+    key = (name, deletion_index, json.dumps(dictionary_signature(name)))
+    with _SHARED_DICTIONARIES_LOCK:
+        entry = _SHARED_DICTIONARIES.get(key)
+        if entry is not None:
+            entry[1] += 1
+            return entry[0]
+    # Load outside of the lock, other dictionaries can be loaded in
+    # parallel:
+    dictionary = Dictionary(name=name, deletion_index=deletion_index)
+    with _SHARED_DICTIONARIES_LOCK:
+        entry = _SHARED_DICTIONARIES.get(key)
+        if entry is not None:
+            # Loaded by another thread in the meantime, use that one:
+            entry[1] += 1
+            return entry[0]
+        dictionary.shared_key = key
+        _SHARED_DICTIONARIES[key] = [dictionary, 1]
+    return dictionary
+
+def release_shared_dictionary(dictionary):
+    '''Releases a Dictionary returned by get_shared_dictionary()
+
+    When its last user has released it, it is dropped from the
+    registry and freed as soon as no thread uses it anymore.
+
+    :param dictionary: The dictionary to release
+    :type dictionary: Dictionary
+    '''
+    with _SHARED_DICTIONARIES_LOCK:
+        entry = _SHARED_DICTIONARIES.get(dictionary.shared_key)
+        if entry is None or entry[0] is not dictionary:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del _SHARED_DICTIONARIES[dictionary.shared_key]
+
+def get_shared_dictionary_statistics():
+    '''Returns the names of the dictionaries in the registry of
+    shared dictionaries and their reference counts
+
+    :rtype: Dictionary
+    '''
+    with _SHARED_DICTIONARIES_LOCK:
+        return {(key[0], key[1]): entry[1]
+                for (key, entry) in _SHARED_DICTIONARIES.items()}
+
 class Hunspell:
     '''A class to suggest completions or corrections
     using a list of Hunspell dictionaries
     '''
-    def __init__(self, dictionary_names=()):
+    def __init__(self, dictionary_names=(), deletion_index=False):
         global DEBUG_LEVEL
         try:
             DEBUG_LEVEL = int(os.getenv('IBUS_TYPING_BOOSTER_DEBUG_LEVEL'))
@@ -128,13 +1385,50 @@ class Hunspell:
             else:
                 sys.stderr.write(
                     'Hunspell.__init__(dictionary_names=())\n')
-        self._suggest_cache = {}
+        self._suggest_cache = itb_util.LRUCache(maxsize=SUGGEST_CACHE_SIZE)
+        # The spell checking corrections may be computed in a worker
+        # thread, _SPELLCHECK_LOCK serializes the calls of enchant
+        # and pyhunspell, self._spellcheck_cache_lock protects the
+        # cache of their results:
+        self._spellcheck_cache = itb_util.LRUCache(
+            maxsize=SUGGEST_CACHE_SIZE)
+        self._spellcheck_cache_lock = threading.Lock()
         self._dictionary_names = dictionary_names
+        # Whether the dictionaries use a DeletionIndex to correct typos:
+        self._deletion_index = deletion_index
         self._dictionaries = []
+        # The suggestion cache belongs to this list of dictionaries,
+        # when the list is replaced, the cache is cleared:
+        self._suggest_cache_dictionaries = self._dictionaries
+        # Incremented each time loading a new set of dictionaries is
+        # started, a load which has been superseded by a newer one
+        # is not swapped in when it finishes:
+        self._load_generation = 0
+        self._loaded_generation = 0
+        # The dictionaries may be shared with other Hunspell objects
+        # (i.e. other engines) looking up other words, so the prefix
+        # and the range of words matched by the last lookup in each
+        # dictionary are kept here, see self._completions():
+        self._last_completions = {}
         self.init_dictionaries()
 
-    def init_dictionaries(self):
+    def init_dictionaries(self, background=False, callback=None):
         '''Initialize the hunspell dictionaries
+
+        The dictionaries are loaded in parallel. The previously loaded
+        dictionaries keep being used for suggestions until all the new
+        ones are loaded, then the new set replaces the old one at once.
+
+        :param background: If True, return immediately and load the
+                           dictionaries in a background thread.
+                           If False, return only when the new
+                           dictionaries are in use.
+        :type background: Boolean
+        :param callback: Called without arguments after the new
+                         dictionaries have been swapped in. When
+                         loading in the background, it is called
+                         from the loading thread.
+        :type callback: Function or None
         '''
         if DEBUG_LEVEL > 1:
             if self._dictionary_names:
@@ -144,10 +1438,146 @@ class Hunspell:
             else:
                 sys.stderr.write(
                     'Hunspell.init_dictionaries() dictionary_names=()\n')
-        self._suggest_cache = {}
-        self._dictionaries = []
-        for dictionary_name in self._dictionary_names:
-            self._dictionaries.append(Dictionary(name=dictionary_name))
+        self._load_generation += 1
+        args = (self._load_generation,
+                list(self._dictionary_names),
+                self._deletion_index,
+                callback)
+        if not background:
+            self._load_dictionaries(*args)
+            return
+        threading.Thread(
+            target=self._load_dictionaries, args=args, daemon=True).start()
+
+    def _load_dictionaries(
+            self, generation, dictionary_names, deletion_index, callback):
+        '''Load a list of dictionaries in parallel and swap them in
+
+        :param generation: The value of self._load_generation when
+                           this load was started
+        :type generation: Integer
+        :param dictionary_names: The names of the dictionaries to load
+        :type dictionary_names: List of strings
+        :param deletion_index: Whether to load the deletion indexes
+        :type deletion_index: Boolean
+        :param callback: Called without arguments after the new
+                         dictionaries have been swapped in
+        :type callback: Function or None
+        '''
+        time_start = time.time()
+        # Parsing and sorting a .dic file is pure Python and holds
+        # the GIL, when several index files are missing or outdated,
+        # compile them in separate processes first:
+        cpu_count = os.cpu_count() or 1
+        names_to_compile = [
+            name for name in dictionary_names
+            if not word_index_is_current(name)
+            or (deletion_index and not deletion_index_is_current(name))]
+        if len(names_to_compile) > 1 and cpu_count > 1:
+            try:
+                with concurrent.futures.ProcessPoolExecutor(
+                        max_workers=min(len(names_to_compile), cpu_count),
+                        mp_context=multiprocessing.get_context(
+                            'spawn')) as executor:
+                    list(executor.map(
+                        _compile_word_index_file,
+                        names_to_compile,
+                        [deletion_index] * len(names_to_compile)))
+            except (OSError,
+                    concurrent.futures.process.BrokenProcessPool,
+                    pickle.PicklingError) as error:
+                # Not fatal, Dictionary() compiles what is missing:
+                if DEBUG_LEVEL > 0:
+                    sys.stderr.write(
+                        'Hunspell._load_dictionaries(): compiling '
+                        + 'without a process pool: %s: %s\n'
+                        %(error.__class__.__name__, error))
+        try:
+            # Memory mapping the word indexes and creating the
+            # enchant or pyhunspell objects can run in threads:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max(1, len(dictionary_names))) as executor:
+                dictionaries = list(executor.map(
+                    lambda name: get_shared_dictionary(
+                        name, deletion_index=deletion_index),
+                    dictionary_names))
+        except Exception: # pylint: disable=broad-except
+            # Whatever a dictionary failed with, keep the dictionaries
+            # currently in use:
+            traceback.print_exc()
+            return
+        # Dictionaries like en_US and en_GB have most of their words
+        # in common, store them only once:
+        share_dictionary_words(dictionaries)
+        with self._spellcheck_cache_lock:
+            if generation != self._load_generation:
+                # A newer set of dictionaries is already being loaded:
+                for dictionary in dictionaries:
+                    release_shared_dictionary(dictionary)
+                return
+            old_dictionaries = self._dictionaries
+            self._dictionaries = dictionaries
+            self._loaded_generation = generation
+            self._spellcheck_cache.clear()
+            self._last_completions = {}
+        for dictionary in old_dictionaries:
+            release_shared_dictionary(dictionary)
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                'Hunspell._load_dictionaries(%s) took %.3f s\n'
+                %(dictionary_names, time.time() - time_start))
+        if callback:
+            callback()
+
+    def release_dictionaries(self):
+        '''Stop using the dictionaries
+
+        The dictionaries are released to the registry of shared
+        dictionaries, a dictionary is freed when no other Hunspell
+        object uses it. Loads still in progress are abandoned.
+        '''
+        with self._spellcheck_cache_lock:
+            self._load_generation += 1
+            self._loaded_generation = self._load_generation
+            dictionaries = self._dictionaries
+            self._dictionaries = []
+            self._dictionary_names = []
+            self._spellcheck_cache.clear()
+            self._last_completions = {}
+        for dictionary in dictionaries:
+            release_shared_dictionary(dictionary)
+
+    def get_suggest_cache_statistics(self):
+        '''Returns the size and the hit, miss and eviction counters of
+        the cache of suggestions.
+
+        :rtype: Dictionary
+        '''
+        return self._suggest_cache.statistics()
+
+    def set_deletion_index(self, mode, background=False, callback=None):
+        '''Sets whether the dictionaries use a deletion index to
+        correct typos
+
+        The dictionaries are reloaded if the mode changes, see
+        init_dictionaries() for the parameters background and callback.
+
+        :param mode: Whether to use a deletion index
+        :type mode: Boolean
+        '''
+        if mode == self._deletion_index:
+            return
+        self._deletion_index = mode
+        if self._dictionary_names:
+            self.init_dictionaries(background=background, callback=callback)
+
+    def get_deletion_index(self):
+        '''Returns whether the dictionaries use a deletion index to
+        correct typos
+
+        :rtype: Boolean
+        '''
+        return self._deletion_index
 
     def get_dictionary_names(self):
         '''Returns a copy of the list of dictionary names.
@@ -156,17 +1586,29 @@ class Hunspell:
         the private member variable directly.'''
         return self._dictionary_names[:]
 
-    def set_dictionary_names(self, dictionary_names):
+    def set_dictionary_names(
+            self, dictionary_names, background=False, callback=None):
         '''Sets the list of dictionary names.
 
         If the new list of dictionary names differs from the existing
         one, re-initilize the dictionaries.
+
+        :param dictionary_names: The names of the dictionaries to use
+        :type dictionary_names: List of strings
+        :param background: Whether to load new dictionaries in a
+                           background thread, see init_dictionaries()
+        :type background: Boolean
+        :param callback: Called after new dictionaries have been
+                         swapped in, see init_dictionaries()
+        :type callback: Function or None
         '''
         if dictionary_names != self._dictionary_names:
-            if set(dictionary_names) != set(self._dictionary_names):
-                # Some dictionaries are really different, reinitialize:
+            if (set(dictionary_names) != set(self._dictionary_names)
+                    or self._loaded_generation != self._load_generation):
+                # Some dictionaries are really different (or the
+                # dictionaries are still being loaded), reinitialize:
                 self._dictionary_names = dictionary_names
-                self.init_dictionaries()
+                self.init_dictionaries(background=background, callback=callback)
             else:
                 # Only the order of dictionaries has changed.
                 # Reinitializing wastes time, just reorder the
@@ -177,24 +1619,32 @@ class Hunspell:
                     for dictionary in self._dictionaries:
                         if dictionary.name == name:
                             dictionaries_new.append(dictionary)
-                self._dictionaries = dictionaries_new
+                with self._spellcheck_cache_lock:
+                    self._dictionaries = dictionaries_new
         if DEBUG_LEVEL > 1:
             sys.stderr.write('set_dictionary_names(%s):\n' % dictionary_names)
             for dictionary in self._dictionaries:
                 sys.stderr.write('%s\n' % dictionary.name)
 
-    def suggest(self, input_phrase):
+    def suggest(self, input_phrase, spellcheck=True):
         # pylint: disable=line-too-long
         '''Return completions or corrections for the input phrase
 
         :param input_phrase: A string to find completions or corrections for
         :type input_phrase: String
+        :param spellcheck: If True, spell checking corrections are
+                           computed if they are not cached yet.
+                           If False, only spell checking corrections
+                           already computed by self.spellcheck() are
+                           used, see self.needs_spellcheck().
+        :type spellcheck: Boolean
         :rtype: A list of tuples of the form (<word>, <score>)
                 <score> can have these values:
                     0: This is a completion, i.e. input_phrase matches
                        the beginning of <word> (accent insensitive match)
                    -1: This is a spell checking correction from hunspell
-                       (i.e. either from enchant or pyhunspell)
+                       (i.e. either from enchant or pyhunspell) or
+                       from the deletion index of a dictionary
 
         Examples:
 
@@ -238,8 +1688,15 @@ class Hunspell:
         ('tenéis', 0)
         '''
         # pylint: enable=line-too-long
-        if input_phrase in self._suggest_cache:
-            return self._suggest_cache[input_phrase]
+        # Keep a reference to the current dictionaries, the list may be
+        # replaced by a background load while this is running:
+        dictionaries = self._dictionaries
+        if dictionaries is not self._suggest_cache_dictionaries:
+            self._suggest_cache.clear()
+            self._suggest_cache_dictionaries = dictionaries
+        cached_suggestions = self._suggest_cache.get(input_phrase)
+        if cached_suggestions is not None:
+            return cached_suggestions
         if DEBUG_LEVEL > 1:
             sys.stderr.write(
                 "Hunspell.suggest() input_phrase=%(ip)s\n"
@@ -264,89 +1721,24 @@ class Hunspell:
         input_phrase_no_accents = unicodedata.normalize(
             itb_util.NORMALIZATION_FORM_INTERNAL,
             itb_util.remove_accents(input_phrase))
-        # But enchant and pyhunspell want NFC as input, make a copy in NFC:
-        input_phrase_nfc = unicodedata.normalize('NFC', input_phrase)
 
         suggested_words = {}
-        for dictionary in self._dictionaries:
+        for dictionary in dictionaries:
             if dictionary.words:
                 # If the input phrase is longer than than the maximum
                 # word length in a dictionary, don’t try
                 # complete it, it just wastes time then.
                 if len(input_phrase) <= dictionary.max_word_len:
-                    if dictionary.word_pairs:
+                    if dictionary.accent_insensitive:
                         suggested_words.update([
-                            (x[0], 0)
-                            for x in dictionary.word_pairs
-                            if x[1].startswith(input_phrase_no_accents)])
+                            (x, 0)
+                            for x in self._completions(
+                                dictionary, input_phrase_no_accents)])
                     else:
                         suggested_words.update([
                             (x, 0)
-                            for x in dictionary.words
-                            if x.startswith(input_phrase)])
-                if dictionary.enchant_dict:
-                    if len(input_phrase) >= 4:
-                        # Always pass NFC to enchant and convert the
-                        # result back to the internal normalization
-                        # form (NFD) (enchant does the right thing for
-                        # Korean if the input is NFC).  enchant takes
-                        # unicode strings and returns unicode strings,
-                        # no encoding and decoding to and from the
-                        # hunspell dictionary encoding is necessary
-                        # (neither for Python2 nor Python3).
-                        # (pyhunspell needs to get its input passed
-                        # in dictionary encoding and also returns it
-                        # in dictionary encoding).
-                        if dictionary.enchant_dict.check(input_phrase_nfc):
-                            # This is a valid word in this dictionary.
-                            # It might have been missed by the matching
-                            # above because the dictionary might not
-                            # contain all possible word forms (The
-                            # prefix and suffix information has been
-                            # ignored). But hunspell knows about this,
-                            # if hunspell thinks it is a correct word,
-                            # it must be counted as a match of course:
-                            suggested_words[input_phrase] = 0
-                        extra_suggestions = [
-                            unicodedata.normalize(
-                                itb_util.NORMALIZATION_FORM_INTERNAL, x)
-                            for x in
-                            dictionary.enchant_dict.suggest(input_phrase_nfc)
-                        ]
-                        suggested_words.update([
-                            (suggestion, -1)
-                            for suggestion in extra_suggestions
-                            if suggestion not in suggested_words])
-                elif dictionary.pyhunspell_object:
-                    if len(input_phrase) >= 4:
-                        # Always pass NFC to pyhunspell and convert
-                        # the result back to the internal
-                        # normalization form (NFD) (hunspell does the
-                        # right thing for Korean if the input is NFC).
-                        if dictionary.pyhunspell_object.spell(
-                                input_phrase_nfc.encode(
-                                    dictionary.encoding, 'replace')):
-                            # This is a valid word in this dictionary.
-                            # It might have been missed by the matching
-                            # above because the dictionary might not
-                            # contain all possible word forms (The
-                            # prefix and suffix information has been
-                            # ignored). But hunspell knows about this,
-                            # if hunspell thinks it is a correct word,
-                            # it must be counted as a match of course:
-                            suggested_words[input_phrase] = 0
-                        extra_suggestions = [
-                            unicodedata.normalize(
-                                itb_util.NORMALIZATION_FORM_INTERNAL, x)
-                            for x in
-                            dictionary.pyhunspell_object.suggest(
-                                input_phrase_nfc.encode(
-                                    dictionary.encoding, 'replace'))
-                        ]
-                        suggested_words.update([
-                            (suggestion, -1)
-                            for suggestion in extra_suggestions
-                            if suggestion not in suggested_words])
+                            for x in self._completions(
+                                dictionary, input_phrase)])
             else:
                 if (dictionary.name[:2]
                         not in ('ja', 'ja_JP',
@@ -362,6 +1754,32 @@ class Hunspell:
                          %{'name': dictionary.name}
                          + 'Please install hunspell dictionary!',
                          0)])
+        for dictionary in dictionaries:
+            if dictionary.deletion_index:
+                for word in dictionary.corrections(
+                        input_phrase_no_accents
+                        if dictionary.accent_insensitive
+                        else input_phrase):
+                    if word not in suggested_words:
+                        suggested_words[word] = -1
+        complete = True
+        if self._spellcheck_possible(input_phrase, dictionaries):
+            with self._spellcheck_cache_lock:
+                spellcheck_suggestions = self._spellcheck_cache.get(
+                    input_phrase)
+            if spellcheck_suggestions is None:
+                if spellcheck:
+                    spellcheck_suggestions = self.spellcheck(input_phrase)
+                else:
+                    # The spell checking suggestions are still being
+                    # computed, don’t cache this incomplete result:
+                    spellcheck_suggestions = []
+                    complete = False
+            for (suggestion, score) in spellcheck_suggestions:
+                if score == 0:
+                    suggested_words[suggestion] = 0
+                elif suggestion not in suggested_words:
+                    suggested_words[suggestion] = -1
         for word in suggested_words:
             if (suggested_words[word] == -1
                     and
@@ -377,9 +1795,158 @@ class Hunspell:
                 len(x[0]), # length of word ascending
                 x[0],      # alphabetical
             ))[0:MAX_WORDS]
-        self._suggest_cache[input_phrase] = sorted_suggestions
+        if complete:
+            self._suggest_cache[input_phrase] = sorted_suggestions
         return sorted_suggestions
 
+    def _completions(self, dictionary, prefix):
+        '''Returns the words in a dictionary which start with prefix
+
+        While the user types a word, each prefix usually extends the
+        prefix of the previous lookup. Then only the range of words
+        which matched the previous prefix is searched. After a
+        backspace or when a new word is started, the whole dictionary
+        is searched again.
+
+        :param dictionary: One of the dictionaries of this object
+        :type dictionary: Dictionary
+        :param prefix: The beginning of the words to find
+        :type prefix: String
+        :rtype: List of strings
+        '''
+        (low, high) = (0, None)
+        last_completion = self._last_completions.get(dictionary.name)
+        if (last_completion is not None
+                and last_completion[0] is dictionary
+                and prefix.startswith(last_completion[1])):
+            (low, high) = last_completion[2]
+        (first, last) = dictionary.completion_range(prefix, low, high)
+        self._last_completions[dictionary.name] = (
+            dictionary, prefix, (first, last))
+        return dictionary.words[first:last]
+
+    def _spellcheck_possible(self, input_phrase, dictionaries=None):
+        '''Checks whether spell checking suggestions can be computed
+        for an input phrase
+
+        :param input_phrase: The input phrase in the internal
+                             normalization form (NFD)
+        :type input_phrase: String
+        :param dictionaries: The dictionaries to check with,
+                             None means the current dictionaries
+        :type dictionaries: List of Dictionary objects or None
+        :rtype: Boolean
+        '''
+        if len(input_phrase) < 4 or '/' in input_phrase:
+            return False
+        if dictionaries is None:
+            dictionaries = self._dictionaries
+        for dictionary in dictionaries:
+            if dictionary.enchant_dict or dictionary.pyhunspell_object:
+                return True
+        return False
+
+    def needs_spellcheck(self, input_phrase):
+        '''Checks whether spell checking suggestions for an input
+        phrase still need to be computed by self.spellcheck()
+
+        If this returns True, self.suggest(input_phrase, spellcheck=False)
+        returns only the completions for now.
+
+        :param input_phrase: The input phrase
+        :type input_phrase: String
+        :rtype: Boolean
+        '''
+        input_phrase = unicodedata.normalize(
+            itb_util.NORMALIZATION_FORM_INTERNAL, input_phrase)
+        if not self._spellcheck_possible(input_phrase):
+            return False
+        with self._spellcheck_cache_lock:
+            return input_phrase not in self._spellcheck_cache
+
+    def spellcheck(self, input_phrase):
+        '''Compute the spell checking suggestions for an input phrase
+
+        Uses enchant or pyhunspell. This can take tens of milliseconds
+        per dictionary, therefore the engine calls it in a worker
+        thread. The result is cached and used by later calls of
+        self.suggest().
+
+        :param input_phrase: The input phrase
+        :type input_phrase: String
+        :rtype: A list of tuples of the form (<word>, <score>)
+                <score> can have these values:
+                    0: <word> is the input phrase and hunspell
+                       considers it a correct word
+                   -1: This is a spell checking correction from hunspell
+        '''
+        input_phrase = unicodedata.normalize(
+            itb_util.NORMALIZATION_FORM_INTERNAL, input_phrase)
+        # But enchant and pyhunspell want NFC as input, make a copy in NFC:
+        input_phrase_nfc = unicodedata.normalize('NFC', input_phrase)
+        # Keep a reference to the current dictionaries, the list may be
+        # replaced while this is running in a worker thread:
+        dictionaries = self._dictionaries
+        spellcheck_suggestions = []
+        with _SPELLCHECK_LOCK:
+            for dictionary in dictionaries:
+                if not dictionary.words:
+                    continue
+                if dictionary.enchant_dict:
+                    # Always pass NFC to enchant and convert the
+                    # result back to the internal normalization
+                    # form (NFD) (enchant does the right thing for
+                    # Korean if the input is NFC).  enchant takes
+                    # unicode strings and returns unicode strings,
+                    # no encoding and decoding to and from the
+                    # hunspell dictionary encoding is necessary
+                    # (neither for Python2 nor Python3).
+                    # (pyhunspell needs to get its input passed
+                    # in dictionary encoding and also returns it
+                    # in dictionary encoding).
+                    if dictionary.enchant_dict.check(input_phrase_nfc):
+                        # This is a valid word in this dictionary.
+                        # It might have been missed by the matching
+                        # of the completions because the dictionary
+                        # might not contain all possible word forms
+                        # (only up to MAX_AFFIX_FORMS_PER_STEM forms
+                        # generated by the affix rules are included).
+                        # But hunspell knows about this,
+                        # if hunspell thinks it is a correct word,
+                        # it must be counted as a match of course:
+                        spellcheck_suggestions.append((input_phrase, 0))
+                    spellcheck_suggestions += [
+                        (unicodedata.normalize(
+                            itb_util.NORMALIZATION_FORM_INTERNAL, x), -1)
+                        for x in
+                        dictionary.enchant_dict.suggest(input_phrase_nfc)
+                    ]
+                elif dictionary.pyhunspell_object:
+                    # Always pass NFC to pyhunspell and convert
+                    # the result back to the internal
+                    # normalization form (NFD) (hunspell does the
+                    # right thing for Korean if the input is NFC).
+                    if dictionary.pyhunspell_object.spell(
+                            input_phrase_nfc.encode(
+                                dictionary.encoding, 'replace')):
+                        # This is a valid word in this dictionary,
+                        # see the comment about enchant above:
+                        spellcheck_suggestions.append((input_phrase, 0))
+                    spellcheck_suggestions += [
+                        (unicodedata.normalize(
+                            itb_util.NORMALIZATION_FORM_INTERNAL, x), -1)
+                        for x in
+                        dictionary.pyhunspell_object.suggest(
+                            input_phrase_nfc.encode(
+                                dictionary.encoding, 'replace'))
+                    ]
+        with self._spellcheck_cache_lock:
+            # Don’t cache results for dictionaries which have been
+            # replaced in the meantime:
+            if dictionaries is self._dictionaries:
+                self._spellcheck_cache[input_phrase] = spellcheck_suggestions
+        return spellcheck_suggestions
+
 BENCHMARK = True
 
 def main():
@@ -391,6 +1958,26 @@ def main():
     runs some tests and prints profiling data.
     '''
     if BENCHMARK:
+        import tempfile
+        from unittest import mock
+        # Measure a cold start with an empty cache directory instead
+        # of removing the files from the cache of the user, which a
+        # running engine may be using:
+        with tempfile.TemporaryDirectory() as cache_directory:
+            with mock.patch.object(
+                    sys.modules[__name__], 'dictionary_cache_path',
+                    lambda name, suffix='.index':
+                    os.path.join(cache_directory, name + suffix)):
+                for name in ('en_US', 'de_DE', 'fr_FR', 'cs_CZ'):
+                    time_start = time.time()
+                    Dictionary(name=name)
+                    time_cold = time.time() - time_start
+                    time_start = time.time()
+                    Dictionary(name=name)
+                    time_warm = time.time() - time_start
+                    print('Loading %s: cold %.3f s, warm %.3f s'
+                          % (name, time_cold, time_warm))
+
         import cProfile
         import pstats
         profile = cProfile.Profile()
@@ -32,6 +32,8 @@ import unicodedata
 import re
 import time
 import locale
+import threading
+import queue
 from gettext import dgettext
 from gi import require_version
 require_version('IBus', '1.0')
@@ -43,6 +45,7 @@ from gi.repository import GLib
 from m17n_translit import Transliterator
 import itb_util
 import itb_emoji
+import hunspell_suggest
 
 IMPORT_GOOGLE_SPEECH_TO_TEXT_SUCCESSFUL = False
 try:
@@ -81,6 +84,14 @@ OFF_THE_RECORD_MODE_SYMBOL = '🕵'
 INPUT_MODE_TRUE_SYMBOL = '🚀'
 INPUT_MODE_FALSE_SYMBOL = '🐌'
 
+# Learned phrases are queued in the database object and written to
+# disk when no key has been typed for this number of seconds:
+WRITE_BEHIND_IDLE_SECONDS = 5
+
+# While no key is typed, a step of the maintenance of the user
+# database is done every this many seconds:
+USER_DB_MAINTENANCE_INTERVAL_SECONDS = 1
+
 class TypingBoosterEngine(IBus.Engine):
     '''The IBus Engine for ibus-typing-booster'''
 
@@ -106,6 +117,26 @@ class TypingBoosterEngine(IBus.Engine):
         self._current_auxiliary_text = ''
         self._bus = bus
         self.db = db
+        # The database may be shared with other engines, the
+        # dictionaries are chosen per engine. Dictionaries used by
+        # several engines are loaded only once, see
+        # hunspell_suggest.get_shared_dictionary():
+        self.hunspell_obj = hunspell_suggest.Hunspell(())
+        # Spell checking suggestions from hunspell are slow, they are
+        # computed in a worker thread and merged into the lookup table
+        # when they arrive. self._spellcheck_pending holds the input
+        # phrases the worker thread is busy with:
+        self._spellcheck_queue = queue.Queue()
+        self._spellcheck_thread = None
+        self._spellcheck_pending = ()
+        # Source id of the timeout writing the queued updates of the
+        # user database and the time of the last key event, the queue
+        # is written when the user has stopped typing for a while:
+        self._flush_timeout_id = 0
+        self._last_key_event_time = 0.0
+        # Source id of the timeout doing the maintenance of the user
+        # database in small steps while the user is idle:
+        self._maintenance_timeout_id = 0
         self._setup_pid = 0
         self._gsettings = Gio.Settings(
             schema='org.freedesktop.ibus.engine.typing-booster')
@@ -160,6 +191,34 @@ class TypingBoosterEngine(IBus.Engine):
             self._debug_level = 255 # maximum
         DEBUG_LEVEL = self._debug_level
 
+        self._user_db_half_life = itb_util.variant_to_value(
+            self._gsettings.get_value('userdbhalflife'))
+        if self._user_db_half_life is None:
+            self._user_db_half_life = 0 # default, never forget
+        if self._user_db_half_life < 0:
+            self._user_db_half_life = 0 # minimum, never forget
+
+        self._user_db_max_rows = itb_util.variant_to_value(
+            self._gsettings.get_value('userdbmaxrows'))
+        if self._user_db_max_rows is None:
+            self._user_db_max_rows = 0 # default, no limit
+        if self._user_db_max_rows < 0:
+            self._user_db_max_rows = 0 # minimum, no limit
+
+        self._user_db_backup_interval = itb_util.variant_to_value(
+            self._gsettings.get_value('userdbbackupinterval'))
+        if self._user_db_backup_interval is None:
+            self._user_db_backup_interval = 0 # default, no backups
+        if self._user_db_backup_interval < 0:
+            self._user_db_backup_interval = 0 # minimum, no backups
+
+        self._system_ngram_db = itb_util.variant_to_value(
+            self._gsettings.get_value('systemngramdb'))
+        if not self._system_ngram_db:
+            self._system_ngram_db = '' # default, no system n-grams
+        if self._system_ngram_db:
+            self.db.attach_system_db(self._system_ngram_db)
+
         self._page_size = itb_util.variant_to_value(
             self._gsettings.get_value('pagesize'))
         if self._page_size is None:
@@ -225,6 +284,11 @@ class TypingBoosterEngine(IBus.Engine):
         if self._arrow_keys_reopen_preedit is None:
             self._arrow_keys_reopen_preedit = False # default
 
+        self._fast_typo_correction = itb_util.variant_to_value(
+            self._gsettings.get_value('fasttypocorrection'))
+        if self._fast_typo_correction is None:
+            self._fast_typo_correction = False # default
+
         self._auto_commit_characters = itb_util.variant_to_value(
             self._gsettings.get_value('autocommitcharacters'))
         if not self._auto_commit_characters:
@@ -362,7 +426,11 @@ class TypingBoosterEngine(IBus.Engine):
                 %self._dictionary_names[:itb_util.MAXIMUM_NUMBER_OF_DICTIONARIES])
             self._dictionary_names = (
                 self._dictionary_names[:itb_util.MAXIMUM_NUMBER_OF_DICTIONARIES])
-        self.db.hunspell_obj.set_dictionary_names(self._dictionary_names[:])
+        self.hunspell_obj.set_deletion_index(self._fast_typo_correction)
+        self.hunspell_obj.set_dictionary_names(
+            self._dictionary_names[:],
+            background=not self._unit_test,
+            callback=self._dictionaries_loaded_callback)
 
         if  self._emoji_predictions:
             if DEBUG_LEVEL > 1:
@@ -788,6 +856,7 @@ class TypingBoosterEngine(IBus.Engine):
         self._candidates = []
         self._candidates_case_mode = 'orig'
         phrase_frequencies = {}
+        spellcheck_phrases = []
         self.is_lookup_table_enabled_by_min_char_complete = False
         for ime in self._current_imes:
             if self._transliterated_strings[ime]:
@@ -809,10 +878,22 @@ class TypingBoosterEngine(IBus.Engine):
                         prefix = (
                             self._transliterated_strings[ime][0:prefix_length])
                     try:
+                        # Show the completions right away, the spell
+                        # checking suggestions are added later when
+                        # the worker thread has computed them. Unit
+                        # tests need the complete result immediately:
                         candidates = self.db.select_words(
                             stripped_transliterated_string,
                             p_phrase=self._p_phrase,
-                            pp_phrase=self._pp_phrase)
+                            pp_phrase=self._pp_phrase,
+                            spellcheck=self._unit_test,
+                            hunspell_obj=self.hunspell_obj)
+                        if (not self._unit_test
+                                and ' ' not in stripped_transliterated_string
+                                and self.hunspell_obj.needs_spellcheck(
+                                    stripped_transliterated_string)):
+                            spellcheck_phrases.append(
+                                stripped_transliterated_string)
                     except:
                         import traceback
                         traceback.print_exc()
@@ -824,6 +905,14 @@ class TypingBoosterEngine(IBus.Engine):
                             phrase_frequencies[cand[0]], cand[1])
                     else:
                         phrase_frequencies[cand[0]] = cand[1]
+        self._start_spellcheck(tuple(spellcheck_phrases))
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                '_update_candidates() hunspell suggest cache: %s\n'
+                %self.hunspell_obj.get_suggest_cache_statistics())
+            sys.stderr.write(
+                '_update_candidates() select_words cache: %s\n'
+                %self.db.get_select_words_cache_statistics())
         phrase_candidates = self.db.best_candidates(phrase_frequencies)
         if (self._emoji_predictions
             or self._typed_string[0] in (' ', '_')
@@ -1191,7 +1280,10 @@ class TypingBoosterEngine(IBus.Engine):
                 %dictionary_names[:itb_util.MAXIMUM_NUMBER_OF_DICTIONARIES])
             dictionary_names = dictionary_names[:itb_util.MAXIMUM_NUMBER_OF_DICTIONARIES]
         self._dictionary_names = dictionary_names
-        self.db.hunspell_obj.set_dictionary_names(dictionary_names)
+        self.hunspell_obj.set_dictionary_names(
+            dictionary_names,
+            background=not self._unit_test,
+            callback=self._dictionaries_loaded_callback)
         self._update_dictionary_menu_dicts()
         self._init_or_update_property_menu_dictionary(
             self.dictionary_menu, current_mode=0)
@@ -1752,6 +1844,15 @@ class TypingBoosterEngine(IBus.Engine):
             sys.stderr.write('do_destroy()\n')
         self._clear_input_and_update_ui()
         self.do_focus_out()
+        if self._flush_timeout_id:
+            GLib.source_remove(self._flush_timeout_id)
+            self._flush_timeout_id = 0
+        if self._maintenance_timeout_id:
+            GLib.source_remove(self._maintenance_timeout_id)
+            self._maintenance_timeout_id = 0
+        self.db.flush_pending_updates()
+        self._stop_spellcheck_worker()
+        self.hunspell_obj.release_dictionaries()
         super(TypingBoosterEngine, self).destroy()
 
     def _update_preedit(self):
@@ -2000,6 +2101,132 @@ class TypingBoosterEngine(IBus.Engine):
         else:
             GLib.idle_add(self._update_candidates_and_lookup_table_and_aux)
 
+    def _start_spellcheck(self, input_phrases):
+        '''Compute spell checking suggestions in a worker thread
+
+        When they are ready, the candidates are updated again and the
+        spell checking suggestions are merged in. Results for input
+        which has changed in the meantime are dropped.
+
+        :param input_phrases: The input phrases which still need spell
+                              checking suggestions, may be empty.
+        :type input_phrases: Tuple of strings
+        '''
+        if input_phrases == self._spellcheck_pending:
+            return
+        self._spellcheck_pending = input_phrases
+        if not input_phrases:
+            return
+        if self._spellcheck_thread is None:
+            self._spellcheck_thread = threading.Thread(
+                target=self._spellcheck_worker, daemon=True)
+            self._spellcheck_thread.start()
+        self._spellcheck_queue.put((self.hunspell_obj, input_phrases))
+
+    def _stop_spellcheck_worker(self):
+        '''Stops the worker thread computing the spell checking
+        suggestions, if it is running, and waits until it has stopped
+        '''
+        if self._spellcheck_thread is None:
+            return
+        # None tells the worker thread to stop:
+        self._spellcheck_queue.put(None)
+        self._spellcheck_thread.join()
+        self._spellcheck_thread = None
+        self._spellcheck_pending = ()
+
+    def _spellcheck_worker(self):
+        '''Runs in the worker thread and computes spell checking
+        suggestions for the input phrases put into the queue.
+
+        Stops when None is put into the queue.
+        '''
+        while True:
+            request = self._spellcheck_queue.get()
+            # If more input has been typed in the meantime, only the
+            # newest request is still interesting:
+            while request is not None:
+                try:
+                    request = self._spellcheck_queue.get_nowait()
+                except queue.Empty:
+                    break
+            if request is None:
+                return
+            (hunspell_obj, input_phrases) = request
+            for input_phrase in input_phrases:
+                try:
+                    hunspell_obj.spellcheck(input_phrase)
+                except:
+                    import traceback
+                    traceback.print_exc()
+            GLib.idle_add(self._spellcheck_finished, input_phrases)
+
+    def _spellcheck_finished(self, input_phrases):
+        '''Called in the main thread when the worker thread has
+        computed the spell checking suggestions for input_phrases
+
+        Returns False to be removed as an idle callback.
+
+        :param input_phrases: The input phrases which have been
+                              spell checked
+        :type input_phrases: Tuple of strings
+        :rtype: Boolean
+        '''
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                '_spellcheck_finished(%s) pending=%s\n'
+                %(input_phrases, self._spellcheck_pending))
+        if input_phrases != self._spellcheck_pending:
+            # The input has changed, this result is stale:
+            return False
+        self._spellcheck_pending = ()
+        if (self.is_empty()
+                or self._hide_input
+                or (self._tab_enable
+                    and not self.is_lookup_table_enabled_by_tab)
+                or self._lookup_table_is_invalid
+                or self._lookup_table_shows_related_candidates
+                or self._lookup_table.cursor_visible):
+            # Either there is nothing to show, an update of the lookup
+            # table is already scheduled which will use the cached
+            # spell checking suggestions, or the user is already
+            # selecting candidates and the lookup table should not
+            # change under the cursor:
+            return False
+        self._update_candidates_and_lookup_table_and_aux()
+        return False
+
+    def _dictionaries_loaded_callback(self):
+        '''Called from the thread loading the hunspell dictionaries
+        in the background after the new dictionaries are in use
+        '''
+        GLib.idle_add(self._dictionaries_loaded)
+
+    def _dictionaries_loaded(self):
+        '''Called in the main thread after new hunspell dictionaries
+        have been loaded in the background
+
+        Returns False to be removed as an idle callback.
+
+        :rtype: Boolean
+        '''
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                '_dictionaries_loaded() dictionaries=%s\n'
+                %self.hunspell_obj.get_dictionary_names())
+        if (self.is_empty()
+                or self._hide_input
+                or (self._tab_enable
+                    and not self.is_lookup_table_enabled_by_tab)
+                or self._lookup_table_is_invalid
+                or self._lookup_table_shows_related_candidates
+                or self._lookup_table.cursor_visible):
+            return False
+        # The candidates shown were computed with the previous
+        # dictionaries:
+        self._update_candidates_and_lookup_table_and_aux()
+        return False
+
     def _lookup_related_candidates(self):
         '''Lookup related (similar) emoji or related words (synonyms,
         hyponyms, hypernyms).
@@ -2283,7 +2510,7 @@ class TypingBoosterEngine(IBus.Engine):
         stripped_input_phrase = itb_util.strip_token(input_phrase)
         stripped_commit_phrase = itb_util.strip_token(commit_phrase)
         if not self._off_the_record and not self._hide_input:
-            self.db.check_phrase_and_update_frequency(
+            self.db.queue_frequency_update(
                 input_phrase=stripped_input_phrase,
                 phrase=stripped_commit_phrase,
                 p_phrase=self.get_p_phrase(),
@@ -2297,13 +2524,14 @@ class TypingBoosterEngine(IBus.Engine):
                 # phrase is “to” and the total context was “I am
                 # going”, then also commit “going to” with the context
                 # “I am”:
-                self.db.check_phrase_and_update_frequency(
+                self.db.queue_frequency_update(
                     input_phrase=
                     self.get_p_phrase() + ' ' + stripped_commit_phrase,
                     phrase=self.get_p_phrase() + ' ' + stripped_commit_phrase,
                     p_phrase=self.get_pp_phrase(),
                     pp_phrase=self.get_ppp_phrase())
                 self.push_context(stripped_commit_phrase)
+            self._schedule_flush_pending_updates()
 
     def _reopen_preedit_or_return_false(self, key):
         '''BackSpace, Delete or arrow left or right has been typed.
@@ -2655,6 +2883,57 @@ class TypingBoosterEngine(IBus.Engine):
         '''
         return self._arrow_keys_reopen_preedit
 
+    def set_fast_typo_correction(self, mode, update_gsettings=True):
+        '''Sets whether an index of the dictionaries is used for
+        fast typo correction
+
+        :param mode: Whether to use the index for fast typo correction
+        :type mode: boolean
+        :param update_gsettings: Whether to write the change to Gsettings.
+                                 Set this to False if this method is
+                                 called because the Gsettings key changed
+                                 to avoid endless loops when the Gsettings
+                                 key is changed twice in a short time.
+        :type update_gsettings: boolean
+        '''
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "set_fast_typo_correction(%s, update_gsettings = %s)\n"
+                %(mode, update_gsettings))
+        if mode == self._fast_typo_correction:
+            return
+        self._fast_typo_correction = mode
+        self.hunspell_obj.set_deletion_index(
+            mode,
+            background=not self._unit_test,
+            callback=self._dictionaries_loaded_callback)
+        if update_gsettings:
+            self._gsettings.set_value(
+                'fasttypocorrection',
+                GLib.Variant.new_boolean(mode))
+
+    def toggle_fast_typo_correction(self, update_gsettings=True):
+        '''Toggles whether an index of the dictionaries is used for
+        fast typo correction
+
+        :param update_gsettings: Whether to write the change to Gsettings.
+                                 Set this to False if this method is
+                                 called because the Gsettings key changed
+                                 to avoid endless loops when the Gsettings
+                                 key is changed twice in a short time.
+        :type update_gsettings: boolean
+        '''
+        self.set_fast_typo_correction(
+            not self._fast_typo_correction, update_gsettings)
+
+    def get_fast_typo_correction(self):
+        '''Returns whether an index of the dictionaries is used for
+        fast typo correction
+
+        :rtype: boolean
+        '''
+        return self._fast_typo_correction
+
     def set_input_mode(self, mode):
         '''Sets the input mode
 
@@ -3652,6 +3931,149 @@ class TypingBoosterEngine(IBus.Engine):
         '''
         return self._debug_level
 
+    def set_user_db_half_life(self, half_life, update_gsettings=True):
+        '''Sets the half-life of the frequencies in the user database
+
+        Phrases which have not been used for a long time are removed
+        from the user database, a phrase used only once is removed
+        after one half-life.
+
+        :param half_life: The half-life in days, 0 to never remove
+                          phrases because they are old
+        :type half_life: integer >= 0
+        :param update_gsettings: Whether to write the change to Gsettings.
+                                 Set this to False if this method is
+                                 called because the Gsettings key changed
+                                 to avoid endless loops when the Gsettings
+                                 key is changed twice in a short time.
+        :type update_gsettings: boolean
+        '''
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "set_user_db_half_life(%s, update_gsettings = %s)\n"
+                %(half_life, update_gsettings))
+        if half_life == self._user_db_half_life:
+            return
+        if half_life >= 0:
+            self._user_db_half_life = half_life
+            if update_gsettings:
+                self._gsettings.set_value(
+                    'userdbhalflife',
+                    GLib.Variant.new_int32(half_life))
+
+    def get_user_db_half_life(self):
+        '''Returns the half-life of the frequencies in the user database
+
+        :rtype: integer
+        '''
+        return self._user_db_half_life
+
+    def set_user_db_max_rows(self, max_rows, update_gsettings=True):
+        '''Sets the maximum number of rows in the user database
+
+        :param max_rows: The maximum number of rows, 0 for no limit
+        :type max_rows: integer >= 0
+        :param update_gsettings: Whether to write the change to Gsettings.
+                                 Set this to False if this method is
+                                 called because the Gsettings key changed
+                                 to avoid endless loops when the Gsettings
+                                 key is changed twice in a short time.
+        :type update_gsettings: boolean
+        '''
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "set_user_db_max_rows(%s, update_gsettings = %s)\n"
+                %(max_rows, update_gsettings))
+        if max_rows == self._user_db_max_rows:
+            return
+        if max_rows >= 0:
+            self._user_db_max_rows = max_rows
+            if update_gsettings:
+                self._gsettings.set_value(
+                    'userdbmaxrows',
+                    GLib.Variant.new_int32(max_rows))
+
+    def get_user_db_max_rows(self):
+        '''Returns the maximum number of rows in the user database
+
+        :rtype: integer
+        '''
+        return self._user_db_max_rows
+
+    def set_user_db_backup_interval(self, hours, update_gsettings=True):
+        '''Sets the time between two automatic snapshots of the user
+        database
+
+        :param hours: The time between two snapshots in hours,
+                      0 for no automatic snapshots
+        :type hours: integer >= 0
+        :param update_gsettings: Whether to write the change to Gsettings.
+                                 Set this to False if this method is
+                                 called because the Gsettings key changed
+                                 to avoid endless loops when the Gsettings
+                                 key is changed twice in a short time.
+        :type update_gsettings: boolean
+        '''
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "set_user_db_backup_interval(%s, update_gsettings = %s)\n"
+                %(hours, update_gsettings))
+        if hours == self._user_db_backup_interval:
+            return
+        if hours >= 0:
+            self._user_db_backup_interval = hours
+            if update_gsettings:
+                self._gsettings.set_value(
+                    'userdbbackupinterval',
+                    GLib.Variant.new_int32(hours))
+
+    def get_user_db_backup_interval(self):
+        '''Returns the time between two automatic snapshots of the
+        user database in hours
+
+        :rtype: integer
+        '''
+        return self._user_db_backup_interval
+
+    def set_system_ngram_db(self, system_ngram_db, update_gsettings=True):
+        '''Sets the database of system n-grams blended into the
+        predictions
+
+        :param system_ngram_db: The full path of a database built by
+                                tabsqlitedb.import_system_db(), ''
+                                to use no system n-grams
+        :type system_ngram_db: string
+        :param update_gsettings: Whether to write the change to Gsettings.
+                                 Set this to False if this method is
+                                 called because the Gsettings key changed
+                                 to avoid endless loops when the Gsettings
+                                 key is changed twice in a short time.
+        :type update_gsettings: boolean
+        '''
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "set_system_ngram_db(%s, update_gsettings = %s)\n"
+                %(system_ngram_db, update_gsettings))
+        if system_ngram_db == self._system_ngram_db:
+            return
+        self._system_ngram_db = system_ngram_db
+        if system_ngram_db:
+            self.db.attach_system_db(system_ngram_db)
+        else:
+            self.db.detach_system_db()
+        if update_gsettings:
+            self._gsettings.set_value(
+                'systemngramdb',
+                GLib.Variant.new_string(system_ngram_db))
+
+    def get_system_ngram_db(self):
+        '''Returns the full path of the database of system n-grams,
+        '' if none is used
+
+        :rtype: string
+        '''
+        return self._system_ngram_db
+
     def set_show_number_of_candidates(self, mode, update_gsettings=True):
         '''Sets the “Show number of candidates” mode
 
@@ -4255,6 +4677,7 @@ class TypingBoosterEngine(IBus.Engine):
         modifier means Key Pressed
         '''
         key = itb_util.KeyEvent(keyval, keycode, state)
+        self._last_key_event_time = time.time()
         if DEBUG_LEVEL > 1:
             sys.stderr.write(
                 "process_key_event() "
@@ -4711,12 +5134,71 @@ class TypingBoosterEngine(IBus.Engine):
         stripped_input_phrase = itb_util.strip_token(input_phrase)
         stripped_commit_phrase = itb_util.strip_token(commit_phrase)
         if not self._off_the_record and not self._hide_input:
-            self.db.check_phrase_and_update_frequency(
+            self.db.queue_frequency_update(
                 input_phrase=stripped_input_phrase,
                 phrase=stripped_commit_phrase,
                 p_phrase=self.get_p_phrase(),
                 pp_phrase=self.get_pp_phrase())
             self.push_context(stripped_commit_phrase)
+            self._schedule_flush_pending_updates()
+
+    def _schedule_flush_pending_updates(self):
+        '''Make sure the updates queued in the user database will be
+        written when the user stops typing for a while
+        '''
+        if self._flush_timeout_id or not self.db.has_pending_updates():
+            return
+        self._flush_timeout_id = GLib.timeout_add_seconds(
+            WRITE_BEHIND_IDLE_SECONDS, self._flush_pending_updates_when_idle)
+
+    def _flush_pending_updates_when_idle(self):
+        '''Timeout callback writing the queued updates of the user
+        database if no key has been typed for WRITE_BEHIND_IDLE_SECONDS
+
+        Returns True to be called again if the user is still typing,
+        False to be removed otherwise.
+
+        :rtype: Boolean
+        '''
+        if (time.time() - self._last_key_event_time
+                < WRITE_BEHIND_IDLE_SECONDS):
+            return True
+        self._flush_timeout_id = 0
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write('_flush_pending_updates_when_idle()\n')
+        self.db.flush_pending_updates()
+        self._schedule_user_db_maintenance()
+        return False
+
+    def _schedule_user_db_maintenance(self):
+        '''Start the maintenance of the user database in small steps
+        while the user is idle, unless it is running already
+        '''
+        if self._maintenance_timeout_id:
+            return
+        self._maintenance_timeout_id = GLib.timeout_add_seconds(
+            USER_DB_MAINTENANCE_INTERVAL_SECONDS,
+            self._maintain_user_db_when_idle)
+
+    def _maintain_user_db_when_idle(self):
+        '''Timeout callback doing a step of the maintenance of the user
+        database if no key has been typed for WRITE_BEHIND_IDLE_SECONDS
+
+        Returns True to be called again if there is more to do,
+        False to be removed otherwise.
+
+        :rtype: Boolean
+        '''
+        if (time.time() - self._last_key_event_time
+                < WRITE_BEHIND_IDLE_SECONDS):
+            return True
+        if self.db.run_maintenance_step(
+                half_life_days=self._user_db_half_life,
+                max_rows=self._user_db_max_rows,
+                backup_interval=self._user_db_backup_interval * 60 * 60):
+            return True
+        self._maintenance_timeout_id = 0
+        return False
 
     def do_focus_out(self):
         '''Called when a window looses focus while this input engine is
@@ -4734,6 +5216,9 @@ class TypingBoosterEngine(IBus.Engine):
         # been recorded in the user database yet. Do it now:
         if not self.is_empty():
             self._record_in_database_and_push_context()
+        # Write what has been learned in this window now, nothing
+        # is queued anymore when focus moves on:
+        self.db.flush_pending_updates()
         self.clear_context()
         self._clear_input_and_update_ui()
 
@@ -4867,6 +5352,9 @@ class TypingBoosterEngine(IBus.Engine):
         if key == 'arrowkeysreopenpreedit':
             self.set_arrow_keys_reopen_preedit(value, update_gsettings=False)
             return
+        if key == 'fasttypocorrection':
+            self.set_fast_typo_correction(value, update_gsettings=False)
+            return
         if key == 'emojipredictions':
             self.set_emoji_prediction_mode(value, update_gsettings=False)
             return
@@ -4902,6 +5390,18 @@ class TypingBoosterEngine(IBus.Engine):
         if key == 'debuglevel':
             self.set_debug_level(value, update_gsettings=False)
             return
+        if key == 'userdbhalflife':
+            self.set_user_db_half_life(value, update_gsettings=False)
+            return
+        if key == 'userdbmaxrows':
+            self.set_user_db_max_rows(value, update_gsettings=False)
+            return
+        if key == 'userdbbackupinterval':
+            self.set_user_db_backup_interval(value, update_gsettings=False)
+            return
+        if key == 'systemngramdb':
+            self.set_system_ngram_db(value, update_gsettings=False)
+            return
         if key == 'shownumberofcandidates':
             self.set_show_number_of_candidates(value, update_gsettings=False)
             return
@@ -4986,7 +5486,9 @@ class TypingBoosterEngine(IBus.Engine):
             # A dictionary has been updated or installed,
             # (re)load all dictionaries:
             print('Reloading dictionaries ...')
-            self.db.hunspell_obj.init_dictionaries()
+            self.hunspell_obj.init_dictionaries(
+                background=not self._unit_test,
+                callback=self._dictionaries_loaded_callback)
             self._clear_input_and_update_ui()
             return
         sys.stderr.write('Unknown key\n')
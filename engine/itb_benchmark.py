@@ -0,0 +1,561 @@
+# -*- coding: utf-8 -*-
+# vim:et sts=4 sw=4
+#
+# ibus-typing-booster - A completion input method for IBus
+#
+# Copyright (c) 2026 Mike FABIAN <mfabian@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+'''
+Benchmarks of the user database with synthetic data.
+
+Measures how TabSqliteDb.select_words(), learning the words typed
+and TabSqliteDb.read_training_data_from_file() scale with the number
+of rows of the user database:
+
+    python3 itb_benchmark.py --rows 10000 100000 1000000 5000000
+
+For each number of rows, a user database is filled with random
+phrases and contexts. The words follow a Zipf distribution, as in
+real text a few words occur very often. The databases are
+reproducible, the same seed always gives the same database. On-disk
+databases are kept in --directory and reused by the next run, each
+run works on a copy.
+
+Then a typing trace is replayed against the database: For each word
+of the trace, its prefixes are looked up with select_words() until
+the word is the best candidate or has been typed completely (the
+lookup latency), then the word is learned like the engine does it,
+with queue_frequency_update() (the “learn” latency). After each
+sentence of FLUSH_INTERVAL_WORDS words, the queued words are written
+with flush_pending_updates() (the “flush” latency), as the engine
+does when the user pauses. The benchmark writes synchronously, the
+engine hands the flush over to the writer thread of the database.
+For comparison, the same trace is then committed word by word with
+check_phrase_and_update_frequency(), which writes each word in its
+own transaction (the “commit” latency). Finally a synthetic text
+file is learned with read_training_data_from_file().
+
+The prefixes looked up are also looked up with the query of
+select_words() directly, once selecting the input phrases with the
+range given by tabsqlitedb.prefix_upper_bound() and once with a LIKE
+pattern, as select_words() did before (the “range/LIKE” column).
+
+The benchmark runs with an in-memory database (“memory”) and with a
+database file in WAL mode (“wal”), see --modes.
+'''
+
+import os
+import sys
+import time
+import random
+import itertools
+import shutil
+import tempfile
+import argparse
+import tabsqlitedb
+
+# The number of different words is this fraction of the number of
+# rows, but at least MIN_VOCABULARY_SIZE and at most
+# MAX_VOCABULARY_SIZE. A user database with many rows mostly has more
+# contexts for the same words, not more words:
+VOCABULARY_FRACTION = 0.1
+MIN_VOCABULARY_SIZE = 1000
+MAX_VOCABULARY_SIZE = 200000
+
+# The rows are written to the database in batches of this size:
+FILL_BATCH_SIZE = 50000
+
+# The words learned while replaying the typing trace are flushed
+# after this many words, i.e. after each sentence:
+FLUSH_INTERVAL_WORDS = 12
+
+def parse_args():
+    '''
+    Parse the command line arguments.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the user database of '
+        + 'ibus-typing-booster with synthetic data')
+    parser.add_argument(
+        '-r', '--rows',
+        nargs='+',
+        type=int,
+        action='store',
+        default=[10000, 100000, 1000000, 5000000],
+        help='The numbers of rows of the user databases to benchmark. '
+        + 'default: “%(default)s”')
+    parser.add_argument(
+        '-m', '--modes',
+        nargs='+',
+        choices=['memory', 'wal'],
+        action='store',
+        default=['memory', 'wal'],
+        help='Benchmark in-memory databases, database files in '
+        + 'WAL mode, or both. default: “%(default)s”')
+    parser.add_argument(
+        '-d', '--directory',
+        type=str,
+        action='store',
+        default=os.path.join(tempfile.gettempdir(), 'itb-benchmark'),
+        help='The directory where the database files are kept. '
+        + 'default: “%(default)s”')
+    parser.add_argument(
+        '-s', '--seed',
+        type=int,
+        action='store',
+        default=1,
+        help='The seed of the random numbers. default: “%(default)s”')
+    parser.add_argument(
+        '-w', '--words',
+        type=int,
+        action='store',
+        default=1000,
+        help='The number of words of the typing trace. '
+        + 'default: “%(default)s”')
+    parser.add_argument(
+        '--training-words',
+        type=int,
+        action='store',
+        default=100000,
+        help='The number of words of the text file to learn from, '
+        + '0 to skip learning from a file. default: “%(default)s”')
+    parser.add_argument(
+        '-t', '--trie',
+        action='store_true',
+        default=False,
+        help='Use the in-memory n-gram trie like the engine does. '
+        + '(It is only used up to %s rows.)'
+        % tabsqlitedb.NGRAM_TRIE_MAX_ROWS)
+    return parser.parse_args()
+
+class ZipfWords:
+    '''Random words following a Zipf distribution
+
+    The probability of the word with the rank r is proportional to 1/r.
+
+    Examples:
+
+    >>> words = ZipfWords(1000, 1)
+    >>> len(words.vocabulary)
+    1000
+    >>> sample = [words.choice() for dummy in range(10000)]
+    >>> sample.count(words.vocabulary[0]) > sample.count(words.vocabulary[9])
+    True
+    '''
+    def __init__(self, size, seed, choice_seed=None):
+        '''
+        :param size: The number of different words
+        :type size: Integer
+        :param seed: The seed of the random numbers which make the
+                     vocabulary
+        :type seed: Integer
+        :param choice_seed: The seed of the random numbers which
+                            choose the words, the same as seed if None
+        :type choice_seed: Integer or None
+        '''
+        rng = random.Random(seed)
+        letters = 'abcdefghijklmnopqrstuvwxyzäöüß'
+        vocabulary = set()
+        while len(vocabulary) < size:
+            vocabulary.add(''.join(
+                rng.choice(letters)
+                for dummy in range(max(1, int(rng.gauss(7, 3))))))
+        # Sorted first, otherwise the order of the set would make the
+        # ranks differ from run to run:
+        self.vocabulary = sorted(vocabulary)
+        rng.shuffle(self.vocabulary)
+        self._cum_weights = list(itertools.accumulate(
+            1.0 / rank for rank in range(1, size + 1)))
+        if choice_seed is None:
+            self._rng = rng
+        else:
+            self._rng = random.Random(choice_seed)
+
+    def choice(self):
+        '''Returns a random word'''
+        return self._rng.choices(
+            self.vocabulary, cum_weights=self._cum_weights)[0]
+
+    def sentence(self, length):
+        '''Returns a list of random words
+
+        :param length: The number of words
+        :type length: Integer
+        :rtype: List of strings
+        '''
+        return self._rng.choices(
+            self.vocabulary, cum_weights=self._cum_weights, k=length)
+
+def vocabulary_size(number_of_rows):
+    '''Returns the number of different words for a database with
+    number_of_rows rows
+
+    :param number_of_rows: The number of rows
+    :type number_of_rows: Integer
+    :rtype: Integer
+
+    Examples:
+
+    >>> vocabulary_size(10000)
+    1000
+    >>> vocabulary_size(5000000)
+    200000
+    '''
+    return min(MAX_VOCABULARY_SIZE,
+               max(MIN_VOCABULARY_SIZE,
+                   int(number_of_rows * VOCABULARY_FRACTION)))
+
+def fill_user_db(database, number_of_rows, seed):
+    '''Fill an empty user database with random rows
+
+    The phrases and the contexts are Zipf distributed, the input
+    phrase of a row is a random prefix of the phrase of at least two
+    characters. The rows are written in batches with the writer of
+    the database, like the rows learned from a file.
+
+    :param database: The empty database to fill
+    :type database: tabsqlitedb.TabSqliteDb
+    :param number_of_rows: The number of rows to create
+    :type number_of_rows: Integer
+    :param seed: The seed of the random numbers
+    :type seed: Integer
+    '''
+    rng = random.Random(seed)
+    words = ZipfWords(vocabulary_size(number_of_rows), seed)
+    rows = 0
+    while rows < number_of_rows:
+        # Some rows are generated more than once and only increase the
+        # frequency of the row, so fill until enough rows are there:
+        updates = {}
+        while len(updates) < min(FILL_BATCH_SIZE, number_of_rows - rows):
+            phrase = words.choice()
+            input_phrase = phrase[:rng.randint(min(2, len(phrase)),
+                                               len(phrase))]
+            key = (input_phrase, phrase, words.choice(), words.choice())
+            updates[key] = updates.get(key, 0) + rng.randint(1, 10)
+        database._submit_frequency_updates(updates)
+        database._writer.wait()
+        rows = database.db.execute(
+            'SELECT count(*) FROM user_db.phrases;').fetchall()[0][0]
+
+def open_user_db(mode, number_of_rows, seed, directory, trie):
+    '''Returns a user database with number_of_rows random rows
+
+    :param mode: 'memory' or 'wal'
+    :type mode: String
+    :param number_of_rows: The number of rows
+    :type number_of_rows: Integer
+    :param seed: The seed of the random numbers
+    :type seed: Integer
+    :param directory: Where the database files are kept
+    :type directory: String
+    :param trie: Whether to use the in-memory n-gram trie
+    :type trie: Boolean
+    :return: The database and the name of its file, which is a copy
+             of the kept file, or ':memory:'
+    :rtype: Tuple (tabsqlitedb.TabSqliteDb, String)
+    '''
+    if mode == 'memory':
+        database = tabsqlitedb.TabSqliteDb(user_db_file=':memory:')
+        fill_user_db(database, number_of_rows, seed)
+        if trie:
+            database.load_ngram_trie()
+        return (database, ':memory:')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    kept_file = os.path.join(
+        directory, 'user-%d-%d.db' %(number_of_rows, seed))
+    if not os.path.exists(kept_file):
+        # Left over if filling was interrupted:
+        remove_user_db(kept_file + '.new')
+        database = tabsqlitedb.TabSqliteDb(user_db_file=kept_file + '.new')
+        fill_user_db(database, number_of_rows, seed)
+        # Closing the last connection checkpoints and removes the WAL:
+        database.sync_usrdb()
+        database.db.close()
+        os.replace(kept_file + '.new', kept_file)
+        remove_user_db(kept_file + '.new')
+    user_db_file = os.path.join(directory, 'user-work.db')
+    remove_user_db(user_db_file)
+    shutil.copyfile(kept_file, user_db_file)
+    return (tabsqlitedb.TabSqliteDb(user_db_file=user_db_file,
+                                    ngram_trie=trie),
+            user_db_file)
+
+def remove_user_db(user_db_file):
+    '''Remove a database file and its WAL
+
+    :param user_db_file: The file name of the database
+    :type user_db_file: String
+    '''
+    if user_db_file == ':memory:':
+        return
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(user_db_file + suffix):
+            os.remove(user_db_file + suffix)
+
+def percentiles(latencies):
+    '''Returns the 50th, 95th and 99th percentile of latencies in
+    milliseconds
+
+    :param latencies: Latencies in seconds
+    :type latencies: List of floats
+    :rtype: Tuple of floats
+
+    Examples:
+
+    >>> percentiles([i / 1000 for i in range(1, 101)])
+    (51.0, 96.0, 100.0)
+    >>> percentiles([])
+    (0.0, 0.0, 0.0)
+    '''
+    if not latencies:
+        return (0.0, 0.0, 0.0)
+    latencies = sorted(latencies)
+    return tuple(
+        round(latencies[min(len(latencies) - 1,
+                            int(len(latencies) * fraction))] * 1000, 3)
+        for fraction in (0.5, 0.95, 0.99))
+
+def like_pattern(prefix):
+    '''Returns a LIKE pattern matching the strings starting with prefix
+
+    “\\” is the escape character of the pattern.
+
+    :param prefix: The prefix
+    :type prefix: String
+    :rtype: String
+
+    Examples:
+
+    >>> like_pattern('co')
+    'co%'
+    >>> like_pattern('50%_a\\\\')
+    '50\\\\%\\\\_a\\\\\\\\%'
+    '''
+    return (prefix.replace('\\', '\\\\').replace('%', '\\%')
+            .replace('_', '\\_') + '%')
+
+def compare_prefix_queries(database, lookups):
+    '''Run the query of select_words() with the prefix range and with
+    a LIKE pattern selecting the input phrases
+
+    :param database: The database
+    :type database: tabsqlitedb.TabSqliteDb
+    :param lookups: The lookups, tuples (input_phrase, p_phrase,
+                    pp_phrase)
+    :type lookups: List of tuples
+    :return: The latencies of the range query and of the LIKE query
+             in seconds and the number of lookups where the results
+             differ
+    :rtype: Tuple (list of floats, list of floats, integer)
+    '''
+    range_sql = tabsqlitedb.SELECT_WORDS_SQL % {
+        'where': 'text >= :input_phrase AND text < :input_phrase_upper'}
+    open_range_sql = tabsqlitedb.SELECT_WORDS_SQL % {
+        'where': 'text >= :input_phrase'}
+    like_sql = tabsqlitedb.SELECT_WORDS_SQL % {
+        'where': "text LIKE :pattern ESCAPE '\\'"}
+    range_latencies = []
+    like_latencies = []
+    mismatches = 0
+    for (input_phrase, p_phrase, pp_phrase) in lookups:
+        sqlargs = {
+            'input_phrase': input_phrase,
+            'input_phrase_upper': tabsqlitedb.prefix_upper_bound(
+                input_phrase),
+            'pattern': like_pattern(input_phrase),
+            'p_phrase': database._get_token_id(p_phrase),
+            'pp_phrase': database._get_token_id(pp_phrase)}
+        time_start = time.perf_counter()
+        range_rows = database.db.execute(
+            range_sql if sqlargs['input_phrase_upper'] is not None
+            else open_range_sql, sqlargs).fetchall()
+        range_latencies.append(time.perf_counter() - time_start)
+        time_start = time.perf_counter()
+        like_rows = database.db.execute(like_sql, sqlargs).fetchall()
+        like_latencies.append(time.perf_counter() - time_start)
+        if sorted(range_rows) != sorted(like_rows):
+            mismatches += 1
+    return (range_latencies, like_latencies, mismatches)
+
+def replay_typing_trace(database, trace):
+    '''Replay a typing trace against a database
+
+    The words are learned the way the engine learns them, see
+    queue_frequency_update() and flush_pending_updates().
+
+    :param database: The database
+    :type database: tabsqlitedb.TabSqliteDb
+    :param trace: The words typed
+    :type trace: List of strings
+    :return: The latencies of select_words(), of
+             queue_frequency_update() and of flush_pending_updates()
+             in seconds and the lookups done, tuples (input_phrase,
+             p_phrase, pp_phrase)
+    :rtype: Tuple (list of floats, list of floats, list of floats,
+            list of tuples)
+    '''
+    lookup_latencies = []
+    learn_latencies = []
+    flush_latencies = []
+    lookups = []
+    p_phrase = pp_phrase = ''
+    for (number, word) in enumerate(trace, 1):
+        for length in range(1, len(word) + 1):
+            time_start = time.perf_counter()
+            candidates = database.select_words(
+                word[:length], p_phrase=p_phrase, pp_phrase=pp_phrase)
+            lookup_latencies.append(time.perf_counter() - time_start)
+            lookups.append((word[:length], p_phrase, pp_phrase))
+            if candidates and candidates[0][0] == word:
+                break
+        time_start = time.perf_counter()
+        database.queue_frequency_update(
+            input_phrase=word[:length], phrase=word,
+            p_phrase=p_phrase, pp_phrase=pp_phrase)
+        learn_latencies.append(time.perf_counter() - time_start)
+        if number % FLUSH_INTERVAL_WORDS == 0 or number == len(trace):
+            time_start = time.perf_counter()
+            database.flush_pending_updates()
+            flush_latencies.append(time.perf_counter() - time_start)
+        (pp_phrase, p_phrase) = (p_phrase, word)
+    return (lookup_latencies, learn_latencies, flush_latencies, lookups)
+
+def replay_commits(database, trace):
+    '''Commit the words of a typing trace one by one with
+    check_phrase_and_update_frequency()
+
+    Each word is written in its own transaction, unlike the words
+    learned by replay_typing_trace().
+
+    :param database: The database
+    :type database: tabsqlitedb.TabSqliteDb
+    :param trace: The words typed
+    :type trace: List of strings
+    :return: The latencies of check_phrase_and_update_frequency()
+             in seconds
+    :rtype: List of floats
+    '''
+    commit_latencies = []
+    p_phrase = pp_phrase = ''
+    for word in trace:
+        time_start = time.perf_counter()
+        database.check_phrase_and_update_frequency(
+            input_phrase=word, phrase=word,
+            p_phrase=p_phrase, pp_phrase=pp_phrase)
+        commit_latencies.append(time.perf_counter() - time_start)
+        (pp_phrase, p_phrase) = (p_phrase, word)
+    return commit_latencies
+
+def write_training_file(filename, number_of_words, words):
+    '''Write a text file with random sentences to learn from
+
+    :param filename: The name of the file to write
+    :type filename: String
+    :param number_of_words: The number of words to write
+    :type number_of_words: Integer
+    :param words: The random words
+    :type words: ZipfWords
+    '''
+    with open(filename, 'w', encoding='UTF-8') as file_handle:
+        written = 0
+        while written < number_of_words:
+            sentence = words.sentence(12)
+            file_handle.write(' '.join(sentence) + '.\n')
+            written += len(sentence)
+
+def benchmark(mode, number_of_rows, args):
+    '''Run the benchmarks for one database
+
+    :param mode: 'memory' or 'wal'
+    :type mode: String
+    :param number_of_rows: The number of rows of the database
+    :type number_of_rows: Integer
+    :param args: The command line arguments
+    :rtype: Dictionary
+    '''
+    time_start = time.time()
+    (database, user_db_file) = open_user_db(
+        mode, number_of_rows, args.seed, args.directory, args.trie)
+    result = {'mode': mode,
+              'rows': number_of_rows,
+              'setup': time.time() - time_start,
+              'trie': database._ngram_trie is not None}
+    try:
+        # The trace uses the same words as the database, so the
+        # predictions are found:
+        words = ZipfWords(vocabulary_size(number_of_rows), args.seed,
+                          choice_seed=args.seed + 1)
+        trace = words.sentence(args.words)
+        (lookup_latencies,
+         learn_latencies,
+         flush_latencies,
+         lookups) = replay_typing_trace(database, trace)
+        result['lookup'] = percentiles(lookup_latencies)
+        result['learn'] = percentiles(learn_latencies)
+        result['flush'] = percentiles(flush_latencies)
+        result['commit'] = percentiles(replay_commits(database, trace))
+        (range_latencies,
+         like_latencies,
+         result['mismatches']) = compare_prefix_queries(database, lookups)
+        result['range'] = percentiles(range_latencies)[0]
+        result['like'] = percentiles(like_latencies)[0]
+        result['training'] = 0.0
+        if args.training_words:
+            training_file = os.path.join(
+                tempfile.gettempdir(),
+                'itb-benchmark-%d.txt' %os.getpid())
+            write_training_file(training_file, args.training_words, words)
+            time_start = time.time()
+            database.read_training_data_from_file(training_file)
+            result['training'] = time.time() - time_start
+            os.remove(training_file)
+        database.sync_usrdb()
+    finally:
+        database.db.close()
+        remove_user_db(user_db_file)
+    return result
+
+def main():
+    '''
+    “python3 itb_benchmark.py --help” shows the options.
+    '''
+    args = parse_args()
+    print('%-6s %8s %5s %8s %20s %20s %20s %20s %18s %10s'
+          %('mode', 'rows', 'trie', 'setup s',
+            'lookup ms p50/95/99', 'learn ms p50/95/99',
+            'flush ms p50/95/99', 'commit ms p50/95/99',
+            'range/LIKE ms p50', 'training s'))
+    for number_of_rows in args.rows:
+        for mode in args.modes:
+            result = benchmark(mode, number_of_rows, args)
+            print('%-6s %8d %5s %8.1f %20s %20s %20s %20s %18s %10.1f'
+                  %(result['mode'], result['rows'], result['trie'],
+                    result['setup'],
+                    '%.2f/%.2f/%.2f' %result['lookup'],
+                    '%.2f/%.2f/%.2f' %result['learn'],
+                    '%.2f/%.2f/%.2f' %result['flush'],
+                    '%.2f/%.2f/%.2f' %result['commit'],
+                    '%.2f/%.2f' %(result['range'], result['like']),
+                    result['training']))
+            if result['mismatches']:
+                print('The range and the LIKE query differ '
+                      + 'for %d lookups!' %result['mismatches'])
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,7 @@ import string
 import unicodedata
 import gettext
 import traceback
+import collections
 from gi import require_version
 require_version('IBus', '1.0')
 from gi.repository import IBus
@@ -2955,12 +2956,227 @@ def find_hunspell_dictionary(language):
         %(language, dirnames))
     return ('', '')
 
-def get_hunspell_dictionary_wordlist(language):
+class HunspellAffixes:
+    '''A class to expand hunspell dictionary words into their word forms
+    using the prefix and suffix rules of a hunspell .aff file
+
+    Only the PFX and SFX rules and the FLAG and AF settings are used.
+    Continuation classes of affixes, compounding and morphological
+    information are ignored. This is good enough to find the common
+    inflected forms of words for completion, hunspell remains the
+    authority about which words are correct.
+
+    Examples:
+
+    >>> affixes = HunspellAffixes(
+    ...     'PFX A Y 1\\n'
+    ...     'PFX A 0 re .\\n'
+    ...     'SFX S Y 3\\n'
+    ...     'SFX S y ies [^aeiou]y\\n'
+    ...     'SFX S 0 s [aeiou]y\\n'
+    ...     'SFX S 0 s [^y]\\n')
+    >>> affixes.expand('try', 'AS')
+    ['tries', 'retry', 'retries']
+
+    >>> affixes.expand('play', 'S')
+    ['plays']
+
+    >>> affixes.expand('play', 'AS', max_forms=1)
+    ['plays']
+
+    >>> affixes = HunspellAffixes(
+    ...     'FLAG long\\n'
+    ...     'AF 1\\n'
+    ...     'AF Zsn1\\n'
+    ...     'SFX Zs Y 1\\n'
+    ...     'SFX Zs 0 s .\\n'
+    ...     'SFX n1 N 1\\n'
+    ...     'SFX n1 e ung e\\n')
+    >>> affixes.expand('Bewege', '1')
+    ['Beweges', 'Bewegung']
+    '''
+    def __init__(self, aff_buffer):
+        '''
+        :param aff_buffer: The contents of a hunspell .aff file
+        :type aff_buffer: String
+        '''
+        self._flag_type = 'char'
+        # The flag vectors of the AF lines, the .dic file can refer
+        # to them by number:
+        self._aliases = []
+        # self._rules['PFX'][flag] and self._rules['SFX'][flag] are
+        # tuples (cross_product, rules), each rule is a tuple
+        # (strip, add, condition) where condition is a compiled
+        # regular expression:
+        self._rules = {'PFX': {}, 'SFX': {}}
+        alias_header_seen = False
+        for line in aff_buffer.splitlines():
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == 'FLAG' and len(fields) > 1:
+                self._flag_type = fields[1].lower()
+            elif fields[0] == 'AF' and len(fields) > 1:
+                # The first AF line only gives the number of aliases:
+                if alias_header_seen:
+                    self._aliases.append(fields[1])
+                alias_header_seen = True
+            elif fields[0] in ('PFX', 'SFX') and len(fields) >= 4:
+                self._parse_affix_line(fields)
+
+    def _parse_affix_line(self, fields):
+        '''Parses a PFX or SFX line of a .aff file
+
+        The first line for a flag is the header “SFX flag cross_product
+        number_of_rules”, the following lines are the rules
+        “SFX flag strip add condition”.
+
+        :param fields: The whitespace separated fields of the line
+        :type fields: List of strings
+        '''
+        (kind, flag) = fields[0:2]
+        if flag not in self._rules[kind]:
+            self._rules[kind][flag] = (fields[2] == 'Y', [])
+            return
+        strip = fields[2]
+        if strip == '0':
+            strip = ''
+        # The affix may be followed by continuation flags, which
+        # are not used here:
+        add = fields[3].split('/')[0]
+        if add == '0':
+            add = ''
+        condition = '.'
+        if len(fields) > 4:
+            condition = fields[4]
+        pattern = self._condition_to_regexp(condition)
+        if kind == 'SFX':
+            regexp = re.compile('(?:%s)$' % pattern)
+        else:
+            regexp = re.compile(pattern)
+        self._rules[kind][flag][1].append((strip, add, regexp))
+
+    @staticmethod
+    def _condition_to_regexp(condition):
+        '''Converts the condition of a hunspell affix rule into a
+        regular expression
+
+        Conditions consist only of characters, “.” and character
+        classes like “[aeiou]” or “[^aeiou]”.
+
+        :param condition: The condition of an affix rule
+        :type condition: String
+        :rtype: String
+
+        Examples:
+
+        >>> HunspellAffixes._condition_to_regexp('[^aeiou]y')
+        '[^aeiou]y'
+
+        >>> HunspellAffixes._condition_to_regexp('.')
+        ''
+        '''
+        if condition == '.':
+            return ''
+        pattern = ''
+        in_class = False
+        for character in condition:
+            if in_class:
+                if character == ']':
+                    in_class = False
+                    pattern += ']'
+                elif character == '^' and pattern.endswith('['):
+                    pattern += '^'
+                else:
+                    pattern += re.escape(character)
+            elif character == '[':
+                in_class = True
+                pattern += '['
+            elif character == '.':
+                pattern += '.'
+            else:
+                pattern += re.escape(character)
+        if in_class:
+            pattern += ']'
+        return pattern
+
+    def split_flags(self, flags):
+        '''Returns the list of flags in the flag field of a .dic line
+
+        :param flags: The flags following the “/” of a .dic line
+        :type flags: String
+        :rtype: List of strings
+        '''
+        if self._aliases and flags.isdigit():
+            alias = int(flags)
+            if not 0 < alias <= len(self._aliases):
+                return []
+            flags = self._aliases[alias - 1]
+        if self._flag_type == 'long':
+            return [flags[i:i + 2] for i in range(0, len(flags), 2)]
+        if self._flag_type == 'num':
+            return [x for x in flags.split(',') if x]
+        return list(flags)
+
+    def expand(self, word, flags, max_forms=100):
+        '''Returns the word forms generated from word by the prefix
+        and suffix rules with the given flags
+
+        The word itself is not included.
+
+        :param word: A word from a .dic file
+        :type word: String
+        :param flags: The flags following the “/” of the .dic line
+        :type flags: String
+        :param max_forms: The maximum number of forms to return
+        :type max_forms: Integer
+        :rtype: List of strings
+        '''
+        prefix_rules = []
+        suffix_forms = []
+        for flag in self.split_flags(flags):
+            if flag in self._rules['SFX']:
+                (cross_product, rules) = self._rules['SFX'][flag]
+                for (strip, add, condition) in rules:
+                    if word.endswith(strip) and condition.search(word):
+                        suffix_forms.append(
+                            (word[:len(word) - len(strip)] + add,
+                             cross_product))
+            if flag in self._rules['PFX']:
+                (cross_product, rules) = self._rules['PFX'][flag]
+                for (strip, add, condition) in rules:
+                    if word.startswith(strip) and condition.match(word):
+                        prefix_rules.append((strip, add, cross_product))
+        forms = [form for (form, dummy_cross_product) in suffix_forms]
+        for (strip, add, prefix_cross_product) in prefix_rules:
+            forms.append(add + word[len(strip):])
+            if not prefix_cross_product:
+                continue
+            for (form, suffix_cross_product) in suffix_forms:
+                if suffix_cross_product and form.startswith(strip):
+                    forms.append(add + form[len(strip):])
+        result = []
+        seen = {word, ''}
+        for form in forms:
+            if form not in seen:
+                seen.add(form)
+                result.append(form)
+                if len(result) >= max_forms:
+                    break
+        return result
+
+def get_hunspell_dictionary_wordlist(language, max_affix_forms=0):
     '''
     Open the hunspell dictionary file for a language
 
     :param language: The language of the dictionary to open
     :type language: String
+    :param max_affix_forms: If greater than 0, the word forms generated
+                            by the prefix and suffix rules of the .aff
+                            file are added to the word list, at most
+                            max_affix_forms forms per word of the .dic
+                            file, see HunspellAffixes.
+    :type max_affix_forms: Integer
     :rtype: tuple of the form (dic_path, dictionary_encoding, wordlist) where
             dic_path is the full path of the dictionary file found,
             dictionary_encoding is the encoding of that dictionary file,
@@ -2976,8 +3192,8 @@ def get_hunspell_dictionary_wordlist(language):
         + '%s file found.\n'
         %dic_path)
     dictionary_encoding = 'UTF-8'
+    aff_buffer = ''
     if os.path.isfile(aff_path):
-        aff_buffer = ''
         try:
             aff_buffer = open(
                 aff_path,
@@ -3084,6 +3300,30 @@ def get_hunspell_dictionary_wordlist(language):
             re.sub(r'[/\t].*', '', x.replace('\n', '')))
         for x in dic_buffer
     ]
+    if max_affix_forms > 0 and aff_buffer:
+        # The .aff file has been read as ISO-8859-1 above, which
+        # can be converted back to the original bytes losslessly:
+        affixes = HunspellAffixes(
+            aff_buffer.encode('ISO-8859-1').decode(
+                dictionary_encoding, errors='ignore'))
+        flags_pattern = re.compile(r'^(?P<word>[^/\t]*)/(?P<flags>[^\s]+)')
+        for line in dic_buffer:
+            match = flags_pattern.match(line)
+            if not match:
+                continue
+            # Apply the rules to the word as it is in the .dic
+            # file, the conditions of the rules usually contain
+            # precomposed characters:
+            word_list += [
+                unicodedata.normalize(NORMALIZATION_FORM_INTERNAL, x)
+                for x in affixes.expand(
+                    match.group('word'),
+                    match.group('flags'),
+                    max_forms=max_affix_forms)]
+        sys.stderr.write(
+            'get_hunspell_dictionary_wordlist(): '
+            + '%s words including affixed forms.\n'
+            %len(word_list))
     return (dic_path, dictionary_encoding, word_list)
 
 def get_ime_help(ime_name):
@@ -3197,6 +3437,91 @@ def xdg_save_data_path(*resource):
         os.makedirs(path)
     return path
 
+class LRUCache:
+    '''A cache holding at most “maxsize” items
+
+    When the cache is full, the least recently used item is discarded
+    to make room for a new item. The numbers of hits, misses and
+    evictions are counted to make it possible to tune the size of
+    the cache.
+
+    Examples:
+
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.keys())
+    ['a', 'c']
+    >>> cache.statistics()
+    {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 1, 'evictions': 1, 'hit_ratio': 0.5}
+    '''
+    def __init__(self, maxsize=1000):
+        self._maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        '''Returns the cached value for key or default if key is
+        not in the cache.
+
+        A successful lookup marks the item as the most recently used.
+        '''
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._items:
+            self._items.move_to_end(key)
+        self._items[key] = value
+        while len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        '''Returns the keys in the cache, least recently used first'''
+        return self._items.keys()
+
+    def clear(self):
+        '''Removes all items from the cache
+
+        The counters are not reset, they describe the whole life time
+        of the cache.
+        '''
+        self._items.clear()
+
+    def statistics(self):
+        '''Returns the size of the cache, the counters and the
+        fraction of the lookups which were hits
+
+        :rtype: Dictionary
+        '''
+        lookups = self.hits + self.misses
+        return {'size': len(self._items),
+                'maxsize': self._maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0}
+
 class KeyEvent:
     '''Key event class used to make the checking of details of the key
     event easy
@@ -22,25 +22,1395 @@ Module for ibus-typing-booster to access the sqlite3 databases
 import os
 import os.path as path
 import sys
-import codecs
 import unicodedata
 import sqlite3
 import time
-import re
 import traceback
+import threading
+import queue
+import collections
+import urllib.request
+import multiprocessing
 import itb_util
-import hunspell_suggest
 
 DEBUG_LEVEL = int(0)
 
-USER_DATABASE_VERSION = '0.65'
+# Since version 0.66, the strings are stored only once in the tokens
+# table and the phrases table refers to them by id. A user database
+# of version 0.65 is migrated in place when it is opened:
+USER_DATABASE_VERSION = '0.66'
+
+# “INSERT … ON CONFLICT DO UPDATE” needs SQLite >= 3.24.0, with older
+# versions a phrase is looked up first and then updated or inserted:
+SQLITE_HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# Phrases learned while typing are queued and written to the user
+# database in one transaction when this many different phrases are
+# pending, or earlier when the engine flushes the queue:
+WRITE_BEHIND_MAX_PENDING = 100
+
+# The WAL is checkpointed after this many phrases have been written
+# since the last checkpoint. The interval adapts between the minimum
+# and the maximum to keep a checkpoint below the target duration
+# (in seconds):
+WAL_CHECKPOINT_MIN_INTERVAL = 50
+WAL_CHECKPOINT_MAX_INTERVAL = 5000
+WAL_CHECKPOINT_TARGET_DURATION = 0.02
+
+# The in-memory n-gram trie needs roughly 800 bytes per row of the user
+# database. It is not used for user databases with more rows:
+NGRAM_TRIE_MAX_ROWS = 300000
+
+# Phrases which have not been used for a long time are pruned from
+# the user database. The frequency of a row is halved for each
+# half-life (in days) since it was used last. The row is removed when
+# this decayed frequency drops below USER_DB_PRUNE_MIN_DECAYED_FREQ,
+# so a phrase typed only once is forgotten after one half-life. If
+# there are still more than USER_DB_MAX_ROWS rows, those with the
+# lowest decayed frequency are removed. Shortcuts, the rows with
+# user_freq >= itb_util.SHORTCUT_USER_FREQ, are always kept.
+# 0 switches the pruning by age respectively by the number of rows
+# off, which is the default, nothing learned is ever forgotten unless
+# the user asks for it (365 days and 200000 rows are sensible values
+# then):
+USER_DB_HALF_LIFE_DAYS = 0
+USER_DB_MAX_ROWS = 0
+USER_DB_PRUNE_MIN_DECAYED_FREQ = 0.5
+# Pruning is done at most once in this many seconds:
+USER_DB_PRUNE_INTERVAL = 24 * 60 * 60
+# How many free pages one step of the incremental vacuum gives back
+# to the file system:
+USER_DB_VACUUM_STEP_PAGES = 256
+# A consistent snapshot of the user database can be written next to
+# it, with this suffix, at most once in USER_DB_BACKUP_INTERVAL seconds
+# while the user is idle. 0 means that no snapshots are written
+# automatically, 24 * 60 * 60 would be a sensible value:
+USER_DB_BACKUP_SUFFIX = '.backup'
+USER_DB_BACKUP_INTERVAL = 0
+# The snapshot is copied this many pages at a time, with a pause of
+# USER_DB_BACKUP_STEP_PAUSE seconds between the steps:
+USER_DB_BACKUP_STEP_PAGES = 256
+USER_DB_BACKUP_STEP_PAUSE = 0.005
+
+# Maximum number of (input_phrase, p_phrase, pp_phrase) lookups whose
+# counts select_words() keeps in its cache. An entry for a short input
+# phrase may hold the counts of thousands of phrases, so this is
+# smaller than the cache of hunspell suggestions. The statistics of the
+# cache are shown in the debug output of the engine:
+SELECT_WORDS_CACHE_SIZE = 200
+
+# The read-only database of n-grams counted in a big corpus (see
+# import_system_db()) is searched with this file name in
+# “~/.local/share/ibus-typing-booster/data” and in the data directory
+# of ibus-typing-booster:
+SYSTEM_DB_FILE_NAME = 'system_ngrams.db'
+
+SYSTEM_DATABASE_VERSION = '1'
+
+# How much of the score of a phrase comes from the system n-grams if
+# the system database has candidates for the input, the rest comes
+# from the user database:
+SYSTEM_NGRAM_WEIGHT = 0.5
+
+# At most this many candidates are taken from each of the unigrams,
+# bigrams and trigrams of the system database:
+SYSTEM_NGRAM_MAX_CANDIDATES = 100
+
+# The best unigram completions of input phrases up to this length are
+# computed by import_system_db(). The prefix ranges of longer input
+# phrases are small enough to be scanned:
+SYSTEM_NGRAM_SHORT_PREFIX_LENGTH = 2
+
+# The system database is memory mapped. The pages are shared with the
+# page cache of the kernel, reading them does not copy them into the
+# page cache of SQLite (which is kept small) nor grow the heap:
+SYSTEM_DB_MMAP_SIZE = 1024 * 1024 * 1024
+SYSTEM_DB_CACHE_SIZE = 100
+
+# import_system_db() inserts the n-grams read into its staging table
+# in batches of this size:
+SYSTEM_DB_IMPORT_BATCH_SIZE = 10000
+
+# When learning from a file, the n-grams are counted in chunks of at
+# most this many different n-grams. Each chunk is merged into the user
+# database in one transaction:
+TRAINING_CHUNK_MAX_NGRAMS = 50000
+
+# When learning from several files or from big files, the files are
+# split into shards of about this many bytes, the n-grams of the
+# shards are counted in parallel by a pool of worker processes:
+TRAINING_SHARD_BYTES = 4 * 1024 * 1024
+
+# How many seconds the writer thread waits for a lock on the user
+# database held by another process, for example by the setup tool
+# while it learns from a file. Waiting does not block typing:
+WRITER_BUSY_TIMEOUT = 60.0
+
+# The query of select_words(), “where” selects the tokens the input
+# phrase can be completed from:
+SELECT_WORDS_SQL = (
+    'SELECT (SELECT text FROM user_db.tokens WHERE id = phrase), '
+    + 'sum(user_freq), '
+    + 'sum(CASE WHEN p_phrase = :p_phrase '
+    + 'THEN user_freq ELSE 0 END), '
+    + 'sum(p_phrase = :p_phrase), '
+    + 'sum(CASE WHEN p_phrase = :p_phrase '
+    + 'AND pp_phrase = :pp_phrase THEN user_freq ELSE 0 END), '
+    + 'sum(p_phrase = :p_phrase AND pp_phrase = :pp_phrase) '
+    + 'FROM user_db.phrases WHERE input_phrase IN '
+    + '(SELECT id FROM user_db.tokens WHERE %(where)s) '
+    + 'GROUP BY phrase;')
+
+def prefix_upper_bound(prefix):
+    '''Returns the smallest string which is greater than all strings
+    starting with prefix, or None if there is no such string
+
+    Together with prefix, this gives a range of strings which can be
+    looked up in an index, “column >= prefix AND column < upper_bound”
+    selects exactly the rows where column starts with prefix.
+
+    :param prefix: The prefix of the strings to select
+    :type prefix: String
+    :rtype: String or None
+
+    Examples:
+
+    >>> prefix_upper_bound('co')
+    'cp'
+
+    >>> prefix_upper_bound('Gl\u00fc')
+    'Gl\xfd'
+
+    >>> prefix_upper_bound('\U0010ffff') is None
+    True
+    '''
+    while prefix:
+        code_point = ord(prefix[-1]) + 1
+        if 0xD800 <= code_point <= 0xDFFF:
+            # Surrogates cannot be encoded in UTF-8, skip them:
+            code_point = 0xE000
+        if code_point <= sys.maxunicode:
+            return prefix[:-1] + chr(code_point)
+        prefix = prefix[:-1]
+    return None
+
+class _NgramTrieNode:
+    '''A node of NgramTrie
+
+    “children” maps the next character of an input phrase to the
+    child node, “rows” holds the frequencies of the rows whose input
+    phrase ends at this node, keyed by (phrase, p_phrase, pp_phrase),
+    and “phrases” maps each phrase in the subtree of this node to
+    [unigram count, unigram rows].
+    '''
+    __slots__ = ('children', 'rows', 'phrases')
+
+    def __init__(self):
+        self.children = {}
+        self.rows = {}
+        self.phrases = {}
+
+class NgramTrie:
+    '''In-memory mirror of the phrases table of the user database
+
+    A trie keyed by the (accent free) input phrases. Each node
+    aggregates the unigram counts of all rows whose input phrase
+    starts with the prefix leading to that node, so the completions
+    of an input phrase are found by a walk down the trie without a
+    scan of the rows.
+
+    The bigram and trigram contexts are kept in a map from
+    (phrase, p_phrase) to the rows with that context, {(pp_phrase,
+    input_phrase): user_freq}. These are only looked up for the
+    phrases found in the trie. (Aggregating the contexts in every
+    node as well would need several times more memory.)
+
+    The counts are sums of user_freq, the rows are the numbers of
+    database rows which were summed.
+
+    Examples:
+
+    (The example from TabSqliteDb.select_words())
+
+    >>> trie = NgramTrie()
+    >>> trie.add('colou', 'colour', 'green', 'nice', 1)
+    >>> trie.add('col', 'colour', 'yellow', 'ugly', 2)
+    >>> trie.add('co', 'colour', 'green', 'awesome', 1)
+    >>> trie.add('co', 'cold', '', '', 1)
+    >>> trie.add('conspirac', 'conspiracy', '', '', 5)
+    >>> trie.add('conspi', 'conspiracy', '', '', 1)
+    >>> trie.add('c', 'conspiracy', '', '', 1)
+    >>> len(trie)
+    7
+    >>> sorted(trie.counts('co', 'green', 'nice'))
+    [('cold', 1, 0, 0, 0, 0), ('colour', 4, 2, 2, 1, 1), ('conspiracy', 6, 0, 0, 0, 0)]
+
+    >>> trie.get('co', 'cold', '', '')
+    1
+    >>> trie.add('co', 'cold', '', '', 2)
+    >>> trie.get('co', 'cold', '', '')
+    3
+    >>> trie.get('co', 'cold', 'x', '') is None
+    True
+
+    >>> trie.remove_phrase('colour')
+    >>> len(trie)
+    4
+    >>> sorted(trie.counts('col', 'green', 'nice'))
+    []
+    >>> sorted(trie.counts('co', 'green', 'nice'))
+    [('cold', 3, 0, 0, 0, 0), ('conspiracy', 6, 0, 0, 0, 0)]
+
+    >>> trie.remove_phrase('conspiracy', input_phrase='conspi')
+    >>> sorted(trie.counts('c', '', ''))
+    [('cold', 3, 3, 1, 3, 1), ('conspiracy', 6, 6, 2, 6, 2)]
+    '''
+    def __init__(self):
+        self._root = _NgramTrieNode()
+        self._contexts = {}
+        self._number_of_rows = 0
+
+    def __len__(self):
+        return self._number_of_rows
+
+    def _find(self, input_phrase):
+        '''Returns the node for input_phrase or None if there is none
+
+        :param input_phrase: The input phrase
+        :type input_phrase: String
+        :rtype: _NgramTrieNode or None
+        '''
+        node = self._root
+        for character in input_phrase:
+            node = node.children.get(character)
+            if node is None:
+                return None
+        return node
+
+    def get(self, input_phrase, phrase, p_phrase, pp_phrase):
+        '''Returns the user_freq of a row or None if there is no such row
+
+        :rtype: Integer or None
+        '''
+        node = self._find(input_phrase)
+        if node is None:
+            return None
+        return node.rows.get((phrase, p_phrase, pp_phrase))
+
+    def add(self, input_phrase, phrase, p_phrase, pp_phrase, increment):
+        '''Increases the user_freq of a row by increment
+
+        The row is added if it does not exist yet.
+
+        :param increment: The increment of user_freq
+        :type increment: Integer
+        '''
+        node = self._root
+        path = [node]
+        for character in input_phrase:
+            child = node.children.get(character)
+            if child is None:
+                child = _NgramTrieNode()
+                node.children[character] = child
+            node = child
+            path.append(node)
+        key = (phrase, p_phrase, pp_phrase)
+        user_freq = node.rows.get(key)
+        row_increment = 0
+        if user_freq is None:
+            user_freq = 0
+            row_increment = 1
+            self._number_of_rows += 1
+        node.rows[key] = user_freq + increment
+        context_key = (phrase, p_phrase)
+        context = self._contexts.get(context_key)
+        if context is None:
+            context = {}
+            self._contexts[context_key] = context
+        context[(pp_phrase, input_phrase)] = user_freq + increment
+        for node in path:
+            unigram = node.phrases.get(phrase)
+            if unigram is None:
+                unigram = [0, 0]
+                node.phrases[phrase] = unigram
+            unigram[0] += increment
+            unigram[1] += row_increment
+
+    def remove(self, input_phrase, phrase, p_phrase, pp_phrase):
+        '''Removes a row
+
+        Nothing happens if there is no such row.
+        '''
+        node = self._root
+        path = [node]
+        for character in input_phrase:
+            node = node.children.get(character)
+            if node is None:
+                return
+            path.append(node)
+        key = (phrase, p_phrase, pp_phrase)
+        if key not in node.rows:
+            return
+        user_freq = node.rows.pop(key)
+        self._number_of_rows -= 1
+        context_key = (phrase, p_phrase)
+        context = self._contexts[context_key]
+        del context[(pp_phrase, input_phrase)]
+        if not context:
+            del self._contexts[context_key]
+        for node in path:
+            unigram = node.phrases[phrase]
+            unigram[0] -= user_freq
+            unigram[1] -= 1
+            if not unigram[1]:
+                del node.phrases[phrase]
+        # Remove the nodes whose subtree has become empty:
+        for index in range(len(input_phrase), 0, -1):
+            if path[index].phrases:
+                break
+            del path[index - 1].children[input_phrase[index - 1]]
+
+    def remove_phrase(self, phrase, input_phrase=None):
+        '''Removes all rows for phrase
+
+        If input_phrase is given, only the rows for that input phrase
+        are removed.
+
+        :param phrase: The phrase to remove
+        :type phrase: String
+        :param input_phrase: The input phrase to remove it for, or None
+                             to remove it for all input phrases
+        :type input_phrase: String or None
+        '''
+        rows = []
+        if input_phrase is not None:
+            node = self._find(input_phrase)
+            if node is None:
+                return
+            rows = [(input_phrase,) + key for key in node.rows
+                    if key[0] == phrase]
+        else:
+            # Only subtrees which contain the phrase need to be
+            # searched:
+            stack = [('', self._root)]
+            while stack:
+                (prefix, node) = stack.pop()
+                rows += [(prefix,) + key for key in node.rows
+                         if key[0] == phrase]
+                for (character, child) in node.children.items():
+                    if phrase in child.phrases:
+                        stack.append((prefix + character, child))
+        for row in rows:
+            self.remove(*row)
+
+    def counts(self, input_phrase, p_phrase, pp_phrase):
+        '''Returns the counts needed to score the completions of
+        input_phrase in the context p_phrase, pp_phrase
+
+        The result is the same as the result of the query in
+        TabSqliteDb.select_words(), a list of tuples
+        (phrase, unigram count, bigram count, bigram rows,
+        trigram count, trigram rows).
+
+        :param input_phrase: The (accent free) input to complete
+        :type input_phrase: String
+        :param p_phrase: The previous word
+        :type p_phrase: String
+        :param pp_phrase: The word before the previous word
+        :type pp_phrase: String
+        :rtype: List of tuples
+        '''
+        node = self._find(input_phrase)
+        if node is None:
+            return []
+        results = []
+        for (phrase, unigram) in node.phrases.items():
+            bigram_count = bigram_rows = trigram_count = trigram_rows = 0
+            context = self._contexts.get((phrase, p_phrase))
+            if context:
+                for ((context_pp_phrase, context_input_phrase),
+                     user_freq) in context.items():
+                    if context_input_phrase.startswith(input_phrase):
+                        bigram_count += user_freq
+                        bigram_rows += 1
+                        if context_pp_phrase == pp_phrase:
+                            trigram_count += user_freq
+                            trigram_rows += 1
+            results.append((phrase, unigram[0], bigram_count, bigram_rows,
+                            trigram_count, trigram_rows))
+        return results
+
+def connect_user_db(user_db_file, timeout=5.0):
+    '''Returns a new connection to the user database
+
+    The database is attached as “user_db” as well, all queries refer
+    to the tables of the user database as “user_db.…”.
+
+    :param user_db_file: The file name of the user database
+    :type user_db_file: String
+    :param timeout: How many seconds to wait for a lock held by
+                    another connection
+    :type timeout: Float
+    :rtype: sqlite3.Connection
+    '''
+    # URIs are allowed to attach the system database read-only:
+    db = sqlite3.connect(user_db_file, timeout=timeout, uri=True)
+    db.executescript('''
+        PRAGMA encoding = "UTF-8";
+        PRAGMA case_sensitive_like = true;
+        PRAGMA page_size = 4096;
+        PRAGMA cache_size = 20000;
+        PRAGMA temp_store = MEMORY;
+        PRAGMA auto_vacuum = INCREMENTAL;
+        PRAGMA journal_mode = WAL;
+        PRAGMA journal_size_limit = 1000000;
+        PRAGMA synchronous = NORMAL;
+        ATTACH DATABASE "%s" AS user_db;
+    ''' % user_db_file)
+    return db
+
+class DatabaseWriter:
+    '''Makes all changes to the user database
+
+    The changes are submitted as calls of the methods of this class.
+    After start_thread(), they are executed one after the other in a
+    thread which has its own connection to the user database, so a
+    slow checkpoint, a VACUUM or a big insert does not block the
+    caller. With the WAL, the connection of the caller can still read
+    while the thread writes. Before start_thread(), the changes are
+    executed immediately, using the connection given to the
+    constructor.
+
+    The methods doing the changes expect normalized phrases. If one of
+    them raises an exception, the open transaction is rolled back.
+    '''
+    def __init__(self, db, user_db_file):
+        '''
+        :param db: The connection to use until start_thread() is called
+        :type db: sqlite3.Connection
+        :param user_db_file: The file name of the user database
+        :type user_db_file: String
+        '''
+        self.db = db
+        self.user_db_file = user_db_file
+        # Batches of updates submitted to write_frequency_updates()
+        # which are not committed yet. Readers hold the lock while
+        # they query the database and look at the batches, so a batch
+        # is never missed or counted twice:
+        self.lock = threading.Lock()
+        self.unwritten_updates = []
+        # Cache of the ids of the strings in the tokens table, as
+        # seen by self.db:
+        self._token_ids = {}
+        self._updates_since_checkpoint = 0
+        self._checkpoint_interval = WAL_CHECKPOINT_MIN_INTERVAL
+        # Incremented whenever tokens are removed. The ids of removed
+        # tokens may be reused, so other connections have to drop
+        # their cached ids then:
+        self.token_generation = 0
+        # The rows removed by prune() as tuples (input_phrase, phrase,
+        # p_phrase, pp_phrase, user_freq), for the in-memory n-gram
+        # trie:
+        self.pruned_rows = []
+        # The number of free pages after the last incremental vacuum:
+        self.free_pages = 0
+        # (pages copied, total pages) while a backup is written,
+        # None otherwise:
+        self.backup_progress = None
+        # Incremented whenever another connection, for example the
+        # one of the setup tool restoring a backup, has changed the
+        # user database:
+        self.external_changes = 0
+        self._data_version = None
+        # The number of changes which failed:
+        self.errors = 0
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start_thread(self):
+        '''Execute the changes in a thread from now on'''
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        '''Runs in the writer thread'''
+        try:
+            self.db = connect_user_db(
+                self.user_db_file, timeout=WRITER_BUSY_TIMEOUT)
+        except:
+            traceback.print_exc()
+            self.db = None
+        self._token_ids = {}
+        while True:
+            (function, args) = self._queue.get()
+            self._execute(function, args)
+            self._queue.task_done()
+
+    def _execute(self, function, args):
+        '''Execute a change and roll it back if it fails'''
+        try:
+            self._check_external_changes()
+            function(*args)
+        except:
+            traceback.print_exc()
+            self.errors += 1
+            try:
+                if self.db.in_transaction:
+                    self.db.rollback()
+            except:
+                traceback.print_exc()
+            # Tokens inserted by the failed transaction are gone:
+            self._token_ids = {}
+
+    def _check_external_changes(self):
+        '''Drop the cached token ids if another connection has
+        changed the user database since the last change made here
+
+        The ids may have been reused for other strings then.
+        '''
+        if self.db is None:
+            return
+        data_version = self.db.execute(
+            'PRAGMA user_db.data_version;').fetchall()[0][0]
+        if (self._data_version is not None
+                and data_version != self._data_version):
+            with self.lock:
+                self.token_generation += 1
+                self.external_changes += 1
+            self._token_ids = {}
+        self._data_version = data_version
+
+    def submit(self, function, *args):
+        '''Execute function(*args), in the writer thread if it is running
+
+        :param function: A method of this class
+        '''
+        if self._thread is None:
+            self._execute(function, args)
+        else:
+            self._queue.put((function, args))
+
+    def is_busy(self):
+        '''Returns whether submitted changes are still waiting to be
+        executed
+
+        :rtype: Boolean
+        '''
+        return self._queue.unfinished_tasks > 0
+
+    def wait(self):
+        '''Wait until all submitted changes have been executed'''
+        if self._thread is not None:
+            self._queue.join()
+
+    def call(self, function, *args):
+        '''Execute function(*args) like submit(), wait for it and
+        return its result
+
+        Returns None if function raised an exception.
+        '''
+        result = []
+        self.submit(lambda: result.append(function(*args)))
+        self.wait()
+        if not result:
+            return None
+        return result[0]
+
+    def get_token_id(self, text):
+        '''Returns the id of a string in the tokens table or 0 if the
+        string is not in the tokens table
+
+        :param text: The string to look up
+        :type text: String
+        :rtype: Integer
+        '''
+        if text in self._token_ids:
+            return self._token_ids[text]
+        result = self.db.execute(
+            'SELECT id FROM user_db.tokens WHERE text = :text;',
+            {'text': text}).fetchall()
+        if not result:
+            return 0
+        self._token_ids[text] = result[0][0]
+        return result[0][0]
+
+    def intern_token(self, text):
+        '''Returns the id of a string in the tokens table and adds the
+        string to the tokens table first if it is not there yet
+
+        :param text: The string to intern
+        :type text: String
+        :rtype: Integer
+        '''
+        token_id = self.get_token_id(text)
+        if token_id:
+            return token_id
+        cursor = self.db.execute(
+            'INSERT INTO user_db.tokens (text) VALUES (:text);',
+            {'text': text})
+        self._token_ids[text] = cursor.lastrowid
+        return cursor.lastrowid
+
+    def executescript(self, sqlstr, commit=True):
+        '''Execute SQL statements which do not need parameters'''
+        self.db.executescript(sqlstr)
+        if commit:
+            self.db.commit()
+
+    def update_phrase(self, input_phrase, phrase, p_phrase, pp_phrase,
+                      user_freq, commit=True):
+        '''Set the user frequency of a phrase'''
+        sqlstr = '''
+        UPDATE user_db.phrases
+        SET user_freq = :user_freq, timestamp = :timestamp
+        WHERE input_phrase = :input_phrase
+         AND phrase = :phrase AND p_phrase = :p_phrase AND pp_phrase = :pp_phrase
+        ;'''
+        sqlargs = {'user_freq': user_freq,
+                   'input_phrase': self.get_token_id(input_phrase),
+                   'phrase': self.get_token_id(phrase),
+                   'p_phrase': self.get_token_id(p_phrase),
+                   'pp_phrase': self.get_token_id(pp_phrase),
+                   'timestamp': time.time()}
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "DatabaseWriter.update_phrase() sqlstr=%s\n" %sqlstr)
+            sys.stderr.write(
+                "DatabaseWriter.update_phrase() sqlargs=%s\n" %sqlargs)
+        self.db.execute(sqlstr, sqlargs)
+        if commit:
+            self.db.commit()
+
+    def add_phrase(self, input_phrase, phrase, p_phrase, pp_phrase,
+                   user_freq, commit=True):
+        '''Add a phrase unless it is already there'''
+        # If there is already such a phrase, add_phrase was called
+        # in error. The primary key of the phrases table makes the
+        # insert do nothing in that case to avoid duplicate entries:
+        sqlstr = '''
+        INSERT OR IGNORE INTO user_db.phrases
+        (input_phrase, phrase, p_phrase, pp_phrase, user_freq, timestamp)
+        VALUES (:input_phrase, :phrase, :p_phrase, :pp_phrase, :user_freq, :timestamp)
+        ;'''
+        sqlargs = {'input_phrase': self.intern_token(input_phrase),
+                   'phrase': self.intern_token(phrase),
+                   'p_phrase': self.intern_token(p_phrase),
+                   'pp_phrase': self.intern_token(pp_phrase),
+                   'user_freq': user_freq,
+                   'timestamp': time.time()}
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "DatabaseWriter.add_phrase() sqlstr=%s\n" %sqlstr)
+            sys.stderr.write(
+                "DatabaseWriter.add_phrase() sqlargs=%s\n" %sqlargs)
+        self.db.execute(sqlstr, sqlargs)
+        if commit:
+            self.db.commit()
+
+    def write_frequency_update(
+            self, input_phrase, phrase, p_phrase, pp_phrase,
+            user_freq_increment, commit=True):
+        '''Increase the frequency of a phrase in the database, or add
+        the phrase if it is not there yet
+        '''
+        if not SQLITE_HAS_UPSERT:
+            self._write_frequency_update_without_upsert(
+                input_phrase, phrase, p_phrase, pp_phrase,
+                user_freq_increment, commit=commit)
+            return
+        # The primary key of the phrases table guarantees that there
+        # is at most one row for input_phrase, phrase, p_phrase and
+        # pp_phrase. If there is none, insert it with user_freq =
+        # user_freq_increment (1 by default), else increase the
+        # user_freq of the existing row by user_freq_increment. All
+        # that in one statement:
+        sqlstr = '''
+        INSERT INTO user_db.phrases
+        (input_phrase, phrase, p_phrase, pp_phrase, user_freq, timestamp)
+        VALUES (:input_phrase, :phrase, :p_phrase, :pp_phrase, :user_freq, :timestamp)
+        ON CONFLICT (input_phrase, phrase, p_phrase, pp_phrase)
+        DO UPDATE SET user_freq = user_freq + :user_freq, timestamp = :timestamp
+        ;'''
+        sqlargs = {'input_phrase': self.intern_token(input_phrase),
+                   'phrase': self.intern_token(phrase),
+                   'p_phrase': self.intern_token(p_phrase),
+                   'pp_phrase': self.intern_token(pp_phrase),
+                   'user_freq': user_freq_increment,
+                   'timestamp': time.time()}
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "DatabaseWriter.write_frequency_update() "
+                + "sqlstr=%s\n" %sqlstr)
+            sys.stderr.write(
+                "DatabaseWriter.write_frequency_update() "
+                + "sqlargs=%s\n" %sqlargs)
+        self.db.execute(sqlstr, sqlargs)
+        if commit:
+            self.db.commit()
+
+    def _write_frequency_update_without_upsert(
+            self, input_phrase, phrase, p_phrase, pp_phrase,
+            user_freq_increment, commit=True):
+        '''
+        Like write_frequency_update() for SQLite versions which do
+        not support “INSERT … ON CONFLICT DO UPDATE”.
+        '''
+        sqlargs = {'input_phrase': self.intern_token(input_phrase),
+                   'phrase': self.intern_token(phrase),
+                   'p_phrase': self.intern_token(p_phrase),
+                   'pp_phrase': self.intern_token(pp_phrase),
+                   'user_freq': user_freq_increment,
+                   'timestamp': time.time()}
+        # Try to increase the user frequency of an existing row by
+        # user_freq_increment (1 by default) first. If there is no
+        # such row, add it with user_freq = user_freq_increment:
+        cursor = self.db.execute('''
+        UPDATE user_db.phrases
+        SET user_freq = user_freq + :user_freq, timestamp = :timestamp
+        WHERE input_phrase = :input_phrase
+        AND phrase = :phrase AND p_phrase = :p_phrase AND pp_phrase = :pp_phrase
+        ;''', sqlargs)
+        if not cursor.rowcount:
+            self.db.execute('''
+            INSERT INTO user_db.phrases
+            (input_phrase, phrase, p_phrase, pp_phrase, user_freq, timestamp)
+            VALUES (:input_phrase, :phrase, :p_phrase, :pp_phrase, :user_freq, :timestamp)
+            ;''', sqlargs)
+        if commit:
+            self.db.commit()
+
+    def write_frequency_updates(self, updates, checkpoint=True):
+        '''Write a batch of frequency updates in a single transaction
+
+        The batch must have been appended to self.unwritten_updates
+        before, it is removed from there when it is committed.
+
+        :param updates: The increments of the frequencies, keyed by
+                        (input_phrase, phrase, p_phrase, pp_phrase)
+        :type updates: Dictionary
+        :param checkpoint: Whether to checkpoint the WAL if enough
+                           updates have been written since the last
+                           checkpoint
+        :type checkpoint: Boolean
+        '''
+        time_start = time.time()
+        try:
+            for ((input_phrase, phrase, p_phrase, pp_phrase),
+                 user_freq_increment) in updates.items():
+                self.write_frequency_update(
+                    input_phrase, phrase, p_phrase, pp_phrase,
+                    user_freq_increment, commit=False)
+            with self.lock:
+                self.db.commit()
+                self.unwritten_updates.remove(updates)
+        except:
+            with self.lock:
+                self.unwritten_updates.remove(updates)
+            raise
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "DatabaseWriter.write_frequency_updates() "
+                + "%s updates written in %.3f s\n"
+                %(len(updates), time.time() - time_start))
+        self._updates_since_checkpoint += len(updates)
+        if (checkpoint
+                and self._updates_since_checkpoint
+                >= self._checkpoint_interval):
+            self._checkpoint_adaptively()
+
+    def _checkpoint_adaptively(self):
+        '''Checkpoint the WAL without waiting for readers and adapt
+        the interval to the next checkpoint
+
+        If the checkpoint took longer than
+        WAL_CHECKPOINT_TARGET_DURATION, checkpoint more often, so that
+        each checkpoint has less to do. If it was much faster, checkpoint
+        less often.
+        '''
+        time_start = time.time()
+        (busy, dummy_log_frames, dummy_checkpointed_frames) = (
+            self.db.execute(
+                'PRAGMA user_db.wal_checkpoint(PASSIVE);').fetchall()[0])
+        duration = time.time() - time_start
+        if busy:
+            # Try again after the next flush:
+            return
+        self._updates_since_checkpoint = 0
+        if duration > WAL_CHECKPOINT_TARGET_DURATION:
+            self._checkpoint_interval = max(
+                WAL_CHECKPOINT_MIN_INTERVAL, self._checkpoint_interval // 2)
+        elif duration < WAL_CHECKPOINT_TARGET_DURATION / 4:
+            self._checkpoint_interval = min(
+                WAL_CHECKPOINT_MAX_INTERVAL, self._checkpoint_interval * 2)
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "DatabaseWriter._checkpoint_adaptively() "
+                + "took %.3f s, " %duration
+                + "next checkpoint after %s updates\n"
+                %self._checkpoint_interval)
+
+    def checkpoint(self):
+        '''Commit and checkpoint the WAL'''
+        self.db.commit()
+        self.db.execute('PRAGMA user_db.wal_checkpoint;').fetchall()
+        self._updates_since_checkpoint = 0
+
+    def remove_phrase(self, input_phrase, phrase, commit=True):
+        '''Remove the rows for phrase, only those for input_phrase
+        unless input_phrase is empty
+        '''
+        if input_phrase:
+            sqlstr = '''
+            DELETE FROM user_db.phrases
+            WHERE input_phrase = :input_phrase AND phrase = :phrase
+            ;'''
+        else:
+            sqlstr = '''
+            DELETE FROM user_db.phrases
+            WHERE phrase = :phrase
+            ;'''
+        sqlargs = {'input_phrase': self.get_token_id(input_phrase),
+                   'phrase': self.get_token_id(phrase)}
+        self.db.execute(sqlstr, sqlargs)
+        if commit:
+            self.db.commit()
+
+    def replace_all_phrases(self, rows):
+        '''Replace all rows of the phrases table
+
+        Returns True when done.
+
+        :param rows: The new rows, dictionaries with the phrases as
+                     strings
+        :type rows: List of dictionaries
+        :rtype: Boolean
+        '''
+        sqlstr = '''
+        INSERT INTO user_db.phrases (input_phrase, phrase, p_phrase, pp_phrase, user_freq, timestamp)
+        VALUES (:input_phrase, :phrase, :p_phrase, :pp_phrase, :user_freq, :timestamp)
+        ;'''
+        self.db.execute('DELETE FROM user_db.phrases;')
+        # Without the following commit, the self.db.executemany() fails
+        # with “OperationalError: database is locked”.
+        self.db.commit()
+        sqlargs = []
+        for row in rows:
+            row = dict(row)
+            for column in ('input_phrase', 'phrase',
+                           'p_phrase', 'pp_phrase'):
+                row[column] = self.intern_token(row[column])
+            sqlargs.append(row)
+        self.db.executemany(sqlstr, sqlargs)
+        self.checkpoint()
+        return True
+
+    def remove_all_phrases(self):
+        '''Remove all phrases and tokens'''
+        self.db.execute('DELETE FROM user_db.phrases;')
+        self.db.execute('DELETE FROM user_db.tokens;')
+        with self.lock:
+            self.db.commit()
+            self.token_generation += 1
+        self._token_ids = {}
+        self.checkpoint()
+
+    def backup(self, backup_file, step_pages, step_pause):
+        '''Write a consistent snapshot of the user database
+
+        The snapshot is written with the backup API of SQLite,
+        step_pages pages at a time, to a temporary file which replaces
+        backup_file when it is complete. As the backup uses the
+        connection of the writer, no other change can make it start
+        over, the changes submitted in the meantime wait until it is
+        done. The snapshot is a single file, not in WAL mode.
+
+        :param backup_file: The file name of the snapshot
+        :type backup_file: String
+        :param step_pages: The number of pages to copy in one step,
+                           -1 to copy all at once
+        :type step_pages: Integer
+        :param step_pause: The number of seconds to sleep between
+                           the steps
+        :type step_pause: Float
+        :rtype: Boolean
+        '''
+        time_start = time.time()
+        self.db.commit()
+        temporary_file = backup_file + '.part'
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        def progress(_status, remaining, total):
+            self.backup_progress = (total - remaining, total)
+            if remaining and step_pause:
+                time.sleep(step_pause)
+        target = sqlite3.connect(temporary_file)
+        try:
+            self.backup_progress = (0, 0)
+            self.db.backup(target, pages=step_pages, progress=progress,
+                           name='user_db')
+            target.execute('PRAGMA journal_mode = DELETE;').fetchall()
+            target.close()
+            os.replace(temporary_file, backup_file)
+        except:
+            target.close()
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+            raise
+        finally:
+            self.backup_progress = None
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "DatabaseWriter.backup(%s) took %.3f s\n"
+                %(backup_file, time.time() - time_start))
+        return True
+
+    def restore(self, backup_file):
+        '''Replace the contents of the user database by a snapshot
+        written by backup()
+
+        The snapshot is copied in a single step, with a connection of
+        its own, so other connections see either the old or the
+        restored contents.
+
+        :param backup_file: The file name of the snapshot
+        :type backup_file: String
+        :rtype: Boolean
+        '''
+        self.db.commit()
+        source = sqlite3.connect(backup_file)
+        try:
+            target = sqlite3.connect(
+                self.user_db_file, timeout=WRITER_BUSY_TIMEOUT)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
+        with self.lock:
+            self.token_generation += 1
+        self._token_ids = {}
+        self.checkpoint()
+        # This change has been taken care of, it is not an external one:
+        self._data_version = self.db.execute(
+            'PRAGMA user_db.data_version;').fetchall()[0][0]
+        return True
+
+    def prune(self, half_life, max_rows):
+        '''Remove the rows which have not been used for a long time
+
+        See USER_DB_HALF_LIFE_DAYS for how the rows are chosen. The
+        tokens which are not used anymore are removed as well.
+
+        A user database created without incremental auto vacuum is
+        converted by a complete VACUUM the first time rows are
+        removed, the free pages can be given back to the file system
+        step by step by incremental_vacuum() from then on.
+
+        :param half_life: The half-life of the frequencies in seconds,
+                          0 to keep all rows as long as there are not
+                          more than max_rows
+        :type half_life: Float
+        :param max_rows: The maximum number of rows to keep, 0 for
+                         no limit
+        :type max_rows: Integer
+        '''
+        time_start = time.time()
+        now = time.time()
+        def decayed_user_freq(user_freq, timestamp):
+            if not half_life or timestamp is None:
+                return user_freq
+            return user_freq * 0.5 ** (max(0.0, now - timestamp) / half_life)
+        self.db.create_function('decayed_user_freq', 2, decayed_user_freq)
+        select_sqlstr = '''
+        SELECT input_phrase_token.text, phrase_token.text,
+        p_phrase_token.text, pp_phrase_token.text, user_freq,
+        input_phrase, phrase, p_phrase, pp_phrase
+        FROM user_db.phrases
+        JOIN user_db.tokens AS input_phrase_token
+        ON input_phrase_token.id = input_phrase
+        JOIN user_db.tokens AS phrase_token
+        ON phrase_token.id = phrase
+        JOIN user_db.tokens AS p_phrase_token
+        ON p_phrase_token.id = p_phrase
+        JOIN user_db.tokens AS pp_phrase_token
+        ON pp_phrase_token.id = pp_phrase
+        WHERE user_freq < :shortcut_user_freq
+        '''
+        delete_sqlstr = '''
+        DELETE FROM user_db.phrases
+        WHERE input_phrase = ? AND phrase = ? AND p_phrase = ? AND pp_phrase = ?
+        ;'''
+        sqlargs = {'shortcut_user_freq': itb_util.SHORTCUT_USER_FREQ,
+                   'min_decayed_user_freq': USER_DB_PRUNE_MIN_DECAYED_FREQ}
+        pruned_rows = []
+        if half_life:
+            pruned_rows += self.db.execute(
+                select_sqlstr
+                + 'AND decayed_user_freq(user_freq, timestamp) '
+                + '< :min_decayed_user_freq;', sqlargs).fetchall()
+            self.db.executemany(
+                delete_sqlstr, [row[5:] for row in pruned_rows])
+        if max_rows:
+            number_of_rows = self.db.execute(
+                'SELECT count(*) FROM user_db.phrases;').fetchall()[0][0]
+            if number_of_rows > max_rows:
+                sqlargs['excess'] = number_of_rows - max_rows
+                excess_rows = self.db.execute(
+                    select_sqlstr
+                    + 'ORDER BY decayed_user_freq(user_freq, timestamp), '
+                    + 'timestamp LIMIT :excess;', sqlargs).fetchall()
+                self.db.executemany(
+                    delete_sqlstr, [row[5:] for row in excess_rows])
+                pruned_rows += excess_rows
+        if not pruned_rows:
+            self.db.commit()
+            return
+        self.db.execute('''
+        DELETE FROM user_db.tokens
+        WHERE id NOT IN (SELECT input_phrase FROM user_db.phrases)
+        AND id NOT IN (SELECT phrase FROM user_db.phrases)
+        AND id NOT IN (SELECT p_phrase FROM user_db.phrases)
+        AND id NOT IN (SELECT pp_phrase FROM user_db.phrases)
+        ;''')
+        with self.lock:
+            self.db.commit()
+            self.token_generation += 1
+            self.pruned_rows += [row[:5] for row in pruned_rows]
+        self._token_ids = {}
+        auto_vacuum = self.db.execute(
+            'PRAGMA user_db.auto_vacuum;').fetchall()[0][0]
+        if auto_vacuum != 2:
+            # 2 is INCREMENTAL
+            self.db.executescript('''
+            PRAGMA user_db.auto_vacuum = INCREMENTAL;
+            VACUUM user_db;
+            ''')
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "DatabaseWriter.prune() %s rows removed in %.3f s\n"
+                %(len(pruned_rows), time.time() - time_start))
+
+    def incremental_vacuum(self, pages):
+        '''Give up to “pages” free pages back to the file system
+
+        Nothing is done for a user database created without
+        incremental auto vacuum, see prune().
+
+        :param pages: The maximum number of pages to free
+        :type pages: Integer
+        '''
+        auto_vacuum = self.db.execute(
+            'PRAGMA user_db.auto_vacuum;').fetchall()[0][0]
+        if auto_vacuum != 2:
+            # 2 is INCREMENTAL
+            self.free_pages = 0
+            return
+        self.db.execute(
+            'PRAGMA user_db.incremental_vacuum(%d);' %pages).fetchall()
+        self.free_pages = self.db.execute(
+            'PRAGMA user_db.freelist_count;').fetchall()[0][0]
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "DatabaseWriter.incremental_vacuum() %s free pages left\n"
+                %self.free_pages)
+
+def _training_shards(filenames):
+    '''Split text files into shards for counting their n-grams in
+    parallel
+
+    Directories are searched recursively for files. The shards of a
+    file are byte ranges of about TRAINING_SHARD_BYTES, a line belongs
+    to the shard where it starts, see _count_training_ngrams().
+
+    :param filenames: Full paths of text files or directories
+    :type filenames: List of strings
+    :rtype: List of tuples (filename, start, end)
+    '''
+    files = []
+    for filename in filenames:
+        if os.path.isdir(filename):
+            for (dirpath, dirnames, walk_filenames) in os.walk(filename):
+                dirnames.sort()
+                files += [os.path.join(dirpath, walk_filename)
+                          for walk_filename in sorted(walk_filenames)]
+        else:
+            files.append(filename)
+    shards = []
+    for filename in files:
+        if not os.path.isfile(filename):
+            continue
+        file_size = os.path.getsize(filename)
+        for start in range(0, file_size, TRAINING_SHARD_BYTES):
+            shards.append(
+                (filename, start,
+                 min(start + TRAINING_SHARD_BYTES, file_size)))
+    return shards
+
+def _count_training_ngrams(shard):
+    '''Count the n-grams in a shard of a text file
+
+    This runs in the worker processes of
+    TabSqliteDb.read_training_data_from_files(), so it must be a
+    module level function.
+
+    The lines starting in the byte range of the shard are counted,
+    the context (the previous two tokens) starts empty at the
+    beginning of the shard.
+
+    :param shard: (filename, start, end) of the byte range
+    :type shard: Tuple
+    :return: The size of the shard in bytes and the counts of the
+             n-grams keyed by (phrase, p_phrase, pp_phrase)
+    :rtype: Tuple (Integer, Dictionary)
+    '''
+    (filename, start, end) = shard
+    counts = {}
+    p_token = ''
+    pp_token = ''
+    with open(filename, 'rb') as file_handle:
+        if start:
+            # Skip the rest of a line started in the previous shard:
+            file_handle.seek(start - 1)
+            file_handle.readline()
+        while file_handle.tell() < end:
+            line = file_handle.readline()
+            if not line:
+                break
+            line = unicodedata.normalize(
+                itb_util.NORMALIZATION_FORM_INTERNAL,
+                line.decode('UTF-8'))
+            for token in itb_util.tokenize(line):
+                key = (token, p_token, pp_token)
+                counts[key] = counts.get(key, 0) + 1
+                pp_token = p_token
+                p_token = token
+    return (end - start, counts)
+
+def _read_system_ngrams(file_handle):
+    '''Yield the n-grams of an ARPA file or of a file of n-gram counts
+
+    An ARPA file is recognized by its first line “\data\”. The weight
+    of an n-gram is then its probability, the backoff weights are
+    ignored. Otherwise each line has an n-gram of one to three words
+    separated by spaces and its count separated by a tab. (Lines with
+    longer n-grams are skipped.)
+
+    N-grams with the ARPA tokens “<s>”, “</s>” or “<unk>” are skipped
+    as well, the user database has no such tokens.
+
+    :param file_handle: The file, opened in binary mode
+    :return: Tuples (words, weight), words is a tuple of up to three
+             normalized strings, the predicted word last
+    '''
+    skip = ('<s>', '</s>', '<unk>')
+    order = 0
+    arpa = None
+    for line in file_handle:
+        line = line.decode('UTF-8').strip()
+        if not line:
+            continue
+        if arpa is None:
+            arpa = line == '\\data\\'
+            if arpa:
+                continue
+        if arpa:
+            if line.startswith('\\'):
+                # “\2-grams:” starts the section of the bigrams:
+                order = 0
+                if line.endswith('-grams:'):
+                    order = int(line[1:-len('-grams:')])
+                continue
+            if not 1 <= order <= 3:
+                continue
+            fields = line.split()
+            if len(fields) < order + 1:
+                continue
+            words = fields[1:order + 1]
+            weight = 10 ** float(fields[0])
+        else:
+            (ngram, dummy_separator, count) = line.rpartition('\t')
+            words = ngram.split()
+            if not 1 <= len(words) <= 3:
+                continue
+            weight = float(count)
+        if any(word in skip for word in words):
+            continue
+        yield (tuple(unicodedata.normalize(
+            itb_util.NORMALIZATION_FORM_INTERNAL, word) for word in words),
+               weight)
+
+def import_system_db(source_file, system_db_file, progress_callback=None):
+    '''Build the read-only database of system n-grams
+
+    The n-grams are read from an ARPA file or a file of counts (see
+    _read_system_ngrams()) and inserted into a staging database in
+    batches, so the memory needed does not depend on the size of the
+    file. SQLite then sorts the tokens and the n-grams on disk:
+
+    The input phrase of a phrase is the phrase in lower case without
+    accents, the completions of an input are found regardless of its
+    case. The ids of the tokens are in the order of their text, so the
+    tokens starting with an input phrase have a contiguous range of
+    ids. The primary key of the n-grams is (p_phrase, pp_phrase,
+    input_phrase, phrase), the completions of an input phrase in a
+    context are a single range of the primary key. Unigrams have ''
+    as p_phrase and pp_phrase, bigrams have '' as pp_phrase.
+
+    The SYSTEM_NGRAM_MAX_CANDIDATES best unigram completions of the
+    input phrases up to SYSTEM_NGRAM_SHORT_PREFIX_LENGTH characters
+    are stored in the completions table, these ranges are too big to
+    be scanned while typing.
+
+    The database is built next to system_db_file and replaces it
+    when complete. A running engine keeps using the file it has
+    opened.
+
+    :param source_file: Full path of the ARPA or counts file
+    :type source_file: String
+    :param system_db_file: Full path of the database to build
+    :type system_db_file: String
+    :param progress_callback: Called with the fraction of the file
+                              read so far, a float between 0.0 and 1.0
+    :type progress_callback: Function or None
+    :rtype: Boolean
+    '''
+    build_file = system_db_file + '.build'
+    staging_file = system_db_file + '.staging'
+    for filename in (build_file, staging_file):
+        if os.path.exists(filename):
+            os.remove(filename)
+    db = None
+    try:
+        file_size = max(1, os.path.getsize(source_file))
+        db = sqlite3.connect(build_file)
+        db.executescript('''
+            PRAGMA page_size = 4096;
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            PRAGMA cache_size = -65536;
+            ATTACH DATABASE "%s" AS staging;
+            PRAGMA staging.journal_mode = OFF;
+            PRAGMA staging.synchronous = OFF;
+            CREATE TABLE staging.ngrams
+            (input_phrase TEXT, phrase TEXT, p_phrase TEXT, pp_phrase TEXT,
+            weight REAL);
+            CREATE TABLE desc (name PRIMARY KEY, value);
+            CREATE TABLE tokens
+            (id INTEGER PRIMARY KEY, text TEXT NOT NULL UNIQUE);
+            CREATE TABLE ngrams
+            (p_phrase INTEGER, pp_phrase INTEGER,
+            input_phrase INTEGER, phrase INTEGER, weight REAL,
+            PRIMARY KEY (p_phrase, pp_phrase, input_phrase, phrase))
+            WITHOUT ROWID;
+            CREATE TABLE completions
+            (prefix TEXT, input_phrase INTEGER, phrase INTEGER, weight REAL,
+            PRIMARY KEY (prefix, input_phrase, phrase))
+            WITHOUT ROWID;
+        ''' % staging_file)
+        insert_sqlstr = 'INSERT INTO staging.ngrams VALUES (?, ?, ?, ?, ?);'
+        batch = []
+        with open(source_file, 'rb') as file_handle:
+            for (words, weight) in _read_system_ngrams(file_handle):
+                phrase = words[-1]
+                input_phrase = unicodedata.normalize(
+                    itb_util.NORMALIZATION_FORM_INTERNAL,
+                    itb_util.remove_accents(phrase).lower())
+                context = ('', '') + words[:-1]
+                batch.append(
+                    (input_phrase, phrase, context[-1], context[-2], weight))
+                if len(batch) >= SYSTEM_DB_IMPORT_BATCH_SIZE:
+                    db.executemany(insert_sqlstr, batch)
+                    batch = []
+                    if progress_callback:
+                        progress_callback(file_handle.tell() / file_size)
+        db.executemany(insert_sqlstr, batch)
+        db.executescript('''
+            INSERT INTO tokens (id, text)
+            SELECT row_number() OVER (ORDER BY text), text FROM
+            (SELECT '' AS text
+            UNION SELECT input_phrase FROM staging.ngrams
+            UNION SELECT phrase FROM staging.ngrams
+            UNION SELECT p_phrase FROM staging.ngrams
+            UNION SELECT pp_phrase FROM staging.ngrams);
+            INSERT INTO ngrams
+            SELECT (SELECT id FROM tokens WHERE text = p_phrase) AS p,
+            (SELECT id FROM tokens WHERE text = pp_phrase) AS pp,
+            (SELECT id FROM tokens WHERE text = input_phrase) AS i,
+            (SELECT id FROM tokens WHERE text = phrase) AS ph,
+            sum(weight)
+            FROM staging.ngrams GROUP BY p, pp, i, ph ORDER BY p, pp, i, ph;
+        ''')
+        empty_id = db.execute(
+            "SELECT id FROM tokens WHERE text = '';").fetchall()[0][0]
+        for length in range(SYSTEM_NGRAM_SHORT_PREFIX_LENGTH + 1):
+            db.execute(
+                'INSERT INTO completions '
+                + 'SELECT prefix, input_phrase, phrase, weight FROM '
+                + '(SELECT substr(text, 1, :length) AS prefix, '
+                + 'input_phrase, phrase, weight, row_number() OVER '
+                + '(PARTITION BY substr(text, 1, :length) '
+                + 'ORDER BY weight DESC) AS rank '
+                + 'FROM ngrams JOIN tokens ON id = input_phrase '
+                + 'WHERE p_phrase = :empty AND pp_phrase = :empty '
+                + 'AND length(text) >= :length) '
+                + 'WHERE rank <= :limit;',
+                {'length': length, 'empty': empty_id,
+                 'limit': SYSTEM_NGRAM_MAX_CANDIDATES})
+        db.execute('INSERT INTO desc VALUES (?, ?);',
+                   ('version', SYSTEM_DATABASE_VERSION))
+        db.execute(
+            'INSERT INTO desc VALUES (?, DATETIME("now", "localtime"));',
+            ('create-time',))
+        db.execute('INSERT INTO desc VALUES (?, ?);',
+                   ('source', os.path.basename(source_file)))
+        db.commit()
+        db.execute('DETACH DATABASE staging;')
+        db.close()
+        db = None
+        os.replace(build_file, system_db_file)
+    except:
+        traceback.print_exc()
+        if db:
+            db.close()
+        if os.path.exists(build_file):
+            os.remove(build_file)
+        return False
+    finally:
+        if os.path.exists(staging_file):
+            os.remove(staging_file)
+    if progress_callback:
+        progress_callback(1.0)
+    return True
+
+def _user_db_path(user_db_file):
+    '''Returns the file name of the user database
+
+    :param user_db_file: The file name of the user database,
+                         ':memory:' for an in-memory database,
+                         or '' for the default location
+    :type user_db_file: String
+    :rtype: String
+    '''
+    if user_db_file:
+        return user_db_file
+    return path.join(
+        os.getenv('HOME'), '.local/share/ibus-typing-booster/user.db')
 
 class TabSqliteDb:
     '''Phrase databases for ibus-typing-booster
 
     The phrases table in the database has columns with the names:
 
-    “id”, “input_phrase”, “phrase”, “p_phrase”, “pp_phrase”, “user_freq”, “timestamp”
+    “input_phrase”, “phrase”, “p_phrase”, “pp_phrase”, “user_freq”, “timestamp”
+
+    “input_phrase”, “phrase”, “p_phrase” and “pp_phrase” are ids of
+    rows in the tokens table, which has the columns “id” and “text”.
+    Each string is stored only once in the tokens table, no matter
+    how many phrases and contexts it appears in. These four columns
+    are the primary key of the phrases table.
 
     There are 2 databases, sysdb, userdb.
 
@@ -54,10 +1424,37 @@ class TabSqliteDb:
         ibus-table, in ibus-table “sysdb” is a Sqlite3 database
         which is installed systemwide and readonly for the user)
 
+    system_db: Optional read-only database with n-grams counted in a
+        big corpus, built by import_system_db(). It makes predictions
+        from the context possible before the user has typed much.
+        It is attached as “system_db” and memory mapped.
+
     user_db: Database on disk where the phrases learned from the user are stored
         user_freq >= 1: The number of times the user has used this phrase
     '''
-    def __init__(self, user_db_file=''):
+    def __init__(self, user_db_file='', ngram_trie=False,
+                 writer_thread=False, system_db_file=None):
+        '''
+        :param user_db_file: The file name of the user database,
+                             ':memory:' for an in-memory database,
+                             or '' for the default location
+        :type user_db_file: String
+        :param system_db_file: The file name of the system n-gram
+                               database, '' to search for it in the
+                               default locations, None for no
+                               system n-grams
+        :type system_db_file: String or None
+        :param ngram_trie: Whether to mirror the user database in an
+                           NgramTrie and serve select_words() from it
+        :type ngram_trie: Boolean
+        :param writer_thread: Whether to make the changes to the user
+                              database in a separate thread with its
+                              own connection. Then self.db is only used
+                              for reading. (An in-memory database
+                              cannot be shared between connections,
+                              it is always changed directly.)
+        :type writer_thread: Boolean
+        '''
         global DEBUG_LEVEL
         try:
             DEBUG_LEVEL = int(os.getenv('IBUS_TYPING_BOOSTER_DEBUG_LEVEL'))
@@ -66,15 +1463,11 @@ class TabSqliteDb:
         if DEBUG_LEVEL > 1:
             sys.stderr.write(
                 "TabSqliteDb.__init__(user_db_file = %s)\n" %user_db_file)
-        self.user_db_file = user_db_file
-        if not self.user_db_file:
-            self.user_db_file = path.join(
-                os.getenv('HOME'), '.local/share/ibus-typing-booster/user.db')
+        self.user_db_file = _user_db_path(user_db_file)
         if (self.user_db_file != ':memory:'
                 and not os.path.isdir(os.path.dirname(self.user_db_file))):
             os.makedirs(os.path.dirname(self.user_db_file))
         self._phrase_table_column_names = [
-            'id',
             'input_phrase',
             'phrase',
             'p_phrase',
@@ -83,8 +1476,52 @@ class TabSqliteDb:
             'timestamp']
 
         self.old_phrases = []
+        migrate_from_0_65 = False
+
+        # Cache of the ids of the strings in the tokens table, valid
+        # as long as the writer has not removed tokens:
+        self._token_ids = {}
+        self._token_generation = 0
+        # “PRAGMA data_version” of self.db when the user database
+        # was read the last time:
+        self._data_version = None
+
+        # When the user database was pruned the last time:
+        self._last_prune_time = 0.0
+
+        # When the last snapshot of the user database was written:
+        self._last_backup_time = 0.0
+        if (self.user_db_file != ':memory:'
+                and os.path.exists(self.user_db_file + USER_DB_BACKUP_SUFFIX)):
+            self._last_backup_time = os.path.getmtime(
+                self.user_db_file + USER_DB_BACKUP_SUFFIX)
+
+        # The value of self._writer.external_changes when the
+        # in-memory n-gram trie was loaded:
+        self._external_changes = 0
 
-        self.hunspell_obj = hunspell_suggest.Hunspell(())
+        # In-memory mirror of the phrases table, if used:
+        self._ngram_trie = None
+
+        # The ids of '' and of the last token in the system database
+        # and its full path, if one is attached:
+        self._system_db_token_ids = None
+        self._system_db_file = None
+
+        # Cache of the counts found by select_words(). The keys start
+        # with the generation of the user database when the counts
+        # were found, so a change only needs to increase
+        # self._generation and the outdated entries are not found
+        # anymore (and are evicted eventually):
+        self._select_words_cache = itb_util.LRUCache(
+            maxsize=SELECT_WORDS_CACHE_SIZE)
+        self._generation = 0
+
+        # Frequency increments queued by queue_frequency_update() but
+        # not yet written to user_db. The keys are tuples
+        # (input_phrase, phrase, p_phrase, pp_phrase), the values
+        # are the sums of the increments:
+        self._pending_updates = {}
 
         if self.user_db_file != ':memory:':
             if not os.path.exists(self.user_db_file):
@@ -94,7 +1531,17 @@ class TabSqliteDb:
             else:
                 try:
                     desc = self.get_database_desc(self.user_db_file)
-                    if (desc is None
+                    if (desc is not None
+                            and desc["version"] == '0.65'
+                            and (self.get_number_of_columns_of_phrase_table(
+                                self.user_db_file) == 7)):
+                        sys.stderr.write(
+                            "The user database %(udb)s "
+                            %{'udb': self.user_db_file}
+                            + "has version 0.65, it will be migrated "
+                            + "to version %s.\n" %USER_DATABASE_VERSION)
+                        migrate_from_0_65 = True
+                    elif (desc is None
                             or desc["version"] != USER_DATABASE_VERSION
                             or (self.get_number_of_columns_of_phrase_table(
                                 self.user_db_file)
@@ -171,18 +1618,9 @@ class TabSqliteDb:
             sys.stderr.write(
                 "Connect to the database %(name)s.\n"
                 %{'name': self.user_db_file})
-            self.db = sqlite3.connect(self.user_db_file)
-            self.db.executescript('''
-                PRAGMA encoding = "UTF-8";
-                PRAGMA case_sensitive_like = true;
-                PRAGMA page_size = 4096;
-                PRAGMA cache_size = 20000;
-                PRAGMA temp_store = MEMORY;
-                PRAGMA journal_mode = WAL;
-                PRAGMA journal_size_limit = 1000000;
-                PRAGMA synchronous = NORMAL;
-                ATTACH DATABASE "%s" AS user_db;
-            ''' % self.user_db_file)
+            self.db = connect_user_db(self.user_db_file)
+            if migrate_from_0_65:
+                self.migrate_from_0_65()
         except:
             sys.stderr.write(
                 "Could not open the database %(name)s.\n"
@@ -203,39 +1641,33 @@ class TabSqliteDb:
                 "Creating a new, empty database \"%(name)s\".\n"
                 %{'name': self.user_db_file})
             self.init_user_db()
-            self.db = sqlite3.connect(self.user_db_file)
-            self.db.executescript('''
-                PRAGMA encoding = "UTF-8";
-                PRAGMA case_sensitive_like = true;
-                PRAGMA page_size = 4096;
-                PRAGMA cache_size = 20000;
-                PRAGMA temp_store = MEMORY;
-                PRAGMA journal_mode = WAL;
-                PRAGMA journal_size_limit = 1000000;
-                PRAGMA synchronous = NORMAL;
-                ATTACH DATABASE "%s" AS user_db;
-            ''' % self.user_db_file)
+            self.db = connect_user_db(self.user_db_file)
         self.create_tables()
+        self.generate_userdb_desc()
+
+        # All further changes go through the writer:
+        self._writer = DatabaseWriter(self.db, self.user_db_file)
+        if writer_thread and self.user_db_file != ':memory:':
+            self.db.execute('PRAGMA query_only = true;')
+            self._writer.start_thread()
+
         if self.old_phrases:
-            sqlargs = []
-            for ophrase in self.old_phrases:
-                sqlargs.append(
-                    {'input_phrase': ophrase[0],
-                     'phrase': ophrase[0],
+            # Different phrases of the old database may be equal after
+            # normalization, add up their frequencies:
+            old_phrase_frequencies = {}
+            for (ophrase, user_freq) in self.old_phrases:
+                old_phrase_frequencies[ophrase] = (
+                    old_phrase_frequencies.get(ophrase, 0) + user_freq)
+            rows = []
+            for ophrase in old_phrase_frequencies:
+                rows.append(
+                    {'input_phrase': ophrase,
+                     'phrase': ophrase,
                      'p_phrase': '',
                      'pp_phrase': '',
-                     'user_freq': ophrase[1],
+                     'user_freq': old_phrase_frequencies[ophrase],
                      'timestamp': time.time()})
-            sqlstr = '''
-            INSERT INTO user_db.phrases (input_phrase, phrase, p_phrase, pp_phrase, user_freq, timestamp)
-            VALUES (:input_phrase, :phrase, :p_phrase, :pp_phrase, :user_freq, :timestamp)
-            ;'''
-            try:
-                self.db.executemany(sqlstr, sqlargs)
-            except:
-                traceback.print_exc()
-            self.db.commit()
-            self.db.execute('PRAGMA wal_checkpoint;')
+            self._writer.call(self._writer.replace_all_phrases, rows)
 
         # do not call this always on intialization for the moment.
         # It makes the already slow “python engine/main.py --xml”
@@ -252,7 +1684,357 @@ class TabSqliteDb:
 
         # try create all hunspell-tables in user database
         self.create_indexes(commit=False)
-        self.generate_userdb_desc()
+
+        if ngram_trie:
+            self.load_ngram_trie()
+
+        if system_db_file is not None:
+            self.attach_system_db(system_db_file)
+
+    def attach_system_db(self, system_db_file=''):
+        '''Attach the read-only database of system n-grams
+
+        It is opened read-only and immutable: import_system_db()
+        never changes an existing file but replaces it, the attached
+        file stays valid until it is detached.
+
+        :param system_db_file: The file name of the database, '' to
+                               search for SYSTEM_DB_FILE_NAME in
+                               “~/.local/share/ibus-typing-booster/data”
+                               and in the data directory
+        :type system_db_file: String
+        :return: Whether a system database has been attached
+        :rtype: Boolean
+        '''
+        if (system_db_file
+                and self._system_db_token_ids is not None
+                and path.abspath(system_db_file) == self._system_db_file):
+            # Already attached, for example by another engine sharing
+            # this database:
+            return True
+        self.detach_system_db()
+        if not system_db_file:
+            for dirname in (
+                    itb_util.xdg_save_data_path('ibus-typing-booster/data'),
+                    path.join(path.dirname(__file__), '../data')):
+                if path.isfile(path.join(dirname, SYSTEM_DB_FILE_NAME)):
+                    system_db_file = path.join(dirname, SYSTEM_DB_FILE_NAME)
+                    break
+        if not system_db_file or not path.isfile(system_db_file):
+            if DEBUG_LEVEL > 1:
+                sys.stderr.write(
+                    "TabSqliteDb.attach_system_db() no system database\n")
+            return False
+        try:
+            self.db.execute(
+                'ATTACH DATABASE ? AS system_db;',
+                ('file:%s?mode=ro&immutable=1'
+                 %urllib.request.pathname2url(path.abspath(system_db_file)),))
+            self.db.executescript('''
+                PRAGMA system_db.mmap_size = %(mmap_size)d;
+                PRAGMA system_db.cache_size = %(cache_size)d;
+            ''' %{'mmap_size': SYSTEM_DB_MMAP_SIZE,
+                  'cache_size': SYSTEM_DB_CACHE_SIZE})
+            version = self.db.execute(
+                'SELECT value FROM system_db.desc WHERE name = ?;',
+                ('version',)).fetchall()
+            if not version or version[0][0] != SYSTEM_DATABASE_VERSION:
+                sys.stderr.write(
+                    "The system database %s has the wrong version.\n"
+                    %system_db_file)
+                self.db.execute('DETACH DATABASE system_db;')
+                return False
+            self._system_db_token_ids = self.db.execute(
+                "SELECT (SELECT id FROM system_db.tokens WHERE text = ''), "
+                + 'max(id) FROM system_db.tokens;').fetchall()[0]
+        except:
+            traceback.print_exc()
+            try:
+                self.db.execute('DETACH DATABASE system_db;')
+            except sqlite3.OperationalError:
+                pass
+            return False
+        self._system_db_file = path.abspath(system_db_file)
+        self._generation += 1
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "TabSqliteDb.attach_system_db() %s attached\n"
+                %system_db_file)
+        return True
+
+    def detach_system_db(self):
+        '''Detach the database of system n-grams, if one is attached
+
+        select_words() uses only the user database then.
+        '''
+        if self._system_db_token_ids is None:
+            return
+        try:
+            self.db.execute('DETACH DATABASE system_db;')
+        except:
+            traceback.print_exc()
+        self._system_db_token_ids = None
+        self._system_db_file = None
+        self._generation += 1
+
+    def run_maintenance_step(self, half_life_days=USER_DB_HALF_LIFE_DAYS,
+                             max_rows=USER_DB_MAX_ROWS,
+                             backup_interval=USER_DB_BACKUP_INTERVAL):
+        '''Do a small step of the maintenance of the user database
+
+        Meant to be called repeatedly while the user is idle. If
+        half_life_days or max_rows is set, the rows which have not
+        been used for a long time are pruned once every
+        USER_DB_PRUNE_INTERVAL seconds. Otherwise, the free pages
+        are given back to the file system, USER_DB_VACUUM_STEP_PAGES
+        pages at a time. When that is done, a snapshot of the user
+        database is written once every backup_interval seconds, see
+        backup_user_db().
+
+        If another process, for example the setup tool, has changed
+        the user database, the in-memory n-gram trie is reloaded.
+
+        Returns True if there is more to do.
+
+        :param half_life_days: The half-life of the frequencies in days,
+                               0 to never forget phrases because
+                               they are old
+        :type half_life_days: Integer
+        :param max_rows: The maximum number of rows to keep, 0 for
+                         no limit
+        :type max_rows: Integer
+        :param backup_interval: The time between two snapshots in
+                                seconds, 0 to write no snapshots
+        :type backup_interval: Integer
+        :rtype: Boolean
+        '''
+        self._apply_pruned_rows()
+        if self._writer.is_busy():
+            # Try again when the previous step is done:
+            return True
+        if self._writer.external_changes != self._external_changes:
+            self._external_changes = self._writer.external_changes
+            self._generation += 1
+            if self._ngram_trie is not None:
+                self.load_ngram_trie()
+            return True
+        if ((half_life_days or max_rows)
+                and time.time() - self._last_prune_time
+                > USER_DB_PRUNE_INTERVAL):
+            self._last_prune_time = time.time()
+            self.flush_pending_updates()
+            self._writer.submit(
+                self._writer.prune, half_life_days * 24 * 60 * 60, max_rows)
+            self._writer.submit(
+                self._writer.incremental_vacuum, USER_DB_VACUUM_STEP_PAGES)
+            return True
+        if self._writer.free_pages:
+            self._writer.submit(
+                self._writer.incremental_vacuum, USER_DB_VACUUM_STEP_PAGES)
+            return True
+        if (backup_interval > 0
+                and self.user_db_file != ':memory:'
+                and time.time() - self._last_backup_time
+                > backup_interval):
+            self.backup_user_db()
+            return True
+        return False
+
+    def backup_user_db(self, backup_file='',
+                       step_pages=USER_DB_BACKUP_STEP_PAGES, wait=False):
+        '''Write a consistent snapshot of the user database
+
+        Unlike a copy of the files of the database, this is safe while
+        the database is in use. With a writer thread and wait=False,
+        this returns immediately and the snapshot is written in the
+        background, step_pages pages at a time, see
+        get_backup_progress().
+
+        With wait=True, returns whether the snapshot has been written.
+
+        :param backup_file: The file name of the snapshot, '' for the
+                            file name of the user database with
+                            USER_DB_BACKUP_SUFFIX appended
+        :type backup_file: String
+        :param step_pages: The number of pages to copy in one step,
+                           -1 to copy all at once
+        :type step_pages: Integer
+        :param wait: Whether to wait until the snapshot is written
+        :type wait: Boolean
+        :rtype: Boolean or None
+        '''
+        if not backup_file:
+            backup_file = self.user_db_file + USER_DB_BACKUP_SUFFIX
+        self._last_backup_time = time.time()
+        self.flush_pending_updates(checkpoint=False)
+        args = (backup_file, step_pages,
+                USER_DB_BACKUP_STEP_PAUSE if step_pages > 0 else 0.0)
+        if wait:
+            return bool(self._writer.call(self._writer.backup, *args))
+        self._writer.submit(self._writer.backup, *args)
+        return None
+
+    def get_backup_progress(self):
+        '''Returns (pages copied, total pages) while a snapshot of the
+        user database is written, None otherwise
+
+        :rtype: Tuple of integers or None
+        '''
+        return self._writer.backup_progress
+
+    def restore_user_db(self, backup_file=''):
+        '''Replace the contents of the user database by a snapshot
+        written by backup_user_db()
+
+        The snapshot is checked first, the user database is not
+        changed if it is damaged, has the wrong version or a page size
+        or journal mode which cannot be restored into the user
+        database.
+
+        Returns True if the snapshot has been restored.
+
+        :param backup_file: The file name of the snapshot, '' for the
+                            file name of the user database with
+                            USER_DB_BACKUP_SUFFIX appended
+        :type backup_file: String
+        :rtype: Boolean
+        '''
+        if self.user_db_file == ':memory:':
+            return False
+        if not backup_file:
+            backup_file = self.user_db_file + USER_DB_BACKUP_SUFFIX
+        desc = self.get_database_desc(backup_file)
+        if (desc is None
+                or desc.get('version') != USER_DATABASE_VERSION
+                or (self.get_number_of_columns_of_phrase_table(backup_file)
+                    != len(self._phrase_table_column_names))):
+            sys.stderr.write(
+                "%(name)s is not a compatible backup of the user database.\n"
+                %{'name': backup_file})
+            return False
+        try:
+            db = sqlite3.connect(backup_file)
+            check = db.execute('PRAGMA quick_check;').fetchall()
+            page_size = db.execute('PRAGMA page_size;').fetchall()[0][0]
+            journal_mode = db.execute(
+                'PRAGMA journal_mode;').fetchall()[0][0].lower()
+            db.close()
+            user_db_page_size = self.db.execute(
+                'PRAGMA user_db.page_size;').fetchall()[0][0]
+        except:
+            traceback.print_exc()
+            return False
+        if check != [('ok',)]:
+            sys.stderr.write(
+                "The backup %(name)s is damaged: %(check)s\n"
+                %{'name': backup_file, 'check': check})
+            return False
+        # The user database is in WAL mode, where SQLite cannot change
+        # the page size, so the backup would fail half way. A snapshot
+        # in WAL mode may lack the pages still in its -wal file,
+        # backup_user_db() always writes a rollback journal snapshot:
+        if page_size != user_db_page_size or journal_mode == 'wal':
+            sys.stderr.write(
+                "The backup %(name)s has page_size=%(page_size)s "
+                "journal_mode=%(journal_mode)s, "
+                "the user database needs page_size=%(user_db_page_size)s "
+                "and a rollback journal.\n"
+                %{'name': backup_file, 'page_size': page_size,
+                  'journal_mode': journal_mode,
+                  'user_db_page_size': user_db_page_size})
+            return False
+        self.flush_pending_updates()
+        if not self._writer.call(self._writer.restore, backup_file):
+            return False
+        self._external_changes = self._writer.external_changes
+        self._generation += 1
+        if self._ngram_trie is not None:
+            self.load_ngram_trie()
+        return True
+
+    def _apply_pruned_rows(self):
+        '''Remove the rows pruned by the writer from the in-memory
+        n-gram trie
+
+        A pruned row may have been learned again in the meantime, then
+        only the pruned frequency is subtracted.
+        '''
+        if not self._writer.pruned_rows:
+            return
+        with self._writer.lock:
+            pruned_rows = self._writer.pruned_rows
+            self._writer.pruned_rows = []
+        if self._ngram_trie is None:
+            return
+        for (input_phrase, phrase, p_phrase, pp_phrase,
+             user_freq) in pruned_rows:
+            trie_user_freq = self._ngram_trie.get(
+                input_phrase, phrase, p_phrase, pp_phrase)
+            if trie_user_freq is None:
+                continue
+            if trie_user_freq <= user_freq:
+                self._ngram_trie.remove(
+                    input_phrase, phrase, p_phrase, pp_phrase)
+            else:
+                self._ngram_trie.add(
+                    input_phrase, phrase, p_phrase, pp_phrase, -user_freq)
+
+    def _submit_change(self, function, *args):
+        '''Make a change to the user database with the writer
+
+        Without the in-memory n-gram trie, select_words() reads the
+        database, so wait until the change has been made. Only
+        changes which are rare while typing use this, the learned
+        phrases are queued.
+
+        :param function: A method of self._writer
+        '''
+        self._writer.submit(function, *args)
+        if self._ngram_trie is None:
+            self._writer.wait()
+
+    def load_ngram_trie(self):
+        '''(Re)load the in-memory n-gram trie from the user database
+
+        If the user database has more than NGRAM_TRIE_MAX_ROWS rows,
+        no trie is used and select_words() queries the database.
+        '''
+        self.flush_pending_updates()
+        self._writer.wait()
+        # The rows pruned so far are not loaded anyway:
+        with self._writer.lock:
+            self._writer.pruned_rows = []
+        self._generation += 1
+        self._ngram_trie = None
+        time_start = time.time()
+        try:
+            number_of_rows = self.db.execute(
+                'SELECT count(*) FROM user_db.phrases;').fetchall()[0][0]
+            if number_of_rows > NGRAM_TRIE_MAX_ROWS:
+                sys.stderr.write(
+                    "The user database has %s rows, " %number_of_rows
+                    + "too many for the in-memory n-gram trie.\n")
+                return
+            # Each string is created only once here and shared by all
+            # nodes of the trie which use it:
+            tokens = dict(self.db.execute(
+                'SELECT id, text FROM user_db.tokens;').fetchall())
+            ngram_trie = NgramTrie()
+            for (input_phrase, phrase, p_phrase, pp_phrase,
+                 user_freq) in self.db.execute(
+                     'SELECT input_phrase, phrase, p_phrase, pp_phrase, '
+                     + 'user_freq FROM user_db.phrases;').fetchall():
+                ngram_trie.add(tokens[input_phrase], tokens[phrase],
+                               tokens[p_phrase], tokens[pp_phrase],
+                               user_freq)
+            self._ngram_trie = ngram_trie
+        except:
+            traceback.print_exc()
+            return
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                "TabSqliteDb.load_ngram_trie() %s rows loaded in %.3f s\n"
+                %(len(self._ngram_trie), time.time() - time_start))
 
     def update_phrase(self, input_phrase='', phrase='',
                       p_phrase='', pp_phrase='',
@@ -271,54 +2053,166 @@ class TabSqliteDb:
             itb_util.NORMALIZATION_FORM_INTERNAL, p_phrase)
         pp_phrase = unicodedata.normalize(
             itb_util.NORMALIZATION_FORM_INTERNAL, pp_phrase)
-        sqlstr = '''
-        UPDATE user_db.phrases
-        SET user_freq = :user_freq, timestamp = :timestamp
-        WHERE input_phrase = :input_phrase
-         AND phrase = :phrase AND p_phrase = :p_phrase AND pp_phrase = :pp_phrase
-        ;'''
-        sqlargs = {'user_freq': user_freq,
-                   'input_phrase': input_phrase,
-                   'phrase': phrase,
-                   'p_phrase': p_phrase,
-                   'pp_phrase': pp_phrase,
-                   'timestamp': time.time()}
-        if DEBUG_LEVEL > 1:
-            sys.stderr.write(
-                "TabSqliteDb.update_phrase() sqlstr=%s\n" %sqlstr)
-            sys.stderr.write(
-                "TabSqliteDb.update_phrase() sqlargs=%s\n" %sqlargs)
-        try:
-            self.db.execute(sqlstr, sqlargs)
-            if commit:
-                self.db.commit()
-        except:
-            traceback.print_exc()
+        # Queued increments would be added to the new user_freq later:
+        self.flush_pending_updates()
+        if self._ngram_trie is not None:
+            old_user_freq = self._ngram_trie.get(
+                input_phrase, phrase, p_phrase, pp_phrase)
+            if old_user_freq is not None:
+                self._ngram_trie.add(
+                    input_phrase, phrase, p_phrase, pp_phrase,
+                    user_freq - old_user_freq)
+        self._generation += 1
+        self._submit_change(
+            self._writer.update_phrase,
+            input_phrase, phrase, p_phrase, pp_phrase, user_freq, commit)
 
     def sync_usrdb(self):
         '''
-        Trigger a checkpoint operation.
+        Write the queued updates and trigger a checkpoint operation.
+
+        Waits until the writer has done that.
         '''
         if DEBUG_LEVEL > 1:
             sys.stderr.write(
                 "TabSqliteDb.sync_userdb() "
                 + "commit and execute checkpoint ...\n")
-        self.db.commit()
-        self.db.execute('PRAGMA wal_checkpoint;')
+        self.flush_pending_updates(checkpoint=False)
+        self._writer.submit(self._writer.checkpoint)
+        self._writer.wait()
         if DEBUG_LEVEL > 1:
             sys.stderr.write(
                 "TabSqliteDb.sync_userdb() "
                 + "commit and execute checkpoint done.\n")
 
     def create_tables(self):
-        '''Create table for the phrases.'''
-        sqlstr = '''CREATE TABLE IF NOT EXISTS user_db.phrases
-                    (id INTEGER PRIMARY KEY,
-                    input_phrase TEXT, phrase TEXT, p_phrase TEXT, pp_phrase TEXT,
-                    user_freq INTEGER, timestamp REAL);'''
-        self.db.execute(sqlstr)
+        '''Create the tables for the tokens and the phrases.'''
+        sqlstr = '''
+        CREATE TABLE IF NOT EXISTS user_db.tokens
+        (id INTEGER PRIMARY KEY, text TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS user_db.phrases
+        (input_phrase INTEGER, phrase INTEGER,
+        p_phrase INTEGER, pp_phrase INTEGER,
+        user_freq INTEGER, timestamp REAL,
+        PRIMARY KEY (input_phrase, phrase, p_phrase, pp_phrase))
+        WITHOUT ROWID;'''
+        self.db.executescript(sqlstr)
         self.db.commit()
 
+    def migrate_from_0_65(self):
+        '''Migrate a user database of version 0.65 in place
+
+        In version 0.65, the phrases table stored the strings in each
+        row. They are moved into the tokens table and replaced by
+        their ids. Rows which are duplicates of each other are merged
+        into one row. That row gets the highest user_freq of the
+        duplicates, not the sum, because check_phrase_and_update_frequency()
+        used to set all duplicates to the same increased user_freq.
+        All rows are kept, including the context.
+
+        If the migration fails, the database is left unchanged and an
+        exception is raised.
+        '''
+        sys.stderr.write(
+            "Migrating the user database %(name)s to version %(version)s.\n"
+            %{'name': self.user_db_file, 'version': USER_DATABASE_VERSION})
+        time_start = time.time()
+        sqlstr = '''
+        BEGIN;
+        ALTER TABLE user_db.phrases RENAME TO phrases_0_65;
+        CREATE TABLE user_db.tokens
+        (id INTEGER PRIMARY KEY, text TEXT NOT NULL UNIQUE);
+        INSERT OR IGNORE INTO user_db.tokens (text)
+        SELECT ifnull(input_phrase, '') FROM user_db.phrases_0_65
+        UNION SELECT ifnull(phrase, '') FROM user_db.phrases_0_65
+        UNION SELECT ifnull(p_phrase, '') FROM user_db.phrases_0_65
+        UNION SELECT ifnull(pp_phrase, '') FROM user_db.phrases_0_65;
+        CREATE TABLE user_db.phrases
+        (input_phrase INTEGER, phrase INTEGER,
+        p_phrase INTEGER, pp_phrase INTEGER,
+        user_freq INTEGER, timestamp REAL,
+        PRIMARY KEY (input_phrase, phrase, p_phrase, pp_phrase))
+        WITHOUT ROWID;
+        INSERT INTO user_db.phrases
+        (input_phrase, phrase, p_phrase, pp_phrase, user_freq, timestamp)
+        SELECT input_phrase_token.id, phrase_token.id,
+        p_phrase_token.id, pp_phrase_token.id,
+        max(old.user_freq), max(old.timestamp)
+        FROM user_db.phrases_0_65 AS old
+        JOIN user_db.tokens AS input_phrase_token
+        ON input_phrase_token.text = ifnull(old.input_phrase, '')
+        JOIN user_db.tokens AS phrase_token
+        ON phrase_token.text = ifnull(old.phrase, '')
+        JOIN user_db.tokens AS p_phrase_token
+        ON p_phrase_token.text = ifnull(old.p_phrase, '')
+        JOIN user_db.tokens AS pp_phrase_token
+        ON pp_phrase_token.text = ifnull(old.pp_phrase, '')
+        GROUP BY input_phrase_token.id, phrase_token.id,
+        p_phrase_token.id, pp_phrase_token.id;
+        DROP TABLE user_db.phrases_0_65;
+        UPDATE user_db.desc SET value = '%(version)s' WHERE name = 'version';
+        COMMIT;
+        ''' %{'version': USER_DATABASE_VERSION}
+        try:
+            self.db.executescript(sqlstr)
+        except:
+            if self.db.in_transaction:
+                self.db.rollback()
+            raise
+        # Give the space of the old table back to the file system:
+        self.db.execute('VACUUM user_db;')
+        sys.stderr.write(
+            "Migration of the user database done in %.1f s.\n"
+            %(time.time() - time_start))
+
+    def _check_external_changes(self):
+        '''Drop the cached token ids and the cached counts of
+        select_words() if another connection has changed the user
+        database since the last read
+
+        The other connection may be the one of the writer thread or
+        the one of another process, for example another input method
+        or the setup tool. When tokens were removed there, the ids may
+        have been reused for other strings.
+        '''
+        try:
+            data_version = self.db.execute(
+                'PRAGMA user_db.data_version;').fetchall()[0][0]
+        except:
+            traceback.print_exc()
+            return
+        if (self._data_version is not None
+                and data_version != self._data_version):
+            self._token_ids = {}
+            self._generation += 1
+        self._data_version = data_version
+
+    def _get_token_id(self, text):
+        '''Returns the id of a string in the tokens table or 0 if the
+        string is not in the tokens table
+
+        0 is never used as an id, it can be compared with the id
+        columns of the phrases table and never matches.
+
+        Only used for reading, the tokens are added by the writer.
+
+        :param text: The string to look up
+        :type text: String
+        :rtype: Integer
+        '''
+        if self._token_generation != self._writer.token_generation:
+            self._token_ids = {}
+            self._token_generation = self._writer.token_generation
+        if text in self._token_ids:
+            return self._token_ids[text]
+        result = self.db.execute(
+            'SELECT id FROM user_db.tokens WHERE text = :text;',
+            {'text': text}).fetchall()
+        if not result:
+            return 0
+        self._token_ids[text] = result[0][0]
+        return result[0][0]
+
     def add_phrase(self, input_phrase='', phrase='',
                    p_phrase='', pp_phrase='',
                    user_freq=0, commit=True):
@@ -343,43 +2237,16 @@ class TabSqliteDb:
             itb_util.NORMALIZATION_FORM_INTERNAL, p_phrase)
         pp_phrase = unicodedata.normalize(
             itb_util.NORMALIZATION_FORM_INTERNAL, pp_phrase)
-        select_sqlstr = '''
-        SELECT * FROM user_db.phrases
-        WHERE input_phrase = :input_phrase
-        AND phrase = :phrase AND p_phrase = :p_phrase AND pp_phrase = :pp_phrase
-        ;'''
-        select_sqlargs = {
-            'input_phrase': input_phrase,
-            'phrase': phrase,
-            'p_phrase': p_phrase,
-            'pp_phrase': pp_phrase}
-        if self.db.execute(select_sqlstr, select_sqlargs).fetchall():
-            # there is already such a phrase, i.e. add_phrase was called
-            # in error, do nothing to avoid duplicate entries.
-            return
-
-        insert_sqlstr = '''
-        INSERT INTO user_db.phrases
-        (input_phrase, phrase, p_phrase, pp_phrase, user_freq, timestamp)
-        VALUES (:input_phrase, :phrase, :p_phrase, :pp_phrase, :user_freq, :timestamp)
-        ;'''
-        insert_sqlargs = {'input_phrase': input_phrase,
-                          'phrase': phrase,
-                          'p_phrase': p_phrase,
-                          'pp_phrase': pp_phrase,
-                          'user_freq': user_freq,
-                          'timestamp': time.time()}
-        if DEBUG_LEVEL > 1:
-            sys.stderr.write(
-                "TabSqliteDb.add_phrase() insert_sqlstr=%s\n" %insert_sqlstr)
-            sys.stderr.write(
-                "TabSqliteDb.add_phrase() insert_sqlargs=%s\n" %insert_sqlargs)
-        try:
-            self.db.execute(insert_sqlstr, insert_sqlargs)
-            if commit:
-                self.db.commit()
-        except Exception:
-            traceback.print_exc()
+        self.flush_pending_updates()
+        if (self._ngram_trie is not None
+                and self._ngram_trie.get(
+                    input_phrase, phrase, p_phrase, pp_phrase) is None):
+            self._ngram_trie.add(
+                input_phrase, phrase, p_phrase, pp_phrase, user_freq)
+        self._generation += 1
+        self._submit_change(
+            self._writer.add_phrase,
+            input_phrase, phrase, p_phrase, pp_phrase, user_freq, commit)
 
     def optimize_database(self):
         '''
@@ -390,34 +2257,30 @@ class TabSqliteDb:
             CREATE TABLE tmp AS SELECT * FROM %(database)s.phrases;
             DELETE FROM user_db.phrases;
             INSERT INTO user_db.phrases SELECT * FROM tmp ORDER BY
-            input_phrase, user_freq DESC, id ASC;
-            DROP TABLE tmp;'''
-        self.db.executescript(sqlstr)
-        self.db.executescript("VACUUM;")
-        self.db.commit()
+            input_phrase, user_freq DESC;
+            DROP TABLE tmp;
+            VACUUM;'''
+        self._writer.submit(self._writer.executescript, sqlstr)
 
     def drop_indexes(self):
         '''Drop the index in database to reduce it's size'''
         sqlstr = '''
-            DROP INDEX IF EXISTS user_db.phrases_index_p;
             DROP INDEX IF EXISTS user_db.phrases_index_i;
             VACUUM;
             '''
-
-        self.db.executescript(sqlstr)
-        self.db.commit()
+        self._writer.submit(self._writer.executescript, sqlstr)
 
     def create_indexes(self, commit=True):
-        '''Create indexes for the database.'''
+        '''Create indexes for the database.
+
+        The rows for an input_phrase are looked up in the primary key
+        of the phrases table, which needs no extra index.
+        '''
         sqlstr = '''
-        CREATE INDEX IF NOT EXISTS user_db.phrases_index_p ON phrases
-        (input_phrase, id ASC);
         CREATE INDEX IF NOT EXISTS user_db.phrases_index_i ON phrases
         (phrase)
         ;'''
-        self.db.executescript(sqlstr)
-        if commit:
-            self.db.commit()
+        self._writer.submit(self._writer.executescript, sqlstr, commit)
 
     def best_candidates(self, phrase_frequencies):
         return sorted(phrase_frequencies.items(),
@@ -427,13 +2290,23 @@ class TabSqliteDb:
                           x[0]       # phrase alphabetical
                       ))[:20]
 
-    def select_words(self, input_phrase, p_phrase='', pp_phrase=''):
+    def select_words(self, input_phrase, p_phrase='', pp_phrase='',
+                     spellcheck=True, hunspell_obj=None):
         '''
         Get phrases from database completing input_phrase.
 
         Returns a list of matches where each match is a tuple in the
         form of (phrase, user_freq), i.e. returns something like
         [(phrase, user_freq), ...]
+
+        If spellcheck is False, spell checking suggestions from
+        hunspell are only included if they have already been computed,
+        see Hunspell.needs_spellcheck() and Hunspell.spellcheck().
+
+        hunspell_obj is the Hunspell object of the caller to get the
+        suggestions from, the database may be shared by engines using
+        different dictionaries. If it is None, only the phrases from
+        the database are returned.
         '''
         input_phrase = unicodedata.normalize(
             itb_util.NORMALIZATION_FORM_INTERNAL, input_phrase)
@@ -448,7 +2321,7 @@ class TabSqliteDb:
                 + "p_phrase=%s " % p_phrase.encode('UTF-8')
                 + "pp_phrase=%s\n" % pp_phrase.encode('UTF-8'))
         phrase_frequencies = {}
-        if not ' ' in input_phrase:
+        if hunspell_obj is not None and not ' ' in input_phrase:
             # Get suggestions from hunspell dictionaries. But only
             # if input_phrase does not contain spaces. The hunspell
             # dictionaries contain only single words, not sentences.
@@ -456,7 +2329,8 @@ class TabSqliteDb:
             # will never work and spell checking suggestions by hunspell
             # for input which contains spaces is almost always nonsense.
             phrase_frequencies.update([
-                x for x in self.hunspell_obj.suggest(input_phrase)])
+                x for x in hunspell_obj.suggest(
+                    input_phrase, spellcheck=spellcheck)])
         if DEBUG_LEVEL > 1:
             sys.stderr.write(
                 "TabSqliteDb.select_words() hunspell: best_candidates=%s\n"
@@ -476,147 +2350,321 @@ class TabSqliteDb:
         #
         # {'code': 0, 'communicability': 0, 'cold': 0, 'colour': 0}
 
-        # To quote a string to be used as a parameter when assembling
-        # an sqlite statement with Python string operations, remove
-        # all NUL characters, replace " with "" and wrap the whole
-        # string in double quotes. Assembling sqlite statements using
-        # parameters containing user input with python string operations
-        # is not recommended because of the risk of SQL injection attacks
-        # if the quoting is not done the right way. So it is better to use
-        # the parameter substitution of the sqlite3 python interface.
-        # But unfortunately that does not work when creating views,
-        # (“OperationalError: parameters are not allowed in views”).
-        quoted_input_phrase = input_phrase.replace(
-            '\x00', '').replace('"', '""')
-        self.db.execute('DROP VIEW IF EXISTS like_input_phrase_view;')
-        sqlstr = '''
-        CREATE TEMPORARY VIEW IF NOT EXISTS like_input_phrase_view AS
-        SELECT * FROM user_db.phrases
-        WHERE input_phrase LIKE "%(quoted_input_phrase)s%%"
-        ;''' % {'quoted_input_phrase': quoted_input_phrase}
-        self.db.execute(sqlstr)
-        sqlargs = {'p_phrase': p_phrase, 'pp_phrase': pp_phrase}
-        sqlstr = (
-            'SELECT phrase, sum(user_freq) FROM like_input_phrase_view '
-            + 'GROUP BY phrase;')
-        try:
-            # Get “unigram” data from user_db.
-            #
-            # Example: Let’s assume the user typed “co” and user_db contains
-            #
-            #     1|colou|colour|green|nice|1
-            #     2|col|colour|yellow|ugly|2
-            #     3|co|colour|green|awesome|1
-            #     4|co|cold|||1
-            #     5|conspirac|conspiracy|||5
-            #     6|conspi|conspiracy|||1
-            #     7|c|conspiracy|||1
-            results_uni = self.db.execute(sqlstr, sqlargs).fetchall()
-            # Then the result returned by .fetchall() is:
-            #
-            # [('colour', 4), ('cold', 1), ('conspiracy', 6)]
-            #
-            # (“c|conspiracy|1” is not selected because it doesn’t
-            # match the user input “LIKE co%”! I.e. this is filtered
-            # out by the VIEW created above already)
-        except:
-            traceback.print_exc()
-        if not results_uni:
-            # If no unigrams matched, bigrams and trigrams cannot
-            # match either. We can stop here and return what we got
-            # from hunspell.
-            return self.best_candidates(phrase_frequencies)
+        # The phrases completing input_phrase are the rows whose
+        # input_phrase is one of the tokens in the range
+        # [input_phrase, upper_bound[. This range can be looked up in
+        # the index of the text column of the tokens table, the ids
+        # found there in the primary key of the phrases table.
+        # (Unlike a LIKE pattern, this needs no quoting of “%” and
+        # “_” and the statements can be prepared once and reused):
+        input_phrase = input_phrase.replace('\x00', '')
+        sqlargs = {'input_phrase': input_phrase,
+                   'input_phrase_upper': prefix_upper_bound(input_phrase)}
+        if sqlargs['input_phrase_upper'] is None:
+            where = 'text >= :input_phrase'
+        else:
+            where = ('text >= :input_phrase '
+                     + 'AND text < :input_phrase_upper')
+        # Get the unigram, bigram and trigram counts of all phrases
+        # in the prefix range in a single scan of the range. For each
+        # phrase, the columns are:
+        #
+        # unigram count: sum of user_freq of all rows
+        # bigram count:  sum of user_freq of the rows where the
+        #                previous word matches p_phrase
+        # bigram rows:   number of such rows
+        # trigram count: sum of user_freq of the rows where the two
+        #                previous words match p_phrase and pp_phrase
+        # trigram rows:  number of such rows
+        #
+        # The totals used to normalize the counts are the sums of
+        # these columns over all phrases.
+        #
+        # Example: Let’s assume the user typed “co” and user_db contains
+        #
+        #     1|colou|colour|green|nice|1
+        #     2|col|colour|yellow|ugly|2
+        #     3|co|colour|green|awesome|1
+        #     4|co|cold|||1
+        #     5|conspirac|conspiracy|||5
+        #     6|conspi|conspiracy|||1
+        #     7|c|conspiracy|||1
+        #
+        # and p_phrase is “green” and pp_phrase is “nice”. Then the
+        # result returned by .fetchall() is:
+        #
+        # [('cold', 1, 0, 0, 0, 0),
+        #  ('colour', 4, 2, 2, 1, 1),
+        #  ('conspiracy', 6, 0, 0, 0, 0)]
+        #
+        # (“c|conspiracy|1” is not selected because “c” does not
+        # start with the user input “co”)
+        #
+        # The context is compared by the ids of the tokens, the text
+        # of a phrase is only looked up once per phrase in the result.
+        sqlstr = SELECT_WORDS_SQL %{'where': where}
+        results = []
+        self._apply_pruned_rows()
+        self._check_external_changes()
+        # The writer increases its token generation when it prunes
+        # rows, that changes the counts as well:
+        cache_key = (self._generation, self._writer.token_generation,
+                     input_phrase, p_phrase, pp_phrase)
+        cached_results = self._select_words_cache.get(cache_key)
+        if cached_results is not None:
+            (results, system_results) = cached_results
+        else:
+            if self._ngram_trie is not None:
+                # The trie contains the queued updates already:
+                results = self._ngram_trie.counts(
+                    input_phrase, p_phrase, pp_phrase)
+            else:
+                # The writer must not commit a batch of updates
+                # between the query and copying the list of unwritten
+                # batches:
+                with self._writer.lock:
+                    try:
+                        sqlargs['p_phrase'] = self._get_token_id(p_phrase)
+                        sqlargs['pp_phrase'] = self._get_token_id(pp_phrase)
+                        results = self.db.execute(
+                            sqlstr, sqlargs).fetchall()
+                    except:
+                        traceback.print_exc()
+                    updates = self._writer.unwritten_updates[:]
+                updates.append(self._pending_updates)
+                results = self._merge_pending_updates(
+                    results, updates, input_phrase, p_phrase, pp_phrase)
+            system_results = []
+            if self._system_db_token_ids is not None:
+                system_results = self._select_system_ngrams(
+                    input_phrase, p_phrase, pp_phrase)
+            self._select_words_cache[cache_key] = (results, system_results)
+        frequencies = self._interpolate_ngram_counts(
+            results, p_phrase, pp_phrase)
+        if system_results:
+            system_frequencies = self._interpolate_ngram_counts(
+                system_results, p_phrase, pp_phrase)
+            for phrase in set(frequencies) | set(system_frequencies):
+                frequencies[phrase] = (
+                    (1 - SYSTEM_NGRAM_WEIGHT) * frequencies.get(phrase, 0)
+                    + SYSTEM_NGRAM_WEIGHT * system_frequencies.get(phrase, 0))
+            if DEBUG_LEVEL > 1:
+                sys.stderr.write(
+                    "TabSqliteDb.select_words() "
+                    + "with system n-grams best_candidates=%s\n"
+                    %self.best_candidates(frequencies))
+        # If no unigrams matched, bigrams and trigrams cannot match
+        # either and only the candidates from hunspell are returned:
+        phrase_frequencies.update(frequencies)
+        return self.best_candidates(phrase_frequencies)
+
+    def _interpolate_ngram_counts(self, results, p_phrase, pp_phrase):
+        '''Compute the frequencies of the phrases from their unigram,
+        bigram and trigram counts
+
+        :param results: The counts as returned by the query in
+                        select_words(), tuples (phrase, unigram count,
+                        bigram count, bigram rows, trigram count,
+                        trigram rows)
+        :type results: List of tuples
+        :param p_phrase: The previous word
+        :type p_phrase: String
+        :param pp_phrase: The word before the previous word
+        :type pp_phrase: String
+        :return: The frequencies of the phrases, between 0 and 1
+        :rtype: Dictionary
+        '''
+        phrase_frequencies = {}
+        if not results:
+            return phrase_frequencies
+        count = sum([x[1] for x in results])
+        count_p_phrase = sum([x[2] for x in results])
+        bigram_rows = sum([x[3] for x in results])
+        count_pp_phrase_p_phrase = sum([x[4] for x in results])
+        trigram_rows = sum([x[5] for x in results])
         # Now normalize the unigram frequencies with the total count
-        # (which is 11 in the above example), which gives us the
-        # normalized result:
+        # (which is 11 in the example in select_words()), which gives
+        # us the normalized result:
         # [('colour', 4/11), ('cold', 1/11), ('conspiracy', 6/11)]
-        sqlstr = 'SELECT sum(user_freq) FROM like_input_phrase_view;'
-        try:
-            count = self.db.execute(sqlstr, sqlargs).fetchall()[0][0]
-        except:
-            traceback.print_exc()
-        # Updating the phrase_frequency dictionary with the normalized
-        # results gives: {'conspiracy': 6/11, 'code': 0,
-        # 'communicability': 0, 'cold': 1/11, 'colour': 4/11}
-        for x in results_uni:
-            phrase_frequencies.update([(x[0], x[1]/float(count))])
+        # Updating the phrase_frequency dictionary of select_words()
+        # with the normalized results gives: {'conspiracy': 6/11,
+        # 'code': 0, 'communicability': 0, 'cold': 1/11, 'colour': 4/11}
+        for x in results:
+            phrase_frequencies[x[0]] = x[1]/float(count) if count else 0.0
         if DEBUG_LEVEL > 1:
             sys.stderr.write(
                 "TabSqliteDb.select_words() Unigram best_candidates=%s\n"
                 %self.best_candidates(phrase_frequencies))
-        if not p_phrase:
-            # If no context for bigram matching is available, return
-            # what we have so far:
-            return self.best_candidates(phrase_frequencies)
-        sqlstr = (
-            'SELECT phrase, sum(user_freq) FROM like_input_phrase_view '
-            + 'WHERE p_phrase = :p_phrase GROUP BY phrase;')
-        try:
-            results_bi = self.db.execute(sqlstr, sqlargs).fetchall()
-        except:
-            traceback.print_exc()
-        if not results_bi:
-            # If no bigram could be matched, return what we have so far:
-            return self.best_candidates(phrase_frequencies)
-        # get the total count of p_phrase to normalize the bigram frequencies:
-        sqlstr = (
-            'SELECT sum(user_freq) FROM like_input_phrase_view '
-            + 'WHERE p_phrase = :p_phrase;')
-        try:
-            count_p_phrase = self.db.execute(sqlstr, sqlargs).fetchall()[0][0]
-        except:
-            traceback.print_exc()
+        if not p_phrase or not bigram_rows or not count_p_phrase:
+            # If no context for bigram matching is available or no
+            # bigram could be matched, return what we have so far:
+            return phrase_frequencies
         # Update the phrase frequency dictionary by using a linear
         # combination of the unigram and the bigram results, giving
         # both the weight of 0.5:
-        for x in results_bi:
-            phrase_frequencies.update(
-                [(x[0],
-                  0.5*x[1]/float(count_p_phrase)
-                  +0.5*phrase_frequencies[x[0]])])
+        for x in results:
+            if x[3]:
+                phrase_frequencies[x[0]] = (
+                    0.5*x[2]/float(count_p_phrase)
+                    +0.5*phrase_frequencies[x[0]])
         if DEBUG_LEVEL > 1:
             sys.stderr.write(
                 "TabSqliteDb.select_words() Bigram best_candidates=%s\n"
                 %self.best_candidates(phrase_frequencies))
-        if not pp_phrase:
-            # If no context for trigram matching is available, return
-            # what we have so far:
-            return self.best_candidates(phrase_frequencies)
-        sqlstr = ('SELECT phrase, sum(user_freq) FROM like_input_phrase_view '
-                  + 'WHERE p_phrase = :p_phrase '
-                  + 'AND pp_phrase = :pp_phrase GROUP BY phrase;')
-        try:
-            results_tri = self.db.execute(sqlstr, sqlargs).fetchall()
-        except:
-            traceback.print_exc()
-        if not results_tri:
-            # if no trigram could be matched, return what we have so far:
-            return self.best_candidates(phrase_frequencies)
-        # get the total count of (p_phrase, pp_phrase) pairs to
-        # normalize the bigram frequencies:
-        sqlstr = (
-            'SELECT sum(user_freq) FROM like_input_phrase_view '
-            + 'WHERE p_phrase = :p_phrase AND pp_phrase = :pp_phrase;')
-        try:
-            count_pp_phrase_p_phrase = self.db.execute(
-                sqlstr, sqlargs).fetchall()[0][0]
-        except:
-            traceback.print_exc()
+        if (not pp_phrase
+                or not trigram_rows
+                or not count_pp_phrase_p_phrase):
+            # If no context for trigram matching is available or no
+            # trigram could be matched, return what we have so far:
+            return phrase_frequencies
         # Update the phrase frequency dictionary by using a linear
         # combination of the bigram and the trigram results, giving
         # both the weight of 0.5 (that makes the total weights: 0.25 *
         # unigram + 0.25 * bigram + 0.5 * trigram, i.e. the trigrams
         # get higher weight):
-        for x in results_tri:
-            phrase_frequencies.update(
-                [(x[0],
-                  0.5*x[1]/float(count_pp_phrase_p_phrase)
-                  +0.5*phrase_frequencies[x[0]])])
+        for x in results:
+            if x[5]:
+                phrase_frequencies[x[0]] = (
+                    0.5*x[4]/float(count_pp_phrase_p_phrase)
+                    +0.5*phrase_frequencies[x[0]])
         if DEBUG_LEVEL > 1:
             sys.stderr.write(
                 "TabSqliteDb.select_words() Trigram best_candidates=%s\n"
                 %self.best_candidates(phrase_frequencies))
-        return self.best_candidates(phrase_frequencies)
+        return phrase_frequencies
+
+    def _select_system_ngrams(self, input_phrase, p_phrase, pp_phrase):
+        '''Get the counts of the completions of input_phrase from the
+        system database
+
+        At most SYSTEM_NGRAM_MAX_CANDIDATES completions with the
+        highest weights are taken from each of the unigrams, the
+        bigrams with p_phrase and the trigrams with p_phrase and
+        pp_phrase. The weights are the probabilities or counts found
+        by import_system_db(). The case of input_phrase is ignored.
+
+        :param input_phrase: The input with the accents removed
+        :type input_phrase: String
+        :param p_phrase: The previous word
+        :type p_phrase: String
+        :param pp_phrase: The word before the previous word
+        :type pp_phrase: String
+        :return: The counts in the format of the results of the
+                 query in select_words()
+        :rtype: List of tuples
+        '''
+        (empty_id, last_id) = self._system_db_token_ids
+        input_phrase = unicodedata.normalize(
+            itb_util.NORMALIZATION_FORM_INTERNAL, input_phrase.lower())
+        input_phrase_upper = prefix_upper_bound(input_phrase)
+        token_id_sqlstr = 'SELECT id FROM system_db.tokens WHERE text = ?;'
+        # The ids of the tokens are in the order of their text, so
+        # the tokens starting with input_phrase have the ids in
+        # [lower, upper[:
+        bound_sqlstr = (
+            'SELECT id FROM system_db.tokens WHERE text >= ? '
+            + 'ORDER BY text LIMIT 1;')
+        range_sqlstr = (
+            'SELECT (SELECT text FROM system_db.tokens WHERE id = phrase), '
+            + 'weight FROM system_db.ngrams '
+            + 'WHERE p_phrase = :p_phrase AND pp_phrase = :pp_phrase '
+            + 'AND input_phrase >= :lower AND input_phrase < :upper '
+            + 'ORDER BY weight DESC LIMIT :limit;')
+        counts = {}
+        try:
+            lower = self.db.execute(bound_sqlstr, (input_phrase,)).fetchall()
+            if not lower:
+                return []
+            sqlargs = {'lower': lower[0][0],
+                       'upper': last_id + 1,
+                       'limit': SYSTEM_NGRAM_MAX_CANDIDATES,
+                       'p_phrase': empty_id,
+                       'pp_phrase': empty_id}
+            if input_phrase_upper is not None:
+                upper = self.db.execute(
+                    bound_sqlstr, (input_phrase_upper,)).fetchall()
+                if upper:
+                    sqlargs['upper'] = upper[0][0]
+            if sqlargs['lower'] >= sqlargs['upper']:
+                return []
+            if len(input_phrase) <= SYSTEM_NGRAM_SHORT_PREFIX_LENGTH:
+                unigrams = self.db.execute(
+                    'SELECT (SELECT text FROM system_db.tokens '
+                    + 'WHERE id = phrase), weight '
+                    + 'FROM system_db.completions WHERE prefix = ? '
+                    + 'ORDER BY weight DESC;', (input_phrase,)).fetchall()
+            else:
+                unigrams = self.db.execute(range_sqlstr, sqlargs).fetchall()
+            for (phrase, weight) in unigrams:
+                counts[phrase] = [weight, 0, 0, 0, 0]
+            p_phrase_id = self.db.execute(
+                token_id_sqlstr, (p_phrase,)).fetchall()
+            if not p_phrase or not p_phrase_id:
+                return [(phrase,) + tuple(count)
+                        for (phrase, count) in counts.items()]
+            sqlargs['p_phrase'] = p_phrase_id[0][0]
+            for (phrase, weight) in self.db.execute(
+                    range_sqlstr, sqlargs).fetchall():
+                counts.setdefault(phrase, [0, 0, 0, 0, 0])[1:3] = [weight, 1]
+            pp_phrase_id = self.db.execute(
+                token_id_sqlstr, (pp_phrase,)).fetchall()
+            if pp_phrase and pp_phrase_id:
+                sqlargs['pp_phrase'] = pp_phrase_id[0][0]
+                for (phrase, weight) in self.db.execute(
+                        range_sqlstr, sqlargs).fetchall():
+                    counts.setdefault(
+                        phrase, [0, 0, 0, 0, 0])[3:5] = [weight, 1]
+        except:
+            traceback.print_exc()
+        return [(phrase,) + tuple(count) for (phrase, count) in counts.items()]
+
+    def get_select_words_cache_statistics(self):
+        '''Returns the size and the hit, miss and eviction counters of
+        the cache of select_words()
+
+        :rtype: Dictionary
+        '''
+        return self._select_words_cache.statistics()
+
+    def _merge_pending_updates(
+            self, results, updates, input_phrase, p_phrase, pp_phrase):
+        '''Add the queued updates to the counts of select_words()
+
+        The result is the same as if the queued updates had been
+        written to the database before the query. The row counts only
+        tell whether a phrase has bigram or trigram matches at all, so
+        it does not matter that a queued update for an existing row
+        counts as an extra row.
+
+        :param results: The rows returned by the query in select_words()
+        :type results: List of tuples
+        :param updates: Batches of updates which are queued or not yet
+                        committed by the writer
+        :type updates: List of dictionaries
+        :param input_phrase: The input with the accents removed
+        :type input_phrase: String
+        :param p_phrase: The previous word
+        :type p_phrase: String
+        :param pp_phrase: The word before the previous word
+        :type pp_phrase: String
+        :rtype: List of tuples
+        '''
+        counts = {x[0]: list(x[1:]) for x in results}
+        for batch in updates:
+            for ((pending_input_phrase, phrase, pending_p_phrase,
+                  pending_pp_phrase), increment) in batch.items():
+                if not pending_input_phrase.startswith(input_phrase):
+                    continue
+                if phrase not in counts:
+                    counts[phrase] = [0, 0, 0, 0, 0]
+                counts[phrase][0] += increment
+                if pending_p_phrase == p_phrase:
+                    counts[phrase][1] += increment
+                    counts[phrase][2] += 1
+                    if pending_pp_phrase == pp_phrase:
+                        counts[phrase][3] += increment
+                        counts[phrase][4] += 1
+        return [tuple([phrase] + counts[phrase]) for phrase in counts]
 
     def generate_userdb_desc(self):
         '''
@@ -681,31 +2729,18 @@ class TabSqliteDb:
         Get the number of columns in the 'phrases' table in
         the database in db_file.
 
-        Determines the number of columns by parsing this:
-
-        sqlite> select sql from sqlite_master where name='phrases';
-CREATE TABLE phrases (id INTEGER PRIMARY KEY, input_phrase TEXT, phrase TEXT, p_phrase TEXT, pp_phrase TEXT, user_freq INTEGER, timestamp REAL)
-        sqlite>
-
-        This result could be on a single line, as above, or on multiple
-        lines.
+        Uses “PRAGMA table_info(phrases);”, which returns one row per
+        column. (Parsing the “CREATE TABLE” statement stored in
+        sqlite_master does not work when the statement contains a
+        table constraint like “PRIMARY KEY (input_phrase, …)”.)
         '''
         if not path.exists(db_file):
             return None
         try:
             db = sqlite3.connect(db_file)
-            tp_res = db.execute(
-                "select sql from sqlite_master where name='phrases';"
-            ).fetchall()
-            # Remove possible line breaks from the string where we
-            # want to match:
-            string = ' '.join(tp_res[0][0].splitlines())
-            res = re.match(r'.*\((.*)\)', string)
-            if res:
-                tp = res.group(1).split(',')
-                return len(tp)
-            else:
-                return 0
+            columns = db.execute('PRAGMA table_info(phrases);').fetchall()
+            db.close()
+            return len(columns)
         except:
             return 0
 
@@ -716,7 +2751,13 @@ CREATE TABLE phrases (id INTEGER PRIMARY KEY, input_phrase TEXT, phrase TEXT, p_
 
         '''
         sqlstr = '''
-        SELECT input_phrase, phrase FROM user_db.phrases WHERE user_freq >= :freq
+        SELECT input_phrase_token.text, phrase_token.text
+        FROM user_db.phrases
+        JOIN user_db.tokens AS input_phrase_token
+        ON input_phrase_token.id = input_phrase
+        JOIN user_db.tokens AS phrase_token
+        ON phrase_token.id = phrase
+        WHERE user_freq >= :freq
         ;'''
         sqlargs = {'freq': itb_util.SHORTCUT_USER_FREQ}
         if DEBUG_LEVEL > 1:
@@ -761,55 +2802,102 @@ CREATE TABLE phrases (id INTEGER PRIMARY KEY, input_phrase TEXT, phrase TEXT, p_
                 %{'p': phrase.encode('UTF-8'),
                   't': input_phrase.encode('UTF-8')})
 
-        # There should never be more than 1 database row for the same
-        # input_phrase *and* phrase. So the following query on
-        # the database should match at most one database
-        # row and the length of the result array should be 0 or
-        # 1. So the “GROUP BY phrase” is actually redundant. It is
-        # only a safeguard for the case when duplicate rows have been
-        # added to the database accidentally (But in that case there
-        # is a bug somewhere else which should be fixed).
-        sqlstr = '''
-        SELECT max(user_freq) FROM user_db.phrases
-        WHERE input_phrase = :input_phrase
-        AND phrase = :phrase AND p_phrase = :p_phrase AND pp_phrase = :pp_phrase
-        GROUP BY phrase
-        ;'''
-        sqlargs = {'input_phrase': input_phrase,
-                   'phrase': phrase,
-                   'p_phrase': p_phrase,
-                   'pp_phrase': pp_phrase}
-        if DEBUG_LEVEL > 1:
-            sys.stderr.write(
-                "TabSqliteDb.check_phrase_and_update_frequency() sqlstr=%s\n"
-                %sqlstr)
-            sys.stderr.write(
-                "TabSqliteDb.check_phrase_and_update_frequency() sqlargs=%s\n"
-                %sqlargs)
-        result = self.db.execute(sqlstr, sqlargs).fetchall()
+        self._generation += 1
+        self._submit_change(
+            self._writer.write_frequency_update,
+            input_phrase, phrase, p_phrase, pp_phrase,
+            user_freq_increment, commit)
+        if self._ngram_trie is not None:
+            self._ngram_trie.add(
+                input_phrase, phrase, p_phrase, pp_phrase,
+                user_freq_increment)
+
+    def queue_frequency_update(
+            self, input_phrase='', phrase='', p_phrase='',
+            pp_phrase='', user_freq_increment=1):
+        '''Queue an increase of the frequency of a phrase
+
+        Like check_phrase_and_update_frequency() but the update is
+        only written to the database by the next call of
+        flush_pending_updates(). This avoids a transaction and the
+        cost of syncing the WAL for each word typed. select_words()
+        takes the queued updates into account already, the in-memory
+        n-gram trie is updated immediately.
+
+        When WRITE_BEHIND_MAX_PENDING different phrases are queued,
+        the queue is flushed immediately.
+        '''
+        if not input_phrase:
+            input_phrase = phrase
+        if not phrase:
+            return
+        phrase = unicodedata.normalize(
+            itb_util.NORMALIZATION_FORM_INTERNAL, phrase)
+        p_phrase = unicodedata.normalize(
+            itb_util.NORMALIZATION_FORM_INTERNAL, p_phrase)
+        pp_phrase = unicodedata.normalize(
+            itb_util.NORMALIZATION_FORM_INTERNAL, pp_phrase)
+        input_phrase = itb_util.remove_accents(input_phrase)
+        input_phrase = unicodedata.normalize(
+            itb_util.NORMALIZATION_FORM_INTERNAL, input_phrase)
+        self._generation += 1
+        key = (input_phrase, phrase, p_phrase, pp_phrase)
+        self._pending_updates[key] = (
+            self._pending_updates.get(key, 0) + user_freq_increment)
+        if self._ngram_trie is not None:
+            self._ngram_trie.add(
+                input_phrase, phrase, p_phrase, pp_phrase,
+                user_freq_increment)
         if DEBUG_LEVEL > 1:
             sys.stderr.write(
-                "check_phrase_and_update_frequency() result=%s\n" %result)
-        if result:
-            # A match was found in user_db, increase user frequency by
-            # user_freq_increment (1 by default)
-            self.update_phrase(input_phrase=input_phrase,
-                               phrase=phrase,
-                               p_phrase=p_phrase,
-                               pp_phrase=pp_phrase,
-                               user_freq=result[0][0]+user_freq_increment,
-                               commit=commit)
+                "TabSqliteDb.queue_frequency_update() %s pending\n"
+                %len(self._pending_updates))
+        if len(self._pending_updates) >= WRITE_BEHIND_MAX_PENDING:
+            self.flush_pending_updates()
+
+    def has_pending_updates(self):
+        '''Returns whether there are queued updates which have not
+        been written to the database yet
+
+        :rtype: Boolean
+        '''
+        return bool(self._pending_updates)
+
+    def flush_pending_updates(self, checkpoint=True):
+        '''Write the updates queued by queue_frequency_update() to
+        the database in a single transaction
+
+        When the writer runs in a thread, this only hands the updates
+        over to it and returns immediately.
+
+        :param checkpoint: Whether to checkpoint the WAL if enough
+                           updates have been written since the last
+                           checkpoint
+        :type checkpoint: Boolean
+        '''
+        if not self._pending_updates:
             return
-        # The phrase was not found in user_db.
-        # Add it as a new phrase, i.e. with user_freq = user_freq_increment
-        # (1 by default):
-        self.add_phrase(input_phrase=input_phrase,
-                        phrase=phrase,
-                        p_phrase=p_phrase,
-                        pp_phrase=pp_phrase,
-                        user_freq=user_freq_increment,
-                        commit=commit)
-        return
+        pending_updates = self._pending_updates
+        self._pending_updates = {}
+        self._submit_frequency_updates(pending_updates, checkpoint)
+
+    def _submit_frequency_updates(self, updates, checkpoint=True):
+        '''Hand a batch of frequency updates over to the writer
+
+        select_words() takes the batch into account until the writer
+        has committed it.
+
+        :param updates: The increments of the frequencies, keyed by
+                        (input_phrase, phrase, p_phrase, pp_phrase)
+        :type updates: Dictionary
+        :param checkpoint: Whether the writer may checkpoint the WAL
+                           after writing the batch
+        :type checkpoint: Boolean
+        '''
+        with self._writer.lock:
+            self._writer.unwritten_updates.append(updates)
+        self._writer.submit(
+            self._writer.write_frequency_updates, updates, checkpoint)
 
     def remove_phrase(self, input_phrase='', phrase='', commit=True):
         '''
@@ -828,20 +2916,15 @@ CREATE TABLE phrases (id INTEGER PRIMARY KEY, input_phrase TEXT, phrase TEXT, p_
         if input_phrase:
             input_phrase = unicodedata.normalize(
                 itb_util.NORMALIZATION_FORM_INTERNAL, input_phrase)
-        if input_phrase:
-            delete_sqlstr = '''
-            DELETE FROM user_db.phrases
-            WHERE input_phrase = :input_phrase AND phrase = :phrase
-            ;'''
-        else:
-            delete_sqlstr = '''
-            DELETE FROM user_db.phrases
-            WHERE phrase = :phrase
-            ;'''
-        delete_sqlargs = {'input_phrase': input_phrase, 'phrase': phrase}
-        self.db.execute(delete_sqlstr, delete_sqlargs)
-        if commit:
-            self.db.commit()
+        # Write queued updates first, otherwise they might add the
+        # phrase again later:
+        self.flush_pending_updates()
+        if self._ngram_trie is not None:
+            self._ngram_trie.remove_phrase(
+                phrase, input_phrase=input_phrase or None)
+        self._generation += 1
+        self._submit_change(
+            self._writer.remove_phrase, input_phrase or '', phrase, commit)
 
     def extract_user_phrases(self):
         '''extract user phrases from database'''
@@ -863,86 +2946,199 @@ CREATE TABLE phrases (id INTEGER PRIMARY KEY, input_phrase TEXT, phrase TEXT, p_
             traceback.print_exc()
             return []
 
-    def read_training_data_from_file(self, filename):
+    def read_training_data_from_file(self, filename, progress_callback=None):
         '''
         Read data to train the prediction from a text file.
 
+        The file is read line by line. The n-grams are counted in
+        chunks of at most TRAINING_CHUNK_MAX_NGRAMS different n-grams,
+        each chunk is added to the frequencies in the user database in
+        one transaction. So the memory needed does not depend on the
+        size of the file or of the user database. If reading the file
+        fails, the chunks learned before are kept.
+
         :param filename: Full path of the text file to read.
         :type filename: String
+        :param progress_callback: Called after each chunk with the
+                                  fraction of the file read so far,
+                                  a float between 0.0 and 1.0
+        :type progress_callback: Function or None
+        :rtype: Boolean
         '''
         if not os.path.isfile(filename):
             return False
-        rows = self.db.execute(
-            'SELECT input_phrase, phrase, p_phrase, pp_phrase, '
-            + 'user_freq, timestamp FROM phrases;').fetchall()
+        self.flush_pending_updates()
+        errors = self._writer.errors
+        file_size = max(1, os.path.getsize(filename))
+        bytes_read = 0
         p_token = ''
         pp_token = ''
-        database_dict = {}
-        for x  in rows:
-            database_dict.update([((x[0], x[1], x[2], x[3]),
-                                   {'input_phrase': x[0],
-                                    'phrase': x[1],
-                                    'p_phrase': x[2],
-                                    'pp_phrase': x[3],
-                                    'user_freq': x[4],
-                                    'timestamp': x[5]}
-                                  )])
-        lines = []
+        updates = {}
         try:
-            with codecs.open(filename, encoding='UTF-8') as file_handle:
-                lines = [
-                    unicodedata.normalize(
-                        itb_util.NORMALIZATION_FORM_INTERNAL, x)
-                    for x in file_handle.readlines()]
+            with open(filename, 'rb') as file_handle:
+                for line in file_handle:
+                    bytes_read += len(line)
+                    line = unicodedata.normalize(
+                        itb_util.NORMALIZATION_FORM_INTERNAL,
+                        line.decode('UTF-8'))
+                    for token in itb_util.tokenize(line):
+                        key = (token, token, p_token, pp_token)
+                        updates[key] = updates.get(key, 0) + 1
+                        pp_token = p_token
+                        p_token = token
+                    if len(updates) >= TRAINING_CHUNK_MAX_NGRAMS:
+                        self._merge_training_chunk(updates)
+                        updates = {}
+                        if progress_callback:
+                            progress_callback(bytes_read / file_size)
         except:
             traceback.print_exc()
             return False
-        for line in lines:
-            for token in itb_util.tokenize(line):
-                key = (token, token, p_token, pp_token)
-                if key in database_dict:
-                    database_dict[key]['user_freq'] += 1
-                    database_dict[key]['timestamp'] = time.time()
-                else:
-                    database_dict[key] = {'input_phrase': token,
-                                          'phrase': token,
-                                          'p_phrase': p_token,
-                                          'pp_phrase': pp_token,
-                                          'user_freq': 1,
-                                          'timestamp': time.time()}
-                pp_token = p_token
-                p_token = token
-        sqlargs = []
-        for x in database_dict.keys():
-            sqlargs.append(database_dict[x])
-        sqlstr = '''
-        INSERT INTO user_db.phrases (input_phrase, phrase, p_phrase, pp_phrase, user_freq, timestamp)
-        VALUES (:input_phrase, :phrase, :p_phrase, :pp_phrase, :user_freq, :timestamp)
-        ;'''
+        self._merge_training_chunk(updates)
+        return self._finish_training(errors, progress_callback)
+
+    def read_training_data_from_files(
+            self, filenames, progress_callback=None, processes=None):
+        '''
+        Read data to train the prediction from several text files.
+
+        Directories are searched recursively for files. The files are
+        split into shards of about TRAINING_SHARD_BYTES (at line
+        boundaries) and the n-grams of the shards are counted in
+        parallel by a pool of worker processes (map). The counts
+        returned by the workers are summed in this process in chunks
+        of at most TRAINING_CHUNK_MAX_NGRAMS different n-grams which
+        are merged into the user database like in
+        read_training_data_from_file() (reduce).
+
+        Only a few more shards than workers are in flight at a time,
+        so the memory needed does not depend on the size of the files.
+
+        As the context starts empty at the beginning of each shard,
+        the first two tokens of a shard are counted without the last
+        tokens of the previous shard as context. Apart from that the
+        result is the same as reading the files one by one with
+        read_training_data_from_file().
+
+        :param filenames: Full paths of text files or directories
+        :type filenames: List of strings
+        :param progress_callback: Called after each shard with the
+                                  fraction of the bytes read so far,
+                                  a float between 0.0 and 1.0
+        :type progress_callback: Function or None
+        :param processes: The number of worker processes,
+                          os.cpu_count() if None
+        :type processes: Integer or None
+        :rtype: Boolean
+        '''
+        shards = _training_shards(filenames)
+        if not shards:
+            return False
+        if not processes:
+            processes = os.cpu_count() or 1
+        processes = min(processes, len(shards))
+        self.flush_pending_updates()
+        errors = self._writer.errors
+        total_size = max(1, sum([end - start for (_, start, end) in shards]))
+        bytes_read = 0
+        updates = {}
+        pool = None
         try:
-            self.db.execute('DELETE FROM phrases;')
-            # Without the following commit, the self.db.executemany() fails
-            # with “OperationalError: database is locked”.
-            self.db.commit()
-            self.db.executemany(sqlstr, sqlargs)
-            self.db.commit()
-            self.db.execute('PRAGMA wal_checkpoint;')
+            if processes > 1:
+                # Not “fork”, the engine and the setup tool have
+                # threads running which a forked child would inherit
+                # in an undefined state:
+                pool = multiprocessing.get_context('spawn').Pool(processes)
+                pending = collections.deque()
+                for shard in shards[:2 * processes]:
+                    pending.append(
+                        pool.apply_async(_count_training_ngrams, (shard,)))
+                next_shard = 2 * processes
+            for shard in shards:
+                if pool:
+                    (shard_size, counts) = pending.popleft().get()
+                    if next_shard < len(shards):
+                        pending.append(pool.apply_async(
+                            _count_training_ngrams, (shards[next_shard],)))
+                        next_shard += 1
+                else:
+                    (shard_size, counts) = _count_training_ngrams(shard)
+                for ((token, p_token, pp_token), count) in counts.items():
+                    key = (token, token, p_token, pp_token)
+                    updates[key] = updates.get(key, 0) + count
+                del counts
+                bytes_read += shard_size
+                if len(updates) >= TRAINING_CHUNK_MAX_NGRAMS:
+                    self._merge_training_chunk(updates)
+                    updates = {}
+                if progress_callback:
+                    progress_callback(bytes_read / total_size)
         except:
             traceback.print_exc()
             return False
-        return True
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+        self._merge_training_chunk(updates)
+        return self._finish_training(errors, progress_callback)
+
+    def _finish_training(self, errors, progress_callback):
+        '''Wait until the learned n-grams are written to the user
+        database
+
+        :param errors: The number of errors of the writer before
+                       training started
+        :type errors: Integer
+        :param progress_callback: Called with 1.0 when done
+        :type progress_callback: Function or None
+        :return: True if no write failed while training
+        :rtype: Boolean
+        '''
+        self._writer.wait()
+        if progress_callback:
+            progress_callback(1.0)
+        if (self._ngram_trie is not None
+                and len(self._ngram_trie) > NGRAM_TRIE_MAX_ROWS):
+            sys.stderr.write(
+                "The user database has become too big "
+                + "for the in-memory n-gram trie.\n")
+            self._ngram_trie = None
+        return self._writer.errors == errors
+
+    def _merge_training_chunk(self, updates):
+        '''Add a chunk of n-gram counts from a training file to the
+        user database
+
+        The next chunk can be counted while the writer thread merges
+        this one, but not more, to bound the memory needed.
+
+        :param updates: The counts of the n-grams, keyed by
+                        (input_phrase, phrase, p_phrase, pp_phrase)
+        :type updates: Dictionary
+        '''
+        if not updates:
+            return
+        self._writer.wait()
+        self._generation += 1
+        if self._ngram_trie is not None:
+            for ((input_phrase, phrase, p_phrase, pp_phrase),
+                 user_freq_increment) in updates.items():
+                self._ngram_trie.add(
+                    input_phrase, phrase, p_phrase, pp_phrase,
+                    user_freq_increment)
+        self._submit_frequency_updates(updates)
 
     def remove_all_phrases(self):
         '''
         Remove all phrases from the database, i.e. delete all the
         data learned from user input or text files.
         '''
-        try:
-            self.db.execute('DELETE FROM phrases;')
-            self.db.commit()
-            self.db.execute('PRAGMA wal_checkpoint;')
-        except:
-            traceback.print_exc()
+        self._pending_updates = {}
+        self._generation += 1
+        if self._ngram_trie is not None:
+            self._ngram_trie = NgramTrie()
+        self._writer.call(self._writer.remove_all_phrases)
 
     def dump_database(self):
         '''
@@ -954,6 +3150,9 @@ CREATE TABLE phrases (id INTEGER PRIMARY KEY, input_phrase TEXT, phrase TEXT, p_
             sys.stderr.write('SELECT * FROM desc;\n')
             for row in self.db.execute("SELECT * FROM desc;").fetchall():
                 sys.stderr.write('%s\n' %repr(row))
+            sys.stderr.write('SELECT * FROM tokens;\n')
+            for row in self.db.execute("SELECT * FROM tokens;").fetchall():
+                sys.stderr.write('%s\n' %repr(row))
             sys.stderr.write('SELECT * FROM phrases;\n')
             for row in self.db.execute("SELECT * FROM phrases;").fetchall():
                 sys.stderr.write('%s\n' %repr(row))
@@ -961,3 +3160,255 @@ CREATE TABLE phrases (id INTEGER PRIMARY KEY, input_phrase TEXT, phrase TEXT, p_
             import traceback
             traceback.print_exc()
             return
+
+# TabSqliteDb objects shared by the engines in this process, indexed
+# by the file name of the user database. The values are lists
+# [database, reference count]. Sharing one object means one
+# connection, one writer thread, one n-gram trie and one cache of
+# select_words() for all engines, and that each engine sees what
+# the others have learned right away:
+_SHARED_DATABASES = {}
+_SHARED_DATABASES_LOCK = threading.Lock()
+
+def get_shared_database(user_db_file='', **kwargs):
+    '''Returns the TabSqliteDb for a user database shared with the
+    other users of that database in this process
+
+    The database is opened by the first call, the keyword arguments
+    are passed to TabSqliteDb() then and are ignored by later calls.
+    Every call must be balanced by a call of release_shared_database().
+
+    An in-memory database is never shared, each call returns a new
+    one.
+
+    :param user_db_file: The file name of the user database,
+                         ':memory:' for an in-memory database,
+                         or '' for the default location
+    :type user_db_file: String
+    :rtype: TabSqliteDb
+    '''
+    user_db_file = _user_db_path(user_db_file)
+    if user_db_file == ':memory:':
+        return TabSqliteDb(user_db_file=user_db_file, **kwargs)
+    with _SHARED_DATABASES_LOCK:
+        entry = _SHARED_DATABASES.get(user_db_file)
+        if entry is None:
+            entry = [TabSqliteDb(user_db_file=user_db_file, **kwargs), 0]
+            _SHARED_DATABASES[user_db_file] = entry
+        entry[1] += 1
+        if DEBUG_LEVEL > 1:
+            sys.stderr.write(
+                'get_shared_database(%s) reference count=%s\n'
+                %(user_db_file, entry[1]))
+        return entry[0]
+
+def release_shared_database(database):
+    '''Releases a TabSqliteDb returned by get_shared_database()
+
+    The pending updates are written in any case. When the last user
+    has released the database, a checkpoint is made and it is
+    dropped from the registry.
+
+    :param database: The database to release
+    :type database: TabSqliteDb
+    '''
+    with _SHARED_DATABASES_LOCK:
+        entry = _SHARED_DATABASES.get(database.user_db_file)
+        if entry is None or entry[0] is not database:
+            database.sync_usrdb()
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            database.flush_pending_updates()
+            return
+        del _SHARED_DATABASES[database.user_db_file]
+    database.sync_usrdb()
+
+# The query of select_words() on a user database of version 0.65,
+# where the strings were stored in each row of the phrases table.
+# Only used to compare the size and the latency in main():
+_SELECT_WORDS_SQL_0_65 = (
+    'SELECT phrase, sum(user_freq), '
+    + 'sum(CASE WHEN p_phrase = :p_phrase '
+    + 'THEN user_freq ELSE 0 END), '
+    + 'sum(p_phrase = :p_phrase), '
+    + 'sum(CASE WHEN p_phrase = :p_phrase '
+    + 'AND pp_phrase = :pp_phrase THEN user_freq ELSE 0 END), '
+    + 'sum(p_phrase = :p_phrase AND pp_phrase = :pp_phrase) '
+    + 'FROM user_db.phrases WHERE input_phrase >= :input_phrase '
+    + 'AND input_phrase < :input_phrase_upper GROUP BY phrase;')
+
+def _create_user_db_0_65(user_db_file, rows, unique_index=True):
+    '''Create a user database of version 0.65
+
+    :param user_db_file: The file name of the database
+    :type user_db_file: String
+    :param rows: The rows of the phrases table, tuples of
+                 (input_phrase, phrase, p_phrase, pp_phrase,
+                 user_freq, timestamp)
+    :type rows: List of tuples
+    :param unique_index: Whether to create the unique index on the
+                         n-grams. Databases created before that index
+                         was added may contain duplicate rows, these
+                         are kept if this is False.
+    :type unique_index: Boolean
+    '''
+    database = sqlite3.connect(user_db_file)
+    database.executescript('''
+    PRAGMA page_size = 4096;
+    PRAGMA journal_mode = WAL;
+    CREATE TABLE desc (name PRIMARY KEY, value);
+    INSERT INTO desc VALUES ('version', '0.65');
+    CREATE TABLE phrases
+    (id INTEGER PRIMARY KEY,
+    input_phrase TEXT, phrase TEXT, p_phrase TEXT, pp_phrase TEXT,
+    user_freq INTEGER, timestamp REAL);
+    CREATE INDEX phrases_index_p ON phrases (input_phrase, id ASC);
+    CREATE INDEX phrases_index_i ON phrases (phrase);
+    ''')
+    if unique_index:
+        database.execute(
+            'CREATE UNIQUE INDEX phrases_index_unique '
+            + 'ON phrases (input_phrase, phrase, p_phrase, pp_phrase);')
+    database.executemany(
+        'INSERT OR IGNORE INTO phrases (input_phrase, phrase, '
+        + 'p_phrase, pp_phrase, user_freq, timestamp) '
+        + 'VALUES (?, ?, ?, ?, ?, ?);',
+        rows)
+    database.commit()
+    database.execute('VACUUM;')
+    database.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+    database.close()
+
+def _benchmark_user_db(number_of_rows, number_of_lookups=300):
+    '''Create a user database of version 0.65 with random phrases,
+    migrate it to the current version and compare the size of the
+    database files and the latency of the query of select_words()
+
+    :param number_of_rows: Number of rows of the phrases table
+    :type number_of_rows: Integer
+    :param number_of_lookups: Number of prefixes to look up
+    :type number_of_lookups: Integer
+    :rtype: Tuple (size_0_65, latency_0_65, size, latency) where the
+            sizes are in bytes and the latencies are the averages in
+            milliseconds
+    '''
+    import random
+    import itertools
+    import tempfile
+    import shutil
+    random.seed(number_of_rows)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocabulary = [
+        ''.join(random.choice(letters)
+                for dummy in range(random.randint(2, 12)))
+        for dummy in range(max(100, number_of_rows // 10))]
+    # The context words follow a Zipf like distribution, as in real
+    # text a few words occur very often:
+    cum_weights = list(itertools.accumulate(
+        1.0 / rank for rank in range(1, len(vocabulary) + 1)))
+    rows = []
+    for dummy in range(number_of_rows):
+        phrase = random.choice(vocabulary)
+        (p_phrase, pp_phrase) = random.choices(
+            vocabulary, cum_weights=cum_weights, k=2)
+        rows.append((phrase[:random.randint(1, len(phrase))], phrase,
+                     p_phrase, pp_phrase, random.randint(1, 10), time.time()))
+    lookups = []
+    for dummy in range(number_of_lookups):
+        (dummy_input_phrase, phrase, p_phrase, pp_phrase,
+         dummy_user_freq, dummy_timestamp) = random.choice(rows)
+        lookups.append(
+            (phrase[:random.randint(1, len(phrase))], p_phrase, pp_phrase))
+    directory = tempfile.mkdtemp()
+    user_db_file = path.join(directory, 'user.db')
+    try:
+        _create_user_db_0_65(user_db_file, rows)
+        size_0_65 = path.getsize(user_db_file)
+        database = sqlite3.connect(user_db_file)
+        database.execute('ATTACH DATABASE "%s" AS user_db;' % user_db_file)
+        time_start = time.time()
+        for (input_phrase, p_phrase, pp_phrase) in lookups:
+            database.execute(
+                _SELECT_WORDS_SQL_0_65,
+                {'input_phrase': input_phrase,
+                 'input_phrase_upper': prefix_upper_bound(input_phrase),
+                 'p_phrase': p_phrase,
+                 'pp_phrase': pp_phrase}).fetchall()
+        latency_0_65 = (time.time() - time_start) / number_of_lookups * 1000
+        database.close()
+        database = TabSqliteDb(user_db_file=user_db_file)
+        database.db.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+        size = path.getsize(user_db_file)
+        sqlstr = SELECT_WORDS_SQL % {
+            'where': 'text >= :input_phrase AND text < :input_phrase_upper'}
+        time_start = time.time()
+        for (input_phrase, p_phrase, pp_phrase) in lookups:
+            database.db.execute(
+                sqlstr,
+                {'input_phrase': input_phrase,
+                 'input_phrase_upper': prefix_upper_bound(input_phrase),
+                 'p_phrase': database._get_token_id(p_phrase),
+                 'pp_phrase': database._get_token_id(pp_phrase)}).fetchall()
+        latency = (time.time() - time_start) / number_of_lookups * 1000
+        database.db.close()
+    finally:
+        shutil.rmtree(directory)
+    return (size_0_65, latency_0_65, size, latency)
+
+def main():
+    '''
+    Used for testing and profiling.
+
+    “python3 tabsqlitedb.py”
+
+    runs the doctests.
+
+    “python3 tabsqlitedb.py --benchmark [<rows> ...]”
+
+    compares the size and the lookup latency of user databases of
+    version 0.65 and of the current version with the given numbers
+    of rows, 10000, 100000 and 1000000 by default.
+
+    “python3 tabsqlitedb.py --import-system-db <file> [<database>]”
+
+    builds the system n-gram database from an ARPA file or a file
+    of n-gram counts, see import_system_db(). The default
+    <database> is
+    “~/.local/share/ibus-typing-booster/data/system_ngrams.db”.
+    The engine uses it when the “systemngramdb” setting is the full
+    path of the database.
+    '''
+    if len(sys.argv) > 2 and sys.argv[1] == '--import-system-db':
+        if len(sys.argv) > 3:
+            system_db_file = sys.argv[3]
+        else:
+            system_db_file = path.join(
+                itb_util.xdg_save_data_path('ibus-typing-booster/data'),
+                SYSTEM_DB_FILE_NAME)
+        def show_progress(fraction):
+            sys.stderr.write('\r%3d %%' %int(fraction * 100))
+        imported = import_system_db(
+            sys.argv[2], system_db_file, progress_callback=show_progress)
+        sys.stderr.write('\n')
+        sys.exit(0 if imported else 1)
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        for number_of_rows in (
+                [int(x) for x in sys.argv[2:]] or [10000, 100000, 1000000]):
+            (size_0_65, latency_0_65, size, latency) = _benchmark_user_db(
+                number_of_rows)
+            print('%7d rows: version 0.65 %6.1f MB %7.3f ms, '
+                  % (number_of_rows, size_0_65 / 1e6, latency_0_65)
+                  + 'version %s %6.1f MB %7.3f ms per lookup'
+                  % (USER_DATABASE_VERSION, size / 1e6, latency))
+        sys.exit(0)
+
+    import doctest
+    (failed, dummy_attempted) = doctest.testmod()
+    if failed:
+        sys.exit(1)
+    else:
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
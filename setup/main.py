@@ -545,6 +545,28 @@ class SetupUI(Gtk.Window):
         if self._arrow_keys_reopen_preedit is True:
             self._arrow_keys_reopen_preedit_checkbutton.set_active(True)
 
+        self._fast_typo_correction_checkbutton = Gtk.CheckButton(
+            # Translators: Whether an additional index of the
+            # dictionaries is used to find corrections for typos
+            # quickly, even for short words.
+            label=_('Fast typo correction'))
+        self._fast_typo_correction_checkbutton.set_tooltip_text(
+            _('Whether an additional index of the dictionaries is '
+              + 'used to find corrections for typos quickly, even '
+              + 'for short words. Building this index takes some time '
+              + 'when a dictionary is used for the first time and it '
+              + 'needs some disk space.'))
+        self._fast_typo_correction_checkbutton.connect(
+            'clicked', self.on_fast_typo_correction_checkbutton)
+        self._options_grid.attach(
+            self._fast_typo_correction_checkbutton, 0, 9, 2, 1)
+        self._fast_typo_correction = itb_util.variant_to_value(
+            self._gsettings.get_value('fasttypocorrection'))
+        if self._fast_typo_correction is None:
+            self._fast_typo_correction = False
+        if self._fast_typo_correction is True:
+            self._fast_typo_correction_checkbutton.set_active(True)
+
         self._auto_commit_characters_label = Gtk.Label()
         self._auto_commit_characters_label.set_text(
             # Translators: The characters in this list cause the
@@ -577,11 +599,11 @@ class SetupUI(Gtk.Window):
               + 'list empty (which is the default).'))
         self._auto_commit_characters_label.set_xalign(0)
         self._options_grid.attach(
-            self._auto_commit_characters_label, 0, 9, 1, 1)
+            self._auto_commit_characters_label, 0, 10, 1, 1)
 
         self._auto_commit_characters_entry = Gtk.Entry()
         self._options_grid.attach(
-            self._auto_commit_characters_entry, 1, 9, 1, 1)
+            self._auto_commit_characters_entry, 1, 10, 1, 1)
         self._auto_commit_characters = itb_util.variant_to_value(
             self._gsettings.get_value('autocommitcharacters'))
         if not self._auto_commit_characters:
@@ -601,7 +623,7 @@ class SetupUI(Gtk.Window):
               + 'of characters have been typed.'))
         self._min_chars_completion_label.set_xalign(0)
         self._options_grid.attach(
-            self._min_chars_completion_label, 0, 10, 1, 1)
+            self._min_chars_completion_label, 0, 11, 1, 1)
 
         self._min_char_complete_adjustment = Gtk.SpinButton()
         self._min_char_complete_adjustment.set_visible(True)
@@ -609,7 +631,7 @@ class SetupUI(Gtk.Window):
         self._min_char_complete_adjustment.set_increments(1.0, 1.0)
         self._min_char_complete_adjustment.set_range(1.0, 9.0)
         self._options_grid.attach(
-            self._min_char_complete_adjustment, 1, 10, 1, 1)
+            self._min_char_complete_adjustment, 1, 11, 1, 1)
         self._min_char_complete = itb_util.variant_to_value(
             self._gsettings.get_value('mincharcomplete'))
         if self._min_char_complete:
@@ -633,7 +655,7 @@ class SetupUI(Gtk.Window):
               + 'may also be shown graphically.'))
         self._debug_level_label.set_xalign(0)
         self._options_grid.attach(
-            self._debug_level_label, 0, 11, 1, 1)
+            self._debug_level_label, 0, 12, 1, 1)
 
         self._debug_level_adjustment = Gtk.SpinButton()
         self._debug_level_adjustment.set_visible(True)
@@ -641,7 +663,7 @@ class SetupUI(Gtk.Window):
         self._debug_level_adjustment.set_increments(1.0, 1.0)
         self._debug_level_adjustment.set_range(0.0, 255.0)
         self._options_grid.attach(
-            self._debug_level_adjustment, 1, 11, 1, 1)
+            self._debug_level_adjustment, 1, 12, 1, 1)
         self._debug_level = itb_util.variant_to_value(
             self._gsettings.get_value('debuglevel'))
         if self._debug_level:
@@ -661,7 +683,7 @@ class SetupUI(Gtk.Window):
         self._learn_from_file_button.set_tooltip_text(
             _('Learn your style by reading a text file'))
         self._options_grid.attach(
-            self._learn_from_file_button, 0, 12, 2, 1)
+            self._learn_from_file_button, 0, 13, 2, 1)
         self._learn_from_file_button.connect(
             'clicked', self.on_learn_from_file_clicked)
 
@@ -673,10 +695,36 @@ class SetupUI(Gtk.Window):
             _('Delete all personal language data learned from '
               + 'typing or from reading files'))
         self._options_grid.attach(
-            self._delete_learned_data_button, 0, 13, 2, 1)
+            self._delete_learned_data_button, 0, 14, 2, 1)
         self._delete_learned_data_button.connect(
             'clicked', self.on_delete_learned_data_clicked)
 
+        self._backup_learned_data_button = Gtk.Button(
+            # Translators: A button used to popup a file selector to
+            # choose where to save a copy of all personal language
+            # data learned from typing or from reading files.
+            label=_('Back up learned data'))
+        self._backup_learned_data_button.set_tooltip_text(
+            _('Save a copy of all personal language data learned from '
+              + 'typing or from reading files'))
+        self._options_grid.attach(
+            self._backup_learned_data_button, 0, 15, 1, 1)
+        self._backup_learned_data_button.connect(
+            'clicked', self.on_backup_learned_data_clicked)
+
+        self._restore_learned_data_button = Gtk.Button(
+            # Translators: A button used to popup a file selector to
+            # choose a saved copy of the personal language data which
+            # then replaces the current language data.
+            label=_('Restore learned data'))
+        self._restore_learned_data_button.set_tooltip_text(
+            _('Replace the personal language data by a copy saved '
+              + 'earlier'))
+        self._options_grid.attach(
+            self._restore_learned_data_button, 1, 15, 1, 1)
+        self._restore_learned_data_button.connect(
+            'clicked', self.on_restore_learned_data_clicked)
+
         self._dictionaries_label = Gtk.Label()
         self._dictionaries_label.set_text(
             # Translators: This is the header of the list of
@@ -1935,6 +1983,9 @@ class SetupUI(Gtk.Window):
         if key == 'arrowkeysreopenpreedit':
             self.set_arrow_keys_reopen_preedit(value, update_gsettings=False)
             return
+        if key == 'fasttypocorrection':
+            self.set_fast_typo_correction(value, update_gsettings=False)
+            return
         if key == 'emojipredictions':
             self.set_emoji_prediction_mode(value, update_gsettings=False)
             return
@@ -2319,6 +2370,14 @@ class SetupUI(Gtk.Window):
         self.set_arrow_keys_reopen_preedit(
             widget.get_active(), update_gsettings=True)
 
+    def on_fast_typo_correction_checkbutton(self, widget):
+        '''
+        The checkbutton whether to use an index of the dictionaries
+        for fast typo correction, has been clicked.
+        '''
+        self.set_fast_typo_correction(
+            widget.get_active(), update_gsettings=True)
+
     def on_auto_commit_characters_entry(self, widget, _property_spec):
         '''
         The list of characters triggering an auto commit has been changed.
@@ -3291,21 +3350,48 @@ class SetupUI(Gtk.Window):
         has been clicked.
         '''
         self._learn_from_file_button.set_sensitive(False)
-        filename = ''
+        filenames = []
         chooser = Gtk.FileChooserDialog(
             title=_('Open File ...'),
             parent=self,
             action=Gtk.FileChooserAction.OPEN)
         chooser.add_button(_('_Cancel'), Gtk.ResponseType.CANCEL)
         chooser.add_button(_('_OK'), Gtk.ResponseType.OK)
+        chooser.set_select_multiple(True)
         response = chooser.run()
         if response == Gtk.ResponseType.OK:
-            filename = chooser.get_filename()
+            filenames = [filename for filename in chooser.get_filenames()
+                         if os.path.isfile(filename)]
         chooser.destroy()
         while Gtk.events_pending():
             Gtk.main_iteration()
-        if filename and os.path.isfile(filename):
-            if self.tabsqlitedb.read_training_data_from_file(filename):
+        if filenames:
+            filename = ', '.join(filenames)
+            progress_dialog = Gtk.Dialog(
+                title=_('Learning from file ...'),
+                parent=self)
+            progress_dialog.set_modal(True)
+            # Learning cannot be cancelled, do not close the dialog:
+            progress_dialog.connect('delete-event', lambda *_args: True)
+            progress_bar = Gtk.ProgressBar()
+            progress_bar.set_show_text(True)
+            margin = 10
+            progress_bar.set_margin_start(margin)
+            progress_bar.set_margin_end(margin)
+            progress_bar.set_margin_top(margin)
+            progress_bar.set_margin_bottom(margin)
+            progress_dialog.get_content_area().add(progress_bar)
+            progress_dialog.show_all()
+            while Gtk.events_pending():
+                Gtk.main_iteration()
+            def show_progress(fraction):
+                progress_bar.set_fraction(fraction)
+                while Gtk.events_pending():
+                    Gtk.main_iteration()
+            learned = self.tabsqlitedb.read_training_data_from_files(
+                filenames, progress_callback=show_progress)
+            progress_dialog.destroy()
+            if learned:
                 dialog = Gtk.MessageDialog(
                     parent=self,
                     flags=Gtk.DialogFlags.MODAL,
@@ -3350,6 +3436,108 @@ class SetupUI(Gtk.Window):
             self.tabsqlitedb.remove_all_phrases()
         self._delete_learned_data_button.set_sensitive(True)
 
+    def on_backup_learned_data_clicked(self, _widget):
+        '''
+        The button to save a copy of the data learned from
+        user input or text files has been clicked.
+        '''
+        self._backup_learned_data_button.set_sensitive(False)
+        filename = ''
+        chooser = Gtk.FileChooserDialog(
+            title=_('Save File ...'),
+            parent=self,
+            action=Gtk.FileChooserAction.SAVE)
+        chooser.add_button(_('_Cancel'), Gtk.ResponseType.CANCEL)
+        chooser.add_button(_('_OK'), Gtk.ResponseType.OK)
+        chooser.set_do_overwrite_confirmation(True)
+        chooser.set_current_name(
+            os.path.basename(self.tabsqlitedb.user_db_file)
+            + tabsqlitedb.USER_DB_BACKUP_SUFFIX)
+        response = chooser.run()
+        if response == Gtk.ResponseType.OK:
+            filename = chooser.get_filename()
+        chooser.destroy()
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+        if filename:
+            # The copy is made right away, in a single step:
+            if self.tabsqlitedb.backup_user_db(
+                    filename, step_pages=-1, wait=True):
+                dialog = Gtk.MessageDialog(
+                    parent=self,
+                    flags=Gtk.DialogFlags.MODAL,
+                    message_type=Gtk.MessageType.INFO,
+                    buttons=Gtk.ButtonsType.OK,
+                    message_format=(
+                        _('Learned data saved to %(filename)s.')
+                        %{'filename': filename}))
+            else:
+                dialog = Gtk.MessageDialog(
+                    parent=self,
+                    flags=Gtk.DialogFlags.MODAL,
+                    message_type=Gtk.MessageType.ERROR,
+                    buttons=Gtk.ButtonsType.OK,
+                    message_format=(
+                        _('Saving the learned data to %(filename)s failed.')
+                        %{'filename': filename}))
+            dialog.run()
+            dialog.destroy()
+        self._backup_learned_data_button.set_sensitive(True)
+
+    def on_restore_learned_data_clicked(self, _widget):
+        '''
+        The button to replace the data learned from user input or
+        text files by a saved copy has been clicked.
+        '''
+        self._restore_learned_data_button.set_sensitive(False)
+        filename = ''
+        chooser = Gtk.FileChooserDialog(
+            title=_('Open File ...'),
+            parent=self,
+            action=Gtk.FileChooserAction.OPEN)
+        chooser.add_button(_('_Cancel'), Gtk.ResponseType.CANCEL)
+        chooser.add_button(_('_OK'), Gtk.ResponseType.OK)
+        response = chooser.run()
+        if response == Gtk.ResponseType.OK:
+            filename = chooser.get_filename()
+        chooser.destroy()
+        while Gtk.events_pending():
+            Gtk.main_iteration()
+        if filename:
+            response = self._run_are_you_sure_dialog(
+                # Translators: This is the text in the centre of a
+                # small dialog window, trying to confirm whether the
+                # user is really sure to replace all the data
+                # ibus-typing-booster has learned by a copy saved
+                # earlier. What has been learned since that copy was
+                # saved is lost.
+                _('Do you really want to replace all language data '
+                  + 'learned from typing or reading files by the copy '
+                  + 'in %(filename)s?') %{'filename': filename})
+            if response == Gtk.ResponseType.OK:
+                if self.tabsqlitedb.restore_user_db(filename):
+                    dialog = Gtk.MessageDialog(
+                        parent=self,
+                        flags=Gtk.DialogFlags.MODAL,
+                        message_type=Gtk.MessageType.INFO,
+                        buttons=Gtk.ButtonsType.OK,
+                        message_format=(
+                            _('Learned data restored from %(filename)s.')
+                            %{'filename': filename}))
+                else:
+                    dialog = Gtk.MessageDialog(
+                        parent=self,
+                        flags=Gtk.DialogFlags.MODAL,
+                        message_type=Gtk.MessageType.ERROR,
+                        buttons=Gtk.ButtonsType.OK,
+                        message_format=(
+                            _('%(filename)s is not a usable copy of '
+                              + 'the learned data.')
+                            %{'filename': filename}))
+                dialog.run()
+                dialog.destroy()
+        self._restore_learned_data_button.set_sensitive(True)
+
     def set_qt_im_module_workaround(self, mode, update_gsettings=True):
         '''Sets whether the workaround for the qt im module is used or not
 
@@ -3400,6 +3588,32 @@ class SetupUI(Gtk.Window):
         else:
             self._arrow_keys_reopen_preedit_checkbutton.set_active(mode)
 
+    def set_fast_typo_correction(self, mode, update_gsettings=True):
+        '''Sets whether an index of the dictionaries is used for
+        fast typo correction
+
+        :param mode: Whether to use the index for fast typo correction
+        :type mode: boolean
+        :param update_gsettings: Whether to write the change to Gsettings.
+                                 Set this to False if this method is
+                                 called because the Gsettings key changed
+                                 to avoid endless loops when the Gsettings
+                                 key is changed twice in a short time.
+        :type update_gsettings: boolean
+        '''
+        sys.stderr.write(
+            "set_fast_typo_correction(%s, update_gsettings = %s)\n"
+            %(mode, update_gsettings))
+        if mode == self._fast_typo_correction:
+            return
+        self._fast_typo_correction = mode
+        if update_gsettings:
+            self._gsettings.set_value(
+                'fasttypocorrection',
+                GLib.Variant.new_boolean(mode))
+        else:
+            self._fast_typo_correction_checkbutton.set_active(mode)
+
     def set_emoji_prediction_mode(self, mode, update_gsettings=True):
         '''Sets the emoji prediction mode
 
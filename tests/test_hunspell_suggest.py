@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+# vim:et sts=4 sw=4
+#
+# ibus-typing-booster - A completion input method for IBus
+#
+# Copyright (c) 2016 Mike FABIAN <mfabian@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+'''
+This file implements test cases for the lookups in the hunspell
+dictionaries of hunspell_suggest
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unicodedata
+import unittest
+from unittest import mock
+
+sys.path.insert(0, "../engine")
+import hunspell_suggest
+import itb_util
+sys.path.pop(0)
+
+def dictionary_installed(name):
+    '''Whether the hunspell dictionary “name” is installed'''
+    return bool(itb_util.find_hunspell_dictionary(name)[0])
+
+class CompletionRangeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.keys = sorted(
+            ['a', 'ab', 'abc', 'abd', 'b', 'ba', 'bé', 'béb', 'c'])
+
+    def brute_force(self, prefix):
+        return [key for key in self.keys if key.startswith(prefix)]
+
+    def test_completion_range(self):
+        for prefix in ('', 'a', 'ab', 'abc', 'abe', 'b', 'bé', 'x', 'é'):
+            (first, last) = hunspell_suggest._completion_range(
+                self.keys, prefix)
+            self.assertEqual(self.keys[first:last], self.brute_force(prefix))
+
+    def test_completion_range_narrowed(self):
+        (low, high) = hunspell_suggest._completion_range(self.keys, 'a')
+        (first, last) = hunspell_suggest._completion_range(
+            self.keys, 'ab', low, high)
+        self.assertEqual(self.keys[first:last], ['ab', 'abc', 'abd'])
+        # An empty range stays empty when narrowed further:
+        (low, high) = hunspell_suggest._completion_range(self.keys, 'ax')
+        (first, last) = hunspell_suggest._completion_range(
+            self.keys, 'axy', low, high)
+        self.assertEqual(first, last)
+
+    @unittest.skipUnless(
+        dictionary_installed('en_US'),
+        'Skipping because the en_US hunspell dictionary is not installed.')
+    def test_incremental_narrowing_and_backspace(self):
+        # Two Hunspell objects, like two engines, typing different
+        # words with the same shared dictionary:
+        hunspell = hunspell_suggest.Hunspell(['en_US'])
+        other_hunspell = hunspell_suggest.Hunspell(['en_US'])
+        dictionary = hunspell._dictionaries[0]
+        self.assertTrue(other_hunspell._dictionaries[0] is dictionary)
+        def brute_force(prefix):
+            return [word for (word, key)
+                    in zip(dictionary.words, dictionary.word_keys)
+                    if key.startswith(prefix)]
+        # Typing, backspacing to shorter prefixes, starting a new word
+        # and typing into a prefix without completions:
+        prefixes = ('c', 'co', 'col', 'colo', 'col', 'co', 'c', '',
+                    'cx', 'cxz', 'c', 'colour', 'colours', 'b', 'be')
+        other_prefixes = ('t', 'th', 'the', 'ther', 'there', 'b', 'bx',
+                          'b', 'be', 'bea', 'c', 'co', 'col', 'colo', 'q')
+        try:
+            for (prefix, other_prefix) in zip(prefixes, other_prefixes):
+                self.assertEqual(
+                    hunspell._completions(dictionary, prefix),
+                    brute_force(prefix), 'prefix=%r' %prefix)
+                self.assertEqual(
+                    other_hunspell._completions(dictionary, other_prefix),
+                    brute_force(other_prefix), 'prefix=%r' %other_prefix)
+                # Each one narrows from its own last lookup:
+                self.assertEqual(
+                    hunspell._last_completions['en_US'][1], prefix)
+                self.assertEqual(
+                    other_hunspell._last_completions['en_US'][1],
+                    other_prefix)
+            # The dictionary itself keeps no state:
+            (low, high) = dictionary.completion_range('c')
+            self.assertEqual(
+                dictionary.completions('co', low, high), brute_force('co'))
+            self.assertEqual(dictionary.completions('co'), brute_force('co'))
+        finally:
+            hunspell.release_dictionaries()
+            other_hunspell.release_dictionaries()
+
+class DeletionIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.keys = sorted([
+            'the', 'then', 'there', 'house', 'mouse', 'horse',
+            'information', 'informative', 'abcdefghijk'])
+        self.index = hunspell_suggest.DeletionIndex(
+            hunspell_suggest.DeletionIndex.build(self.keys))
+
+    def corrections(self, term, max_distance=None):
+        return [(distance, self.keys[position])
+                for (distance, position)
+                in self.index.corrections(
+                    self.keys, term, max_distance=max_distance)]
+
+    def test_distance_one(self):
+        # Substitution, deletion, insertion and transposition:
+        self.assertTrue((1, 'house') in self.corrections('hause'))
+        self.assertTrue((1, 'house') in self.corrections('hose'))
+        self.assertTrue((1, 'house') in self.corrections('houuse'))
+        self.assertTrue((1, 'house') in self.corrections('hosue'))
+        self.assertEqual(self.corrections('teh', max_distance=1),
+                         [(1, 'the')])
+
+    def test_distance_two(self):
+        corrections = self.corrections('hsoue')
+        self.assertTrue((2, 'house') in corrections)
+        # Sorted by distance:
+        self.assertEqual(corrections, sorted(corrections))
+        self.assertTrue((2, 'house') in self.corrections('hxusx'))
+        # Not found if only distance 1 is allowed:
+        self.assertFalse(
+            'house' in [x[1] for x in self.corrections('hsoue', 1)])
+
+    def test_long_words(self):
+        # Only the beginnings of the words are in the index, the
+        # distance of the whole word is verified:
+        self.assertEqual(self.corrections('infromation'),
+                         [(1, 'information')])
+        self.assertEqual(self.corrections('informatiev'),
+                         [(1, 'informative'), (2, 'information')])
+        self.assertEqual(self.corrections('abcdefghijkxyz'), [])
+
+    def test_misses(self):
+        self.assertEqual(self.corrections('xyzzy'), [])
+        self.assertEqual(self.corrections('houses!!!'), [])
+        # The term itself is not a correction:
+        self.assertFalse('house' in [x[1] for x in self.corrections('house')])
+        # Distances above DELETION_INDEX_MAX_DISTANCE are not used:
+        self.assertEqual(
+            self.corrections('hsoeu', max_distance=5),
+            self.corrections('hsoeu'))
+
+    def test_empty_index(self):
+        index = hunspell_suggest.DeletionIndex(
+            hunspell_suggest.DeletionIndex.build([]))
+        self.assertEqual(index.corrections([], 'house'), [])
+
+class AffixExpansionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dic_path = os.path.join(self.directory, 'xx_XX.dic')
+        self.aff_path = os.path.join(self.directory, 'xx_XX.aff')
+        with open(self.aff_path, 'w', encoding='UTF-8') as aff_file:
+            aff_file.write(
+                'SET UTF-8\n'
+                + 'PFX A Y 1\n'
+                + 'PFX A 0 re .\n'
+                + 'SFX S Y 3\n'
+                + 'SFX S y ies [^aeiou]y\n'
+                + 'SFX S 0 s [aeiou]y\n'
+                + 'SFX S 0 s [^y]\n'
+                + 'SFX D Y 1\n'
+                + 'SFX D 0 ed .\n')
+        with open(self.dic_path, 'w', encoding='UTF-8') as dic_file:
+            dic_file.write('4\ntry/AS\nplay/SD\nwork/ADS\nthe\n')
+        self.patchers = [
+            mock.patch.object(
+                itb_util, 'find_hunspell_dictionary',
+                lambda name: ((self.dic_path, self.aff_path)
+                              if name == 'xx_XX' else ('', ''))),
+            mock.patch.object(
+                hunspell_suggest, 'dictionary_cache_path',
+                lambda name, suffix='.index': os.path.join(
+                    self.directory, name + suffix)),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.directory)
+
+    def compile(self, max_affix_forms):
+        with mock.patch.object(
+                hunspell_suggest, 'MAX_AFFIX_FORMS_PER_STEM',
+                max_affix_forms):
+            signature = hunspell_suggest.dictionary_signature('xx_XX')
+            return (signature,
+                    hunspell_suggest.compile_word_index('xx_XX', signature))
+
+    @staticmethod
+    def words(index):
+        # The word count in the first line of the .dic file is in
+        # the word list as well:
+        return [word for word in index.words if not word.isdigit()]
+
+    def test_without_expansion(self):
+        (dummy_signature, index) = self.compile(0)
+        self.assertEqual(self.words(index), ['play', 'the', 'try', 'work'])
+
+    def test_expanded_word_index(self):
+        (signature, index) = self.compile(20)
+        self.assertEqual(
+            self.words(index),
+            ['play', 'played', 'plays', 'retries', 'retry',
+             'rework', 'reworked', 'reworks', 'the', 'tries', 'try',
+             'work', 'worked', 'works'])
+        self.assertEqual(list(index.completions('re')),
+                         ['retries', 'retry', 'rework', 'reworked',
+                          'reworks'])
+        # The index written to the cache is found again with the
+        # same signature only:
+        self.assertEqual(
+            list(hunspell_suggest.WordIndex.open(
+                hunspell_suggest.dictionary_cache_path('xx_XX'),
+                signature).words),
+            list(index.words))
+        (signature_without_expansion, dummy_index) = self.compile(0)
+        self.assertNotEqual(signature, signature_without_expansion)
+
+    def test_default_dictionary(self):
+        # Inflected forms complete from a prefix with the default
+        # settings:
+        with mock.patch.object(
+                hunspell_suggest, 'IMPORT_ENCHANT_SUCCESSFUL', False), \
+             mock.patch.object(
+                 hunspell_suggest, 'IMPORT_HUNSPELL_SUCCESSFUL', False):
+            dictionary = hunspell_suggest.Dictionary(name='xx_XX')
+        self.assertEqual(dictionary.completions('rew'),
+                         ['rework', 'reworked', 'reworks'])
+        self.assertEqual(dictionary.completions('trie'), ['tries'])
+
+    def test_max_forms(self):
+        (dummy_signature, index) = self.compile(1)
+        # At most one generated form per word of the .dic file:
+        self.assertEqual(len(self.words(index)), 4 + 3)
+
+class WordPoolTestCase(unittest.TestCase):
+    '''Dictionaries of the same language store their common words
+    once in a word pool'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'de.aff'), 'w',
+                  encoding='UTF-8') as aff_file:
+            aff_file.write('SET UTF-8\n')
+        self.write_dic('de_AA', ['Glühwürmchen', 'Glut', 'Haus', 'Maus'])
+        self.write_dic('de_BB', ['Glut', 'Haus', 'Straße', 'Strasse'])
+        self.patchers = [
+            mock.patch.object(
+                itb_util, 'find_hunspell_dictionary',
+                lambda name: (
+                    (os.path.join(self.directory, name + '.dic'),
+                     os.path.join(self.directory, 'de.aff'))
+                    if name in ('de_AA', 'de_BB') else ('', ''))),
+            mock.patch.object(
+                hunspell_suggest, 'dictionary_cache_path',
+                lambda name, suffix='.index': os.path.join(
+                    self.directory, name + suffix)),
+            # There is no enchant or pyhunspell dictionary for these:
+            mock.patch.object(
+                hunspell_suggest, 'IMPORT_ENCHANT_SUCCESSFUL', False),
+            mock.patch.object(
+                hunspell_suggest, 'IMPORT_HUNSPELL_SUCCESSFUL', False),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def nfc(words):
+        return sorted(unicodedata.normalize('NFC', x) for x in words)
+
+    def write_dic(self, name, words):
+        with open(os.path.join(self.directory, name + '.dic'), 'w',
+                  encoding='UTF-8') as dic_file:
+            dic_file.write('%d\n' % len(words) + '\n'.join(words) + '\n')
+
+    def test_shared_words(self):
+        dictionaries = [hunspell_suggest.Dictionary(name=name)
+                        for name in ('de_AA', 'de_BB')]
+        expected = [(list(x.words), list(x.word_keys), x.completions('Glu'))
+                    for x in dictionaries]
+        hunspell_suggest.share_dictionary_words(dictionaries)
+        for (dictionary, (words, keys, completions)) in zip(
+                dictionaries, expected):
+            self.assertTrue(isinstance(
+                dictionary.words, hunspell_suggest._PooledSequence))
+            self.assertEqual(list(dictionary.words), words)
+            self.assertEqual(list(dictionary.word_keys), keys)
+            self.assertEqual(dictionary.completions('Glu'), completions)
+            for (position, word) in enumerate(words):
+                self.assertEqual(dictionary.words[position], word)
+                self.assertEqual(dictionary.words[position:], words[position:])
+        self.assertEqual(
+            self.nfc(dictionaries[0].completions('Glu')),
+            ['Glut', 'Glühwürmchen'])
+        self.assertEqual(
+            self.nfc(dictionaries[1].completions('Stra')),
+            ['Strasse', 'Straße'])
+        # “Glut”, “Haus” and the word count “4” in the first line of
+        # both .dic files are stored once:
+        pool = hunspell_suggest.WordIndex.open(
+            hunspell_suggest.dictionary_cache_path(
+                'de_AA+de_BB', suffix='.pool'),
+            [x.signature for x in dictionaries])
+        self.assertEqual(
+            sorted(pool.words),
+            sorted(set(expected[0][0]) | set(expected[1][0])))
+        self.assertEqual(
+            len(pool.words), len(expected[0][0]) + len(expected[1][0]) - 3)
+
+    def test_changed_dictionary(self):
+        dictionaries = [hunspell_suggest.Dictionary(name=name)
+                        for name in ('de_AA', 'de_BB')]
+        hunspell_suggest.share_dictionary_words(dictionaries)
+        self.write_dic('de_BB', ['Glut', 'Haus', 'Gleis'])
+        # Make sure the signature changes even with a coarse mtime:
+        os.utime(os.path.join(self.directory, 'de_BB.dic'), (0, 0))
+        dictionaries[1] = hunspell_suggest.Dictionary(name='de_BB')
+        hunspell_suggest.share_dictionary_words(dictionaries)
+        self.assertEqual(
+            self.nfc(dictionaries[1].completions('Gl')), ['Gleis', 'Glut'])
+        self.assertEqual(
+            self.nfc(dictionaries[0].completions('Gl')),
+            ['Glut', 'Glühwürmchen'])
+
+    def test_hunspell(self):
+        hunspell = hunspell_suggest.Hunspell(['de_AA', 'de_BB'])
+        try:
+            for dictionary in hunspell._dictionaries:
+                self.assertTrue(isinstance(
+                    dictionary.words, hunspell_suggest._PooledSequence))
+            self.assertEqual(
+                self.nfc(x[0] for x in hunspell.suggest('Stra')),
+                ['Strasse', 'Straße'])
+        finally:
+            hunspell.release_dictionaries()
+
+@unittest.skipUnless(
+    dictionary_installed('en_US') and dictionary_installed('de_DE'),
+    'Skipping because the en_US or de_DE hunspell dictionary '
+    + 'is not installed.')
+class LoadDictionariesTestCase(unittest.TestCase):
+    def setUp(self):
+        # Compile the word indexes into an empty cache directory:
+        self.cache_directory = tempfile.mkdtemp()
+        self.patcher = mock.patch.object(
+            hunspell_suggest, 'dictionary_cache_path',
+            lambda name, suffix='.index': os.path.join(
+                self.cache_directory, name + suffix))
+        self.patcher.start()
+        self.hunspell = None
+
+    def tearDown(self):
+        if self.hunspell is not None:
+            self.hunspell.release_dictionaries()
+        self.patcher.stop()
+        shutil.rmtree(self.cache_directory)
+
+    def words(self, input_phrase):
+        return [x[0] for x in self.hunspell.suggest(input_phrase)]
+
+    def assert_completes(self, dictionary):
+        '''Check that a long word of the dictionary is suggested as
+        a completion of its beginning'''
+        word = max(dictionary.words[:1000], key=len)
+        self.assertTrue(word in self.words(word[:-1]), word)
+
+    def test_background_load_and_swap(self):
+        self.hunspell = hunspell_suggest.Hunspell(['en_US'])
+        en_us = self.hunspell._dictionaries[0]
+        self.assert_completes(en_us)
+        loaded = threading.Event()
+        self.hunspell.set_dictionary_names(
+            ['en_US', 'de_DE'], background=True, callback=loaded.set)
+        self.assertEqual(
+            self.hunspell.get_dictionary_names(), ['en_US', 'de_DE'])
+        # The old dictionaries are used until the new ones are loaded:
+        self.assert_completes(en_us)
+        self.assertTrue(loaded.wait(120))
+        self.assertEqual(
+            [x.name for x in self.hunspell._dictionaries],
+            ['en_US', 'de_DE'])
+        # The dictionary which was loaded already has been reused:
+        self.assertTrue(self.hunspell._dictionaries[0] is en_us)
+        self.assert_completes(en_us)
+        self.assert_completes(self.hunspell._dictionaries[1])
+
+    def test_superseded_background_load(self):
+        self.hunspell = hunspell_suggest.Hunspell([])
+        loaded = threading.Event()
+        self.hunspell.set_dictionary_names(['de_DE'], background=True)
+        self.hunspell.set_dictionary_names(
+            ['en_US'], background=True, callback=loaded.set)
+        self.assertTrue(loaded.wait(120))
+        # Wait until the superseded load has finished as well:
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and thread.daemon:
+                thread.join(120)
+        self.assertEqual(
+            [x.name for x in self.hunspell._dictionaries], ['en_US'])
+        self.assert_completes(self.hunspell._dictionaries[0])
+
+    def test_fallback_when_process_pool_fails(self):
+        # Compiling several missing word indexes uses a process pool,
+        # if it cannot be started, the dictionaries compile their
+        # indexes themselves:
+        with mock.patch.object(
+                hunspell_suggest.concurrent.futures, 'ProcessPoolExecutor',
+                side_effect=OSError('no process pool')), \
+             mock.patch.object(
+                 hunspell_suggest.os, 'cpu_count', return_value=2):
+            self.hunspell = hunspell_suggest.Hunspell(['en_US', 'de_DE'])
+        self.assertEqual(
+            [x.name for x in self.hunspell._dictionaries],
+            ['en_US', 'de_DE'])
+        for dictionary in self.hunspell._dictionaries:
+            self.assert_completes(dictionary)
+
+    def test_unexpected_process_pool_error(self):
+        # Only the failures to start or use a process pool fall back
+        # to compiling in this process, a bug is not hidden:
+        with mock.patch.object(
+                hunspell_suggest.concurrent.futures, 'ProcessPoolExecutor',
+                side_effect=RuntimeError('bug')), \
+             mock.patch.object(
+                 hunspell_suggest.os, 'cpu_count', return_value=2):
+            with self.assertRaises(RuntimeError):
+                hunspell_suggest.Hunspell(['en_US', 'de_DE'])
@@ -84,6 +84,8 @@ class ItbTestCase(unittest.TestCase):
             self.engine.get_dictionary_names())
         self.orig_qt_im_module_workaround = (
             self.engine.get_qt_im_module_workaround())
+        self.orig_fast_typo_correction = (
+            self.engine.get_fast_typo_correction())
         self.orig_keybindings = (
             self.engine.get_keybindings())
 
@@ -118,6 +120,8 @@ class ItbTestCase(unittest.TestCase):
             self.orig_dictionary_names)
         self.engine.set_qt_im_module_workaround(
             self.orig_qt_im_module_workaround)
+        self.engine.set_fast_typo_correction(
+            self.orig_fast_typo_correction)
         self.engine.set_keybindings(
             self.orig_keybindings)
 
@@ -135,6 +139,7 @@ class ItbTestCase(unittest.TestCase):
         self.engine.set_current_imes(['NoIME'])
         self.engine.set_dictionary_names(['en_US'])
         self.engine.set_qt_im_module_workaround(False)
+        self.engine.set_fast_typo_correction(False)
         self.engine.set_keybindings({
             'cancel': ['Escape'],
             'commit_candidate_1': [],
@@ -239,6 +244,51 @@ class ItbTestCase(unittest.TestCase):
         self.engine.do_process_key_event(IBus.KEY_F1, 0, 0)
         self.assertEqual(self.engine.mock_committed_text, 'cerulean ')
 
+    def test_fast_typo_correction(self):
+        self.engine.set_dictionary_names(['en_US'])
+        self.engine.set_fast_typo_correction(True)
+        self.engine.do_process_key_event(IBus.KEY_t, 0, 0)
+        self.engine.do_process_key_event(IBus.KEY_e, 0, 0)
+        self.engine.do_process_key_event(IBus.KEY_h, 0, 0)
+        self.assertTrue(
+            'the' in [x[0] for x in self.engine._candidates])
+        self.engine.set_fast_typo_correction(False)
+
+    def test_spellcheck_worker_stops(self):
+        self.engine.set_dictionary_names(['en_US'])
+        self.engine._start_spellcheck(('hellp',))
+        thread = self.engine._spellcheck_thread
+        self.assertTrue(thread.is_alive())
+        self.engine._stop_spellcheck_worker()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.engine._spellcheck_thread, None)
+        # A new worker thread is started when needed again:
+        self.engine._start_spellcheck(('wrold',))
+        self.assertTrue(self.engine._spellcheck_thread.is_alive())
+        self.engine._stop_spellcheck_worker()
+
+    def test_focus_out_writes_queued_phrases(self):
+        self.engine.set_current_imes(['NoIME', 't-latn-post'])
+        self.engine.set_dictionary_names(['en_US'])
+        self.engine.do_process_key_event(IBus.KEY_f, 0, 0)
+        self.engine.do_process_key_event(IBus.KEY_o, 0, 0)
+        self.engine.do_process_key_event(IBus.KEY_o, 0, 0)
+        self.engine.do_process_key_event(IBus.KEY_space, 0, 0)
+        self.assertEqual(self.engine.mock_committed_text, 'foo ')
+        # The phrase is only queued but already found:
+        self.assertTrue(self.db.has_pending_updates())
+        self.assertTrue(
+            ('foo', 1.0) in self.db.select_words(
+                'fo', hunspell_obj=self.engine.hunspell_obj))
+        self.engine.do_focus_out()
+        self.assertFalse(self.db.has_pending_updates())
+        self.assertEqual(
+            self.db.db.execute(
+                'SELECT user_freq FROM user_db.phrases '
+                + 'JOIN user_db.tokens ON tokens.id = phrases.phrase '
+                + "WHERE tokens.text = 'foo';").fetchall(),
+            [(1,)])
+
     def test_commit_with_arrows(self):
         self.engine.set_current_imes(['NoIME', 't-latn-post'])
         self.engine.set_dictionary_names(['en_US'])
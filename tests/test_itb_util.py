@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# vim:et sts=4 sw=4
+#
+# ibus-typing-booster - A completion input method for IBus
+#
+# Copyright (c) 2016 Mike FABIAN <mfabian@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+'''
+This file implements test cases for the helper classes in itb_util
+'''
+
+import sys
+import unittest
+
+sys.path.insert(0, "../engine")
+import itb_util
+sys.path.pop(0)
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_eviction_order(self):
+        cache = itb_util.LRUCache(maxsize=3)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+        # Using “a” makes “b” the least recently used item:
+        self.assertEqual(cache.get('a'), 1)
+        cache['d'] = 4
+        self.assertEqual(list(cache.keys()), ['c', 'a', 'd'])
+        self.assertFalse('b' in cache)
+        # Setting an existing key marks it as used as well:
+        cache['c'] = 30
+        cache['e'] = 5
+        self.assertEqual(list(cache.keys()), ['d', 'c', 'e'])
+        self.assertEqual(cache.get('c'), 30)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.evictions, 2)
+
+    def test_get_default(self):
+        cache = itb_util.LRUCache(maxsize=1)
+        self.assertEqual(cache.get('x', 'default'), 'default')
+        cache['x'] = None
+        self.assertEqual(cache.get('x', 'default'), None)
+
+    def test_statistics(self):
+        cache = itb_util.LRUCache(maxsize=2)
+        self.assertEqual(cache.statistics()['hit_ratio'], 0.0)
+        cache['a'] = 1
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual(
+            cache.statistics(),
+            {'size': 1, 'maxsize': 2, 'hits': 2, 'misses': 1,
+             'evictions': 0, 'hit_ratio': 0.667})
+        # Clearing the cache keeps the counters:
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.statistics()['hits'], 2)
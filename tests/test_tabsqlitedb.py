@@ -0,0 +1,976 @@
+# -*- coding: utf-8 -*-
+# vim:et sts=4 sw=4
+#
+# ibus-typing-booster - A completion input method for IBus
+#
+# Copyright (c) 2016 Mike FABIAN <mfabian@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+'''
+This file implements test cases for the user database of tabsqlitedb
+'''
+
+import os
+import sys
+import io
+import contextlib
+import random
+import shutil
+import sqlite3
+import time
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, "../engine")
+import tabsqlitedb
+import hunspell_suggest
+import itb_benchmark
+import itb_util
+sys.path.pop(0)
+
+def stored_phrases(user_db_file):
+    '''Returns the phrases written to a user database file and the
+    sums of their user frequencies, read with a new connection'''
+    db = sqlite3.connect(user_db_file)
+    phrases = dict(db.execute(
+        'SELECT tokens.text, sum(phrases.user_freq) FROM phrases '
+        + 'JOIN tokens ON tokens.id = phrases.phrase '
+        + 'GROUP BY tokens.text;').fetchall())
+    db.close()
+    return phrases
+
+def stored_rows(user_db_file):
+    '''Returns the rows of the phrases table of a user database file
+    with the strings instead of the token ids, sorted'''
+    db = sqlite3.connect(user_db_file)
+    rows = db.execute(
+        'SELECT input_phrase_token.text, phrase_token.text, '
+        + 'p_phrase_token.text, pp_phrase_token.text, user_freq '
+        + 'FROM phrases '
+        + 'JOIN tokens AS input_phrase_token '
+        + 'ON input_phrase_token.id = input_phrase '
+        + 'JOIN tokens AS phrase_token ON phrase_token.id = phrase '
+        + 'JOIN tokens AS p_phrase_token ON p_phrase_token.id = p_phrase '
+        + 'JOIN tokens AS pp_phrase_token '
+        + 'ON pp_phrase_token.id = pp_phrase;').fetchall()
+    db.close()
+    return sorted(rows)
+
+class PrefixRangeTestCase(unittest.TestCase):
+    '''The lookups of the input phrases by the range given by
+    prefix_upper_bound() select the same rows as the LIKE patterns
+    used before'''
+    input_phrases = [
+        'co', 'col', 'colour', 'cold', 'Co', 'coz', 'cp',
+        'кошка', 'кот', 'кон', '日本', '日本語', '日曜日',
+        'σοφία', 'σο', 'ß', 'ßa', 'æble', 'øl',
+        '50%', '50%off', '5050', 'a_b', 'axb', 'a\\b',
+        '\ud7ff', '\ud7ffa', '\ue000', '\ue000b',
+        '\U0001f600', '\U0001f600x', '\U0001f601',
+        '\U0010ffff', '\U0010ffffa', '\U0010fffe',
+    ]
+    prefixes = [
+        '', 'c', 'co', 'col', 'C', 'к', 'ко', 'кош', '日', '日本',
+        'σ', 'ß', 'æ', '50%', '50', 'a_', 'a\\', 'a',
+        '\ud7ff', '\ue000', '\U0001f600', '\U0010ffff', '\U0010fffe',
+        'x', 'z' * 3, '\U0010ffff\U0010ffff',
+    ]
+
+    def setUp(self):
+        self.database = tabsqlitedb.TabSqliteDb(user_db_file=':memory:')
+        self.hunspell_obj = hunspell_suggest.Hunspell(())
+        for (index, input_phrase) in enumerate(self.input_phrases):
+            self.database.check_phrase_and_update_frequency(
+                input_phrase=input_phrase,
+                phrase='phrase%d' % index,
+                user_freq_increment=index + 1)
+        self.database.flush_pending_updates()
+
+    def tokens_in_range(self, prefix):
+        upper_bound = tabsqlitedb.prefix_upper_bound(prefix)
+        if upper_bound is None:
+            return sorted(row[0] for row in self.database.db.execute(
+                'SELECT text FROM user_db.tokens WHERE text >= :prefix',
+                {'prefix': prefix}))
+        return sorted(row[0] for row in self.database.db.execute(
+            'SELECT text FROM user_db.tokens '
+            + 'WHERE text >= :prefix AND text < :upper',
+            {'prefix': prefix, 'upper': upper_bound}))
+
+    def tokens_like(self, prefix):
+        return sorted(row[0] for row in self.database.db.execute(
+            "SELECT text FROM user_db.tokens WHERE text LIKE :pattern "
+            + "ESCAPE '\\'",
+            {'pattern': itb_benchmark.like_pattern(prefix)}))
+
+    def test_upper_bound(self):
+        for prefix in self.prefixes:
+            upper_bound = tabsqlitedb.prefix_upper_bound(prefix)
+            if upper_bound is None:
+                self.assertEqual(prefix.strip('\U0010ffff'), '')
+                continue
+            self.assertTrue(prefix < upper_bound)
+            upper_bound.encode('UTF-8')
+            for text in self.input_phrases:
+                self.assertEqual(
+                    text.startswith(prefix),
+                    prefix <= text < upper_bound)
+
+    def test_range_like_equal(self):
+        for prefix in self.prefixes:
+            tokens = self.tokens_in_range(prefix)
+            self.assertEqual(tokens, self.tokens_like(prefix), prefix)
+            self.assertEqual(
+                tokens,
+                sorted(row[0] for row in self.database.db.execute(
+                    'SELECT text FROM user_db.tokens')
+                       if row[0].startswith(prefix)))
+
+    def test_select_words(self):
+        for prefix in self.prefixes:
+            expected = sorted(
+                'phrase%d' % index
+                for (index, input_phrase)
+                in enumerate(self.input_phrases)
+                # The input phrases are stored without accents:
+                if itb_util.remove_accents(input_phrase).startswith(
+                    itb_util.remove_accents(prefix)))
+            candidates = sorted(
+                phrase for (phrase, dummy_user_freq)
+                in self.database.select_words(
+                    prefix, hunspell_obj=self.hunspell_obj))
+            # select_words() returns at most the 20 best candidates:
+            if len(expected) <= 20:
+                self.assertEqual(candidates, expected, prefix)
+            else:
+                self.assertEqual(len(candidates), 20)
+                self.assertTrue(set(candidates) <= set(expected))
+
+class WriteBehindTestCase(unittest.TestCase):
+    '''Phrases queued by queue_frequency_update() are used before
+    they are written and written by flush_pending_updates()'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.user_db_file = os.path.join(self.directory, 'user.db')
+        self.hunspell_obj = hunspell_suggest.Hunspell(())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_write_behind(self, writer_thread):
+        database = tabsqlitedb.TabSqliteDb(
+            user_db_file=self.user_db_file, writer_thread=writer_thread)
+        database.check_phrase_and_update_frequency(
+            input_phrase='hel', phrase='hello')
+        database.queue_frequency_update(
+            input_phrase='hel', phrase='hello', p_phrase='say')
+        database.queue_frequency_update(
+            input_phrase='he', phrase='help')
+        self.assertTrue(database.has_pending_updates())
+        self.assertEqual(
+            sorted(database.select_words(
+                'he', hunspell_obj=self.hunspell_obj)),
+            [('hello', 2/3), ('help', 1/3)])
+        database._writer.wait()
+        self.assertEqual(stored_phrases(self.user_db_file), {'hello': 1})
+        database.flush_pending_updates()
+        self.assertFalse(database.has_pending_updates())
+        # Until the writer thread has written them, the updates
+        # handed over to it are still used:
+        self.assertEqual(
+            sorted(database.select_words(
+                'he', hunspell_obj=self.hunspell_obj)),
+            [('hello', 2/3), ('help', 1/3)])
+        database._writer.wait()
+        self.assertEqual(
+            stored_phrases(self.user_db_file), {'hello': 2, 'help': 1})
+        # The bigram was written as well:
+        database = tabsqlitedb.TabSqliteDb(user_db_file=self.user_db_file)
+        self.assertEqual(
+            database.select_words(
+                'hel', p_phrase='say', hunspell_obj=self.hunspell_obj),
+            [('hello', 1.0)])
+
+    def test_write_behind(self):
+        self.check_write_behind(writer_thread=False)
+
+    def test_write_behind_writer_thread(self):
+        self.check_write_behind(writer_thread=True)
+
+    def test_flush_when_too_many_pending(self):
+        database = tabsqlitedb.TabSqliteDb(user_db_file=self.user_db_file)
+        for index in range(tabsqlitedb.WRITE_BEHIND_MAX_PENDING - 1):
+            database.queue_frequency_update(phrase='word%d' % index)
+        self.assertEqual(stored_phrases(self.user_db_file), {})
+        database.queue_frequency_update(phrase='word')
+        self.assertFalse(database.has_pending_updates())
+        self.assertEqual(
+            len(stored_phrases(self.user_db_file)),
+            tabsqlitedb.WRITE_BEHIND_MAX_PENDING)
+
+class MigrationTestCase(unittest.TestCase):
+    '''A user database of version 0.65 is migrated when opened'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.user_db_file = os.path.join(self.directory, 'user.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_migrate_from_0_65(self):
+        shortcut_user_freq = itb_util.SHORTCUT_USER_FREQ
+        rows = [
+            ('hel', 'hello', 'say', 'I', 3, 1.0),
+            ('hel', 'hello', 'say', 'I', 5, 2.0),
+            ('hel', 'hello', 'say', 'I', 4, 3.0),
+            ('hel', 'hello', 'say', 'you', 2, 1.0),
+            ('hel', 'hello', '', '', 7, 1.0),
+            ('hel', 'hello', None, None, 1, 1.0),
+            ('he', 'hello', '', '', 1, 1.0),
+            ('sig', 'Best regards', '', '', shortcut_user_freq, 1.0),
+            ('sig', 'Best regards', '', '', shortcut_user_freq + 2, 1.0),
+            ('brb', 'be right back', '', '', shortcut_user_freq, 1.0),
+            ('кот', 'кошка', 'моя', '', 2, 1.0),
+        ]
+        tabsqlitedb._create_user_db_0_65(
+            self.user_db_file, rows, unique_index=False)
+        database = tabsqlitedb.TabSqliteDb(user_db_file=self.user_db_file)
+        database.sync_usrdb()
+        self.assertEqual(
+            database.get_database_desc(self.user_db_file)['version'],
+            tabsqlitedb.USER_DATABASE_VERSION)
+        # The duplicates are merged into one row with the highest
+        # user_freq, a missing context is the same as an empty one:
+        self.assertEqual(
+            stored_rows(self.user_db_file),
+            sorted([
+                ('hel', 'hello', 'say', 'I', 5),
+                ('hel', 'hello', 'say', 'you', 2),
+                ('hel', 'hello', '', '', 7),
+                ('he', 'hello', '', '', 1),
+                ('sig', 'Best regards', '', '', shortcut_user_freq + 2),
+                ('brb', 'be right back', '', '', shortcut_user_freq),
+                ('кот', 'кошка', 'моя', '', 2),
+            ]))
+        self.assertEqual(
+            sorted(database.list_user_shortcuts()),
+            [('brb', 'be right back'), ('sig', 'Best regards')])
+        # The migrated database is used as usual:
+        database.check_phrase_and_update_frequency(
+            input_phrase='hel', phrase='hello', p_phrase='say',
+            pp_phrase='I')
+        database.sync_usrdb()
+        self.assertTrue(
+            ('hel', 'hello', 'say', 'I', 6)
+            in stored_rows(self.user_db_file))
+
+class UpsertTestCase(unittest.TestCase):
+    '''Writing a phrase which is already in the user database
+    increases its frequency and updates its timestamp'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.user_db_file = os.path.join(self.directory, 'user.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def timestamps(self):
+        db = sqlite3.connect(self.user_db_file)
+        timestamps = dict(db.execute(
+            'SELECT tokens.text, phrases.timestamp FROM phrases, tokens '
+            + 'WHERE tokens.id = phrases.p_phrase;').fetchall())
+        db.close()
+        return timestamps
+
+    def check_upsert(self, upsert):
+        with mock.patch.object(tabsqlitedb, 'SQLITE_HAS_UPSERT', upsert):
+            database = tabsqlitedb.TabSqliteDb(
+                user_db_file=self.user_db_file)
+            with mock.patch.object(
+                    tabsqlitedb.time, 'time', return_value=1000.0):
+                database.queue_frequency_update(
+                    input_phrase='hel', phrase='hello', p_phrase='say',
+                    user_freq_increment=3)
+                database.queue_frequency_update(
+                    input_phrase='hel', phrase='hello', p_phrase='wave')
+                database.flush_pending_updates()
+            with mock.patch.object(
+                    tabsqlitedb.time, 'time', return_value=2000.0):
+                # Queued twice in the same batch and written onto
+                # the existing row:
+                database.queue_frequency_update(
+                    input_phrase='hel', phrase='hello', p_phrase='say')
+                database.queue_frequency_update(
+                    input_phrase='hel', phrase='hello', p_phrase='say',
+                    user_freq_increment=2)
+                database.flush_pending_updates()
+            database.sync_usrdb()
+        self.assertEqual(
+            stored_rows(self.user_db_file),
+            [('hel', 'hello', 'say', '', 6),
+             ('hel', 'hello', 'wave', '', 1)])
+        self.assertEqual(self.timestamps(), {'say': 2000.0, 'wave': 1000.0})
+
+    def test_upsert(self):
+        if not tabsqlitedb.SQLITE_HAS_UPSERT:
+            self.skipTest('SQLite is older than 3.24.0')
+        self.check_upsert(upsert=True)
+
+    def test_update_or_insert(self):
+        self.check_upsert(upsert=False)
+
+class NgramTrieTestCase(unittest.TestCase):
+    '''select_words() gives the same results with the in-memory
+    n-gram trie as with the queries of the database'''
+    def setUp(self):
+        self.random = random.Random(11)
+        self.vocabulary = [
+            ''.join(self.random.choice('abcdé')
+                    for dummy in range(self.random.randint(2, 6)))
+            for dummy in range(300)]
+        self.contexts = self.vocabulary[:6] + ['']
+        self.hunspell_obj = hunspell_suggest.Hunspell(())
+        self.sql_database = tabsqlitedb.TabSqliteDb(user_db_file=':memory:')
+        self.trie_database = tabsqlitedb.TabSqliteDb(
+            user_db_file=':memory:', ngram_trie=True)
+        self.assertTrue(self.trie_database._ngram_trie is not None)
+
+    def assert_same_results(self, lookups=30):
+        for dummy in range(lookups):
+            input_phrase = self.random.choice(self.vocabulary + [''])[
+                :self.random.randint(0, 3)]
+            p_phrase = self.random.choice(self.contexts)
+            pp_phrase = self.random.choice(self.contexts)
+            results = []
+            for database in (self.sql_database, self.trie_database):
+                results.append([
+                    (phrase, round(user_freq, 12))
+                    for (phrase, user_freq) in database.select_words(
+                        input_phrase, p_phrase=p_phrase,
+                        pp_phrase=pp_phrase,
+                        hunspell_obj=self.hunspell_obj)])
+            self.assertEqual(results[0], results[1],
+                             (input_phrase, p_phrase, pp_phrase))
+
+    def test_random_changes(self):
+        for index in range(2000):
+            phrase = self.random.choice(self.vocabulary)
+            p_phrase = self.random.choice(self.contexts)
+            pp_phrase = self.random.choice(self.contexts)
+            input_phrase = phrase[:self.random.randint(1, len(phrase))]
+            change = self.random.random()
+            for database in (self.sql_database, self.trie_database):
+                if change < 0.5:
+                    database.queue_frequency_update(
+                        input_phrase=input_phrase, phrase=phrase,
+                        p_phrase=p_phrase, pp_phrase=pp_phrase)
+                elif change < 0.9:
+                    database.check_phrase_and_update_frequency(
+                        input_phrase=input_phrase, phrase=phrase,
+                        p_phrase=p_phrase, pp_phrase=pp_phrase,
+                        user_freq_increment=2)
+                elif change < 0.93:
+                    database.add_phrase(
+                        input_phrase=input_phrase, phrase=phrase,
+                        p_phrase=p_phrase, pp_phrase=pp_phrase,
+                        user_freq=3)
+                elif change < 0.96:
+                    database.update_phrase(
+                        input_phrase=input_phrase, phrase=phrase,
+                        p_phrase=p_phrase, pp_phrase=pp_phrase,
+                        user_freq=5)
+                elif change < 0.98:
+                    database.remove_phrase(
+                        input_phrase=input_phrase, phrase=phrase)
+                else:
+                    database.remove_phrase(input_phrase=None, phrase=phrase)
+            if index % 100 == 0:
+                self.assert_same_results()
+        self.trie_database.flush_pending_updates()
+        self.assert_same_results()
+        # The trie loaded from the database gives the same results as
+        # the trie updated along with the database:
+        self.trie_database.load_ngram_trie()
+        self.assertTrue(self.trie_database._ngram_trie is not None)
+        self.assert_same_results()
+
+class ExternalChangesTestCase(unittest.TestCase):
+    '''Changes made by another connection to the same user database
+    file are seen by select_words()'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.user_db_file = os.path.join(self.directory, 'user.db')
+        self.hunspell_obj = hunspell_suggest.Hunspell(())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_two_connections(self):
+        database = tabsqlitedb.TabSqliteDb(user_db_file=self.user_db_file)
+        other_database = tabsqlitedb.TabSqliteDb(
+            user_db_file=self.user_db_file)
+        database.check_phrase_and_update_frequency(
+            input_phrase='hel', phrase='hello', p_phrase='say')
+        database.sync_usrdb()
+        self.assertEqual(
+            other_database.select_words(
+                'hel', p_phrase='say', hunspell_obj=self.hunspell_obj),
+            [('hello', 1.0)])
+        # Remove everything with the other connection and learn new
+        # phrases. The ids of the removed tokens are used again, “say”
+        # had the id which “other” has now:
+        database.remove_all_phrases()
+        database.check_phrase_and_update_frequency(
+            input_phrase='hel', phrase='help', p_phrase='other')
+        database.check_phrase_and_update_frequency(
+            input_phrase='hel', phrase='helm')
+        database.sync_usrdb()
+        self.assertEqual(
+            other_database._get_token_id('say'),
+            database._get_token_id('other'))
+        # Neither the cached counts nor the cached id of “say” are
+        # used anymore:
+        self.assertEqual(
+            other_database.select_words(
+                'hel', p_phrase='say', hunspell_obj=self.hunspell_obj),
+            [('helm', 0.5), ('help', 0.5)])
+        self.assertEqual(other_database._get_token_id('say'), 0)
+        # The changes made by the other connection are not mistaken
+        # for external ones:
+        self.assertEqual(
+            database.select_words(
+                'hel', p_phrase='other', hunspell_obj=self.hunspell_obj),
+            [('help', 0.75), ('helm', 0.5)])
+
+class PruneTestCase(unittest.TestCase):
+    '''DatabaseWriter.prune() removes old rows and the rows with the
+    lowest frequencies but keeps the shortcuts'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.user_db_file = os.path.join(self.directory, 'user.db')
+        self.hunspell_obj = hunspell_suggest.Hunspell(())
+        self.database = tabsqlitedb.TabSqliteDb(
+            user_db_file=self.user_db_file)
+        self.old_phrases = ['old%d' % index for index in range(200)]
+        self.recent_phrases = ['recent%d' % index for index in range(100)]
+        self.shortcuts = ['shortcut %d' % index for index in range(5)]
+        for phrase in self.old_phrases + self.recent_phrases:
+            self.database.queue_frequency_update(phrase=phrase)
+        # One old phrase has been used very often:
+        self.database.queue_frequency_update(
+            phrase='old0', user_freq_increment=10000)
+        for phrase in self.shortcuts:
+            self.database.add_phrase(
+                input_phrase='sc', phrase=phrase,
+                user_freq=itb_util.SHORTCUT_USER_FREQ)
+        self.database.sync_usrdb()
+        # The old phrases were used about ten years ago, “old0” first:
+        ten_years_ago = time.time() - 10 * 365 * 24 * 60 * 60
+        self.database.db.executemany(
+            'UPDATE user_db.phrases SET timestamp = :timestamp '
+            + 'WHERE phrase = (SELECT id FROM user_db.tokens '
+            + 'WHERE text = :phrase);',
+            [{'timestamp': ten_years_ago + index, 'phrase': phrase}
+             for (index, phrase)
+             in enumerate(self.old_phrases + self.shortcuts)])
+        self.database.db.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_defaults_keep_everything(self):
+        self.assertEqual(tabsqlitedb.USER_DB_HALF_LIFE_DAYS, 0)
+        self.assertEqual(tabsqlitedb.USER_DB_MAX_ROWS, 0)
+        self.database._last_prune_time = 0.0
+        while self.database.run_maintenance_step():
+            self.database._writer.wait()
+        self.assertEqual(len(stored_rows(self.user_db_file)), 305)
+
+    def auto_vacuum(self):
+        return self.database._writer.db.execute(
+            'PRAGMA user_db.auto_vacuum;').fetchall()[0][0]
+
+    def make_non_incremental(self):
+        # Like a user database created by an old version:
+        self.database._writer.db.executescript('''
+        PRAGMA user_db.auto_vacuum = NONE;
+        VACUUM user_db;
+        ''')
+        self.assertEqual(self.auto_vacuum(), 0)
+
+    def test_defaults_do_not_vacuum(self):
+        self.make_non_incremental()
+        self.database._last_prune_time = 0.0
+        with mock.patch.object(self.database._writer, 'prune') as prune, \
+             mock.patch.object(
+                 self.database._writer, 'incremental_vacuum') as vacuum:
+            while self.database.run_maintenance_step():
+                self.database._writer.wait()
+        prune.assert_not_called()
+        vacuum.assert_not_called()
+        self.assertEqual(self.auto_vacuum(), 0)
+
+    def test_prune_converts_to_incremental(self):
+        self.make_non_incremental()
+        # Nothing to prune, nothing is converted:
+        self.database._writer.prune(0, 1000)
+        self.database._writer.incremental_vacuum(
+            tabsqlitedb.USER_DB_VACUUM_STEP_PAGES)
+        self.assertEqual(self.auto_vacuum(), 0)
+        self.database._writer.prune(0, 120)
+        self.assertEqual(self.auto_vacuum(), 2)
+        self.assertEqual(len(stored_phrases(self.user_db_file)), 120)
+
+    def test_prune_max_rows(self):
+        self.assertEqual(
+            self.database.select_words(
+                'old1', hunspell_obj=self.hunspell_obj)[0], ('old1', 1/111))
+        self.database._writer.prune(0, 120)
+        phrases = stored_phrases(self.user_db_file)
+        self.assertEqual(len(phrases), 120)
+        for phrase in self.shortcuts + self.recent_phrases + ['old0']:
+            self.assertTrue(phrase in phrases, phrase)
+        # The oldest of the rows used least are removed first, the
+        # old rows left are the ones used last:
+        self.assertEqual(
+            sorted(phrase for phrase in phrases if phrase.startswith('old')),
+            sorted(['old0'] + self.old_phrases[-14:]))
+        # The tokens not used anymore are removed as well:
+        self.assertEqual(self.database._get_token_id('old1'), 0)
+        self.assertEqual(
+            self.database.select_words(
+                'old1', hunspell_obj=self.hunspell_obj)[0], ('old186', 1/14))
+
+    def test_prune_half_life(self):
+        self.database._writer.prune(365 * 24 * 60 * 60, 0)
+        self.assertEqual(
+            sorted(stored_phrases(self.user_db_file)),
+            sorted(self.shortcuts + self.recent_phrases + ['old0']))
+        self.assertEqual(
+            sorted(self.database.list_user_shortcuts()),
+            sorted(('sc', phrase) for phrase in self.shortcuts))
+
+class BackupTestCase(unittest.TestCase):
+    '''A snapshot written by backup_user_db() can be restored by
+    restore_user_db(), snapshots are only written automatically when
+    asked for'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.user_db_file = os.path.join(self.directory, 'user.db')
+        self.backup_file = (
+            self.user_db_file + tabsqlitedb.USER_DB_BACKUP_SUFFIX)
+        self.hunspell_obj = hunspell_suggest.Hunspell(())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def learn(self, writer_thread=False):
+        database = tabsqlitedb.TabSqliteDb(
+            user_db_file=self.user_db_file, writer_thread=writer_thread)
+        for phrase in ('hello', 'hello', 'help'):
+            database.check_phrase_and_update_frequency(
+                input_phrase='he', phrase=phrase)
+        database.add_phrase(
+            input_phrase='sc', phrase='shortcut',
+            user_freq=itb_util.SHORTCUT_USER_FREQ)
+        database.sync_usrdb()
+        return database
+
+    def check_round_trip(self, writer_thread):
+        database = self.learn(writer_thread=writer_thread)
+        phrases = stored_phrases(self.user_db_file)
+        self.assertTrue(database.backup_user_db(wait=True))
+        database.remove_all_phrases()
+        database._writer.wait()
+        self.assertEqual(stored_phrases(self.user_db_file), {})
+        self.assertEqual(
+            database.select_words('he', hunspell_obj=self.hunspell_obj), [])
+        self.assertTrue(database.restore_user_db())
+        self.assertEqual(stored_phrases(self.user_db_file), phrases)
+        self.assertEqual(
+            database.select_words('he', hunspell_obj=self.hunspell_obj),
+            [('hello', 2/3), ('help', 1/3)])
+        # The user database is still in WAL mode and can be changed:
+        self.assertEqual(
+            database.db.execute('PRAGMA user_db.journal_mode;').fetchall(),
+            [('wal',)])
+        database.check_phrase_and_update_frequency(
+            input_phrase='he', phrase='help')
+        database.sync_usrdb()
+        database._writer.wait()
+        self.assertEqual(
+            stored_phrases(self.user_db_file)['help'], phrases['help'] + 1)
+
+    def test_round_trip(self):
+        self.check_round_trip(writer_thread=False)
+
+    def test_round_trip_writer_thread(self):
+        self.check_round_trip(writer_thread=True)
+
+    def learn_after_backup(self, database):
+        # A phrase which would be lost by restoring the backup:
+        database.check_phrase_and_update_frequency(
+            input_phrase='he', phrase='hero')
+        database.sync_usrdb()
+        phrases = stored_phrases(self.user_db_file)
+        self.assertTrue('hero' in phrases)
+        return phrases
+
+    def test_incompatible_page_size(self):
+        database = self.learn()
+        self.assertTrue(database.backup_user_db(wait=True))
+        db = sqlite3.connect(self.backup_file)
+        page_size = db.execute('PRAGMA page_size;').fetchall()[0][0]
+        db.execute('PRAGMA page_size = %d;' % (2 * page_size))
+        db.execute('VACUUM;')
+        db.close()
+        phrases = self.learn_after_backup(database)
+        self.assertFalse(database.restore_user_db())
+        self.assertEqual(database._writer.errors, 0)
+        # The user database is unchanged:
+        self.assertEqual(stored_phrases(self.user_db_file), phrases)
+
+    def test_wal_snapshot(self):
+        database = self.learn()
+        self.assertTrue(database.backup_user_db(wait=True))
+        db = sqlite3.connect(self.backup_file)
+        db.execute('PRAGMA journal_mode = WAL;')
+        db.close()
+        phrases = self.learn_after_backup(database)
+        self.assertFalse(database.restore_user_db())
+        self.assertEqual(stored_phrases(self.user_db_file), phrases)
+
+    def run_maintenance(self, database, **kwargs):
+        while database.run_maintenance_step(**kwargs):
+            database._writer.wait()
+
+    def test_no_automatic_backup_by_default(self):
+        database = self.learn()
+        self.run_maintenance(database)
+        self.assertFalse(os.path.exists(self.backup_file))
+
+    def test_automatic_backup(self):
+        database = self.learn()
+        self.run_maintenance(database, backup_interval=24 * 60 * 60)
+        self.assertTrue(os.path.exists(self.backup_file))
+        # Not again before the interval has passed:
+        os.remove(self.backup_file)
+        self.run_maintenance(database, backup_interval=24 * 60 * 60)
+        self.assertFalse(os.path.exists(self.backup_file))
+
+class TrainingTestCase(unittest.TestCase):
+    '''Learning from text files gives the same counts however the
+    work is split into chunks, shards and worker processes'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        texts = {
+            'a.txt': 'The quick brown fox jumps over the lazy dog.\n'
+                     'The dog sleeps. The fox runs away quickly!\n' * 5,
+            'b.txt': 'Der Fuchs läuft, der Hund schläft.\n'
+                     'Glühwürmchen leuchten im Garten.\n' * 7,
+            'sub/c.txt': 'кошка спит, собака бежит.\n'
+                         'The quick fox, the lazy dog.\n' * 3,
+        }
+        os.mkdir(os.path.join(self.directory, 'sub'))
+        for (name, text) in texts.items():
+            with open(os.path.join(self.directory, name), 'w',
+                      encoding='UTF-8') as text_file:
+                text_file.write(text)
+        self.filenames = [
+            os.path.join(self.directory, name)
+            for name in ('a.txt', 'b.txt', 'sub/c.txt')]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def train(self, name, processes):
+        user_db_file = os.path.join(self.directory, name + '.db')
+        database = tabsqlitedb.TabSqliteDb(user_db_file=user_db_file)
+        progress = []
+        # The worker processes have to find tabsqlitedb:
+        with mock.patch.object(
+                sys, 'path', [os.path.abspath('../engine')] + sys.path):
+            self.assertTrue(database.read_training_data_from_files(
+                [self.filenames[0], self.filenames[1],
+                 os.path.join(self.directory, 'sub')],
+                progress_callback=progress.append,
+                processes=processes))
+        database.sync_usrdb()
+        self.assertEqual(progress[-1], 1.0)
+        self.assertEqual(progress, sorted(progress))
+        return stored_rows(user_db_file)
+
+    def test_same_as_reading_the_files_one_by_one(self):
+        user_db_file = os.path.join(self.directory, 'files.db')
+        database = tabsqlitedb.TabSqliteDb(user_db_file=user_db_file)
+        for filename in self.filenames:
+            progress = []
+            self.assertTrue(database.read_training_data_from_file(
+                filename, progress_callback=progress.append))
+            self.assertEqual(progress[-1], 1.0)
+        database.sync_usrdb()
+        rows = stored_rows(user_db_file)
+        self.assertTrue(('fox', 'fox', 'brown', 'quick', 5) in rows)
+        self.assertEqual(rows, self.train('single', processes=1))
+        self.assertEqual(rows, self.train('pool', processes=2))
+
+    def test_small_chunks(self):
+        user_db_file = os.path.join(self.directory, 'chunks.db')
+        database = tabsqlitedb.TabSqliteDb(
+            user_db_file=user_db_file, writer_thread=True)
+        progress = []
+        with mock.patch.object(tabsqlitedb, 'TRAINING_CHUNK_MAX_NGRAMS', 5):
+            self.assertTrue(database.read_training_data_from_file(
+                self.filenames[0], progress_callback=progress.append))
+        database.sync_usrdb()
+        self.assertTrue(len(progress) > 2)
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 1.0)
+        rows = stored_rows(user_db_file)
+        user_db_file = os.path.join(self.directory, 'file.db')
+        database = tabsqlitedb.TabSqliteDb(user_db_file=user_db_file)
+        self.assertTrue(
+            database.read_training_data_from_file(self.filenames[0]))
+        database.sync_usrdb()
+        self.assertEqual(rows, stored_rows(user_db_file))
+
+    def test_small_shards(self):
+        with mock.patch.object(tabsqlitedb, 'TRAINING_SHARD_BYTES', 64):
+            self.assertEqual(
+                len(tabsqlitedb._training_shards(self.filenames)),
+                sum((os.path.getsize(filename) + 63) // 64
+                    for filename in self.filenames))
+            rows = self.train('single', processes=1)
+            self.assertEqual(rows, self.train('pool', processes=3))
+        # Every token is counted once, no matter where the shards
+        # start and end:
+        number_of_tokens = 0
+        for filename in self.filenames:
+            with open(filename, encoding='UTF-8') as text_file:
+                number_of_tokens += len(
+                    itb_util.tokenize(text_file.read()))
+        self.assertEqual(
+            sum(row[4] for row in rows if row[0] == row[1]),
+            number_of_tokens)
+
+class SelectWordsCacheTestCase(unittest.TestCase):
+    '''The counts cached by select_words() are not used anymore after
+    the user database has changed'''
+    ngram_trie = False
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.user_db_file = os.path.join(self.directory, 'user.db')
+        self.hunspell_obj = hunspell_suggest.Hunspell(())
+        self.database = tabsqlitedb.TabSqliteDb(
+            user_db_file=self.user_db_file, ngram_trie=self.ngram_trie)
+        self.assertEqual(
+            self.database._ngram_trie is not None, self.ngram_trie)
+        for phrase in ('hello', 'hello', 'help'):
+            self.database.check_phrase_and_update_frequency(
+                input_phrase='he', phrase=phrase)
+        self.database.sync_usrdb()
+        self.assertEqual(self.lookup(), [('hello', 2/3), ('help', 1/3)])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def lookup(self):
+        '''Look up “he” twice, the second lookup must use the cache'''
+        hits = self.database.get_select_words_cache_statistics()['hits']
+        candidates = self.database.select_words(
+            'he', hunspell_obj=self.hunspell_obj)
+        self.assertEqual(
+            self.database.select_words('he', hunspell_obj=self.hunspell_obj),
+            candidates)
+        self.assertEqual(
+            self.database.get_select_words_cache_statistics()['hits'],
+            hits + 1)
+        return candidates
+
+    def test_learning(self):
+        self.database.check_phrase_and_update_frequency(
+            input_phrase='he', phrase='help')
+        self.assertEqual(self.lookup(), [('help', 0.5), ('hello', 0.5)])
+        self.database.queue_frequency_update(
+            input_phrase='he', phrase='help')
+        self.assertEqual(self.lookup(), [('help', 0.6), ('hello', 0.4)])
+        # Writing the queued update does not change the counts, the
+        # cached ones are still used:
+        self.database.flush_pending_updates()
+        hits = self.database.get_select_words_cache_statistics()['hits']
+        self.assertEqual(
+            self.database.select_words('he', hunspell_obj=self.hunspell_obj),
+            [('help', 0.6), ('hello', 0.4)])
+        self.assertEqual(
+            self.database.get_select_words_cache_statistics()['hits'],
+            hits + 1)
+
+    def test_remove_phrase(self):
+        self.database.remove_phrase(input_phrase='he', phrase='help')
+        self.assertEqual(self.lookup(), [('hello', 1.0)])
+
+    def test_remove_all_phrases(self):
+        self.database.remove_all_phrases()
+        self.assertEqual(self.lookup(), [])
+
+    def test_prune(self):
+        self.database._writer.prune(0, 1)
+        self.assertEqual(self.lookup(), [('hello', 1.0)])
+
+    def test_restore(self):
+        self.assertTrue(self.database.backup_user_db(wait=True))
+        self.database.check_phrase_and_update_frequency(
+            input_phrase='he', phrase='helium')
+        self.assertEqual(
+            self.lookup(),
+            [('hello', 0.5), ('help', 0.25), ('helium', 0.25)])
+        self.assertTrue(self.database.restore_user_db())
+        self.assertEqual(self.lookup(), [('hello', 2/3), ('help', 1/3)])
+
+class SelectWordsCacheNgramTrieTestCase(SelectWordsCacheTestCase):
+    '''The same with the in-memory n-gram trie'''
+    ngram_trie = True
+
+class SystemDbTestCase(unittest.TestCase):
+    '''The system n-gram database is only used when it is attached
+    explicitly'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hunspell_obj = hunspell_suggest.Hunspell(())
+        counts_file = os.path.join(self.directory, 'counts.txt')
+        with open(counts_file, 'w', encoding='UTF-8') as counts:
+            counts.write('help\t100\n'
+                         'hello\t10\n'
+                         'helium\t50\n'
+                         'Helsinki\t30\n'
+                         'say hello\t8\n'
+                         'I say hello\t5\n'
+                         'sentence too long here\t9\n')
+        self.system_db_file = os.path.join(
+            self.directory, tabsqlitedb.SYSTEM_DB_FILE_NAME)
+        progress = []
+        self.assertTrue(tabsqlitedb.import_system_db(
+            counts_file, self.system_db_file,
+            progress_callback=progress.append))
+        self.assertEqual(progress[-1], 1.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_immutable(self):
+        # Readable the way attach_system_db() opens it, without a
+        # journal, a WAL or any write access:
+        db = sqlite3.connect(
+            'file:%s?mode=ro&immutable=1' % self.system_db_file, uri=True)
+        self.assertEqual(
+            db.execute("SELECT value FROM desc WHERE name = 'version';"
+                      ).fetchall(),
+            [(tabsqlitedb.SYSTEM_DATABASE_VERSION,)])
+        self.assertEqual(
+            db.execute('PRAGMA journal_mode;').fetchall(), [('delete',)])
+        tokens = [row[0] for row in db.execute(
+            'SELECT text FROM tokens ORDER BY id;')]
+        self.assertEqual(tokens, sorted(tokens))
+        self.assertTrue('Helsinki' in tokens)
+        self.assertFalse('sentence' in tokens)
+        self.assertEqual(
+            db.execute('SELECT count(*) FROM ngrams;').fetchall(), [(6,)])
+        with self.assertRaises(sqlite3.OperationalError):
+            db.execute("INSERT INTO desc VALUES ('x', 'y');")
+        db.close()
+        self.assertFalse(os.path.exists(self.system_db_file + '-wal'))
+        self.assertFalse(os.path.exists(self.system_db_file + '-journal'))
+
+    def test_user_ranking_unchanged_without_system_db(self):
+        data_directory = os.path.join(self.directory, 'data')
+        os.mkdir(data_directory)
+        shutil.copy(self.system_db_file, data_directory)
+        user_db_file = os.path.join(self.directory, 'user.db')
+        for phrase in ('hello', 'hello', 'hello', 'helm'):
+            database = tabsqlitedb.TabSqliteDb(user_db_file=user_db_file)
+            database.check_phrase_and_update_frequency(
+                input_phrase='hel', phrase=phrase, p_phrase='say')
+            database.sync_usrdb()
+        user_ranking = [('hello', 0.75), ('helm', 0.25)]
+        # A system database in the default location is not used
+        # unless asked for:
+        with mock.patch.object(
+                itb_util, 'xdg_save_data_path',
+                return_value=data_directory):
+            database = tabsqlitedb.get_shared_database(
+                user_db_file=user_db_file,
+                ngram_trie=True, writer_thread=True)
+            self.assertEqual(database._system_db_token_ids, None)
+            self.assertEqual(
+                database.select_words(
+                    'hel', hunspell_obj=self.hunspell_obj), user_ranking)
+            # Attached explicitly, it is blended in:
+            self.assertTrue(database.attach_system_db(self.system_db_file))
+            self.assertTrue(database.attach_system_db(self.system_db_file))
+            candidates = database.select_words(
+                'hel', hunspell_obj=self.hunspell_obj)
+            self.assertEqual(
+                sorted(phrase for (phrase, dummy_user_freq) in candidates),
+                ['Helsinki', 'helium', 'hello', 'helm', 'help'])
+            self.assertEqual(candidates[0][0], 'hello')
+            database.detach_system_db()
+            self.assertEqual(
+                database.select_words(
+                    'hel', hunspell_obj=self.hunspell_obj), user_ranking)
+            tabsqlitedb.release_shared_database(database)
+
+class BenchmarkTestCase(unittest.TestCase):
+    '''A tiny run of the benchmark of the user database'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay_typing_trace(self):
+        database = tabsqlitedb.TabSqliteDb(user_db_file=':memory:')
+        trace = ['hello', 'world'] * 7
+        (lookup_latencies,
+         learn_latencies,
+         flush_latencies,
+         lookups) = itb_benchmark.replay_typing_trace(database, trace)
+        self.assertEqual(len(lookup_latencies), len(lookups))
+        self.assertEqual(len(learn_latencies), len(trace))
+        # Flushed after a sentence and at the end of the trace:
+        self.assertEqual(len(flush_latencies), 2)
+        self.assertFalse(database.has_pending_updates())
+        self.assertEqual(
+            database.select_words('hel', p_phrase='world')[0][0], 'hello')
+        self.assertEqual(
+            len(itb_benchmark.replay_commits(database, trace)), len(trace))
+
+    def test_main(self):
+        output = io.StringIO()
+        with mock.patch.object(
+                sys, 'argv',
+                ['itb_benchmark.py', '--rows', '2000', '--words', '100',
+                 '--training-words', '1000',
+                 '--directory', self.directory]), \
+             contextlib.redirect_stdout(output):
+            itb_benchmark.main()
+        lines = output.getvalue().splitlines()
+        self.assertEqual(
+            [line.split()[:2] for line in lines[1:]],
+            [['memory', '2000'], ['wal', '2000']])
+        # The database file is kept for the next run, the copy the
+        # benchmark worked on is removed:
+        self.assertEqual(os.listdir(self.directory), ['user-2000-1.db'])